@@ -0,0 +1,103 @@
+import logging
+import statistics
+import threading
+import time
+from typing import List, Optional
+
+# A window of a concurrency limit holds about one round trip of samples, but never fewer than this.
+MIN_WINDOW_SIZE = 8
+
+
+class AimdLimiter:
+    # Additive increase / multiplicative decrease of a concurrency or batch size limit, decided once per window
+    # of samples, so that a single slow or failed sample does not cut the limit on its own.
+    # A window is congested when too many of its samples failed, or when its median latency exceeds max_latency
+    # or, without max_latency, latency_tolerance times the lowest window median seen recently.
+    def __init__(
+        self,
+        name: str,
+        initial_limit: float,
+        min_limit: float = 1,
+        max_limit: float = 64,
+        max_latency: Optional[float] = None,
+        latency_tolerance: float = 2.0,
+        max_error_ratio: float = 0.1,
+        window_size: Optional[int] = None,
+        increase: float = 1,
+        decrease_ratio: float = 0.5,
+        report_interval: float = 60.0,
+    ) -> None:
+        self.name = name
+        self.limit = float(max(min_limit, min(max_limit, initial_limit)))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_latency = max_latency
+        self.latency_tolerance = latency_tolerance
+        self.max_error_ratio = max_error_ratio
+        self.window_size = window_size
+        self.increase = increase
+        self.decrease_ratio = decrease_ratio
+        self.report_interval = report_interval
+        self.baseline_latency: Optional[float] = None
+        self.window_latencies: List[float] = []
+        self.window_errors = 0
+        self.lock = threading.Lock()
+        self.reported_at = time.monotonic()
+        self.number_of_successes = 0
+        self.number_of_errors = 0
+        self.total_latency = 0.0
+
+    def get_limit(self) -> int:
+        return int(self.limit)
+
+    def get_window_size(self) -> int:
+        # Without window_size, the samples of every request issued under the current limit.
+        return self.window_size or max(MIN_WINDOW_SIZE, self.get_limit())
+
+    def is_congested(self, latency: float) -> bool:
+        if self.max_latency is not None:
+            return latency > self.max_latency
+        # The baseline slowly drifts upwards, so that it follows a downstream that got permanently slower.
+        self.baseline_latency = latency if self.baseline_latency is None else min(latency, self.baseline_latency * 1.01)
+        return latency > self.baseline_latency * self.latency_tolerance
+
+    def close_window(self) -> None:
+        latency = statistics.median(self.window_latencies)
+        error_ratio = self.window_errors / len(self.window_latencies)
+        if self.is_congested(latency) or error_ratio > self.max_error_ratio:
+            self.limit = max(self.min_limit, self.limit * self.decrease_ratio)
+        else:
+            self.limit = min(self.max_limit, self.limit + self.increase)
+        self.window_latencies = []
+        self.window_errors = 0
+
+    def record(self, latency: float, success: bool = True) -> None:
+        with self.lock:
+            now = time.monotonic()
+            if success:
+                self.number_of_successes += 1
+            else:
+                self.number_of_errors += 1
+                self.window_errors += 1
+            self.total_latency += latency
+
+            self.window_latencies.append(latency)
+            if len(self.window_latencies) >= self.get_window_size():
+                self.close_window()
+
+            if now - self.reported_at >= self.report_interval:
+                self.report(now)
+
+    def report(self, now: float) -> None:
+        elapsed = now - self.reported_at
+        number_of_samples = self.number_of_successes + self.number_of_errors
+        logging.info(
+            f"{self.name}: limit = {self.get_limit()}"
+            f", throughput = {self.number_of_successes / elapsed:.2f}/sec"
+            f", errors = {self.number_of_errors}"
+            f", latency = {self.total_latency / max(1, number_of_samples):.3f} sec"
+        )
+        self.reported_at = now
+        self.number_of_successes = 0
+        self.number_of_errors = 0
+        self.total_latency = 0.0
@@ -1,84 +1,210 @@
+import concurrent.futures
 import hashlib
+import itertools
 import json
 import logging
 import sys
+import time
+from dataclasses import dataclass, field
 from datetime import datetime
-from typing import List
+from typing import Any, Dict, Iterable, Iterator, List, Set, Tuple
 from urllib.parse import urlparse
 
 import click
 import more_itertools
 import pymongo
+import pymongo.results
 
 from .command import option_log_level, option_mongodb_url
 from .db import get_database
+from .status import STATUS_PENDING, URL_STAGES, make_status_record
 
 COLLECTION_URL = "url"
 
 
-def read_urls_from_stdin() -> List[str]:
-    urls = []
-    while url := sys.stdin.readline():
-        urls.append(url.strip())
-    return urls
+@dataclass
+class IngestProgress:
+    report_interval: float = 10.0
+    urls: int = 0
+    inserted: int = 0
+    updated: int = 0
+    skipped: int = 0
+    started_at: float = field(default_factory=time.monotonic)
+    reported_at: float = field(default_factory=time.monotonic)
+
+    def update(self, number_of_urls: int, inserted: int, updated: int, skipped: int) -> None:
+        self.urls += number_of_urls
+        self.inserted += inserted
+        self.updated += updated
+        self.skipped += skipped
+        if time.monotonic() - self.reported_at >= self.report_interval:
+            self.report()
+
+    def report(self) -> None:
+        self.reported_at = time.monotonic()
+        elapsed = max(self.reported_at - self.started_at, 1e-9)
+        logging.info(
+            f"urls = {self.urls}, inserted = {self.inserted}, updated = {self.updated}, skipped = {self.skipped}, "
+            f"urls/sec = {self.urls / elapsed:.1f}"
+        )
+
+
+def read_records_from_stdin(stdin_format: str) -> Iterator[Dict[str, Any]]:
+    for line in sys.stdin:
+        if line := line.strip():
+            # jsonl is the `scan_nginx --output-format jsonl` output: {"url": ..., "size": ..., "mtime": ...}
+            yield json.loads(line) if stdin_format == "jsonl" else {"url": line}
 
 
 def make_url_id(url: str) -> str:
     return hashlib.sha1(url.encode("utf-8")).hexdigest()
 
 
-def bulk_upsert_urls(mongodb: pymongo.database.Database, urls: List[str]) -> None:
-    logging.info(f"urls.length = {len(urls)}")
+def make_url_record(record: Dict[str, Any]) -> Dict[str, Any]:
+    url_record = {
+        "url": record["url"],
+        "host": urlparse(record["url"]).netloc,
+    }
+    listing = {
+        key: record[name] for key, name in [("size", "size"), ("modifiedAt", "mtime")] if record.get(name) is not None
+    }
+    if listing:
+        url_record["listing"] = listing
+    return url_record
+
+
+def bulk_upsert_urls(
+    mongodb: pymongo.database.Database, records: List[Dict[str, Any]]
+) -> pymongo.results.BulkWriteResult:
+    logging.debug(f"records.length = {len(records)}")
     operations = [
         pymongo.UpdateOne(
-            {"_id": make_url_id(url)},
+            {"_id": make_url_id(record["url"])},
             {
                 "$set": {
                     "updatedAt": datetime.now().timestamp(),
-                    "url": url,
-                    "host": urlparse(url).netloc,
+                    **make_url_record(record),
                 },
                 "$setOnInsert": {
                     "createdAt": datetime.now().timestamp(),
+                    **make_status_record(URL_STAGES, STATUS_PENDING),
                 },
             },
             upsert=True,
         )
-        for url in urls
+        for record in records
     ]
-    mongodb[COLLECTION_URL].bulk_write(operations)
+    return mongodb[COLLECTION_URL].bulk_write(operations, ordered=False)
+
 
+def find_existing_url_ids(mongodb: pymongo.database.Database, url_ids: List[str]) -> Set[str]:
+    records = mongodb[COLLECTION_URL].find({"_id": {"$in": url_ids}}, {"_id": True})
+    return {record["_id"] for record in records}
 
-def add_url(mongodb_url: str, chunk_size: int, urls: List[str]) -> None:
+
+def bulk_insert_new_urls(mongodb: pymongo.database.Database, records: List[Dict[str, Any]]) -> Tuple[int, int, int]:
+    records_by_id = {make_url_id(record["url"]): record for record in records}
+    existing_url_ids = find_existing_url_ids(mongodb, list(records_by_id.keys()))
+    new_records = [record for url_id, record in records_by_id.items() if url_id not in existing_url_ids]
+    logging.debug(f"new_records.length = {len(new_records)}")
+    if len(new_records) == 0:
+        return 0, 0, len(records)
+
+    now = datetime.now().timestamp()
+    operations = [
+        pymongo.UpdateOne(
+            {"_id": make_url_id(record["url"])},
+            {
+                # Only $setOnInsert, so a URL inserted concurrently since the probe is left untouched.
+                "$setOnInsert": {
+                    "createdAt": now,
+                    "updatedAt": now,
+                    **make_url_record(record),
+                    **make_status_record(URL_STAGES, STATUS_PENDING),
+                },
+            },
+            upsert=True,
+        )
+        for record in new_records
+    ]
+    result = mongodb[COLLECTION_URL].bulk_write(operations, ordered=False)
+    return result.upserted_count, 0, len(records) - result.upserted_count
+
+
+def add_url(
+    mongodb_url: str, chunk_size: int, max_in_flight: int, skip_existing: bool, records: Iterable[Dict[str, Any]]
+) -> None:
     logging.debug(f"mongodb_url = {json.dumps(mongodb_url)}")
     logging.debug(f"chunk_size = {chunk_size}")
-    logging.debug(f"urls.length = {len(urls)}")
+    logging.debug(f"max_in_flight = {max_in_flight}")
+    logging.debug(f"skip_existing = {json.dumps(skip_existing)}")
 
     mongodb = get_database(mongodb_url)
-
-    for chunked_urls in more_itertools.chunked(urls, chunk_size):
-        bulk_upsert_urls(mongodb, chunked_urls)
+    progress = IngestProgress()
+
+    def collect(futures: Set[concurrent.futures.Future], return_when: str) -> Set[concurrent.futures.Future]:
+        done, not_done = concurrent.futures.wait(futures, return_when=return_when)
+        for future in done:
+            number_of_urls, (inserted, updated, skipped) = future.result()
+            progress.update(number_of_urls, inserted, updated, skipped)
+        return not_done
+
+    def write(chunked_records: List[Dict[str, Any]]) -> Tuple[int, Tuple[int, int, int]]:
+        if skip_existing:
+            return len(chunked_records), bulk_insert_new_urls(mongodb, chunked_records)
+        else:
+            result = bulk_upsert_urls(mongodb, chunked_records)
+            return len(chunked_records), (result.upserted_count, result.matched_count, 0)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        in_flight: Set[concurrent.futures.Future] = set()
+        for chunked_records in more_itertools.chunked(records, chunk_size):
+            # Stop reading stdin while max_in_flight writes are outstanding.
+            if len(in_flight) >= max_in_flight:
+                in_flight = collect(in_flight, concurrent.futures.FIRST_COMPLETED)
+            in_flight.add(executor.submit(write, chunked_records))
+        collect(in_flight, concurrent.futures.ALL_COMPLETED)
+
+    progress.report()
 
 
 @click.command()
 @option_log_level
 @option_mongodb_url
 @click.option("--stdin", type=bool, default=False, is_flag=True)
+@click.option("--stdin-format", type=click.Choice(["text", "jsonl"]), default="text", show_default=True)
 @click.option("--chunk-size", type=int, default=1000, show_default=True, required=True)
+@click.option("--max-in-flight", type=int, default=4, show_default=True, required=True)
+@click.option("--skip-existing", type=bool, default=False, is_flag=True, help="insert new URLs only")
 @click.argument("urls", type=str, nargs=-1)
-def main(log_level: str, mongodb_url: str, stdin: bool, chunk_size: int, urls: List[str]) -> None:
+def main(
+    log_level: str,
+    mongodb_url: str,
+    stdin: bool,
+    stdin_format: str,
+    chunk_size: int,
+    max_in_flight: int,
+    skip_existing: bool,
+    urls: List[str],
+) -> None:
     logging.basicConfig(
         format="%(asctime)s %(levelname)s %(message)s",
         level=getattr(logging, log_level.upper(), logging.INFO),
     )
     logging.debug(f"log_level = {json.dumps(log_level)}")
     logging.debug(f"stdin = {json.dumps(stdin)}")
-
-    urls = list(urls)
-    if stdin:
-        urls.extend(read_urls_from_stdin())
-
-    add_url(mongodb_url=mongodb_url, chunk_size=chunk_size, urls=urls)
+    logging.debug(f"stdin_format = {json.dumps(stdin_format)}")
+
+    add_url(
+        mongodb_url=mongodb_url,
+        chunk_size=chunk_size,
+        max_in_flight=max_in_flight,
+        skip_existing=skip_existing,
+        records=itertools.chain(
+            ({"url": url} for url in urls),
+            read_records_from_stdin(stdin_format) if stdin else [],
+        ),
+    )
 
     logging.info("done")
 
@@ -0,0 +1,71 @@
+import datetime
+import hashlib
+import http.server
+import json
+import logging
+import time
+from typing import Any, Dict, List
+
+from ..status import STAGE_NSFW_GANTMAN, STAGE_NSFW_OPENNSFW2
+from .origin import StoppableServer, make_server
+
+LABELS = {
+    STAGE_NSFW_GANTMAN: ["drawings", "hentai", "neutral", "porn", "sexy"],
+    STAGE_NSFW_OPENNSFW2: ["sfw", "nsfw"],
+}
+
+
+def make_labels(names: List[str], bin: bytes) -> Dict[str, float]:
+    # Any distribution will do, predict_nsfw_* only stores it.
+    digest = hashlib.sha1(bin).digest()
+    scores = [digest[index] + 1 for index in range(len(names))]
+    return {name: score / sum(scores) for name, score in zip(names, scores)}
+
+
+def make_service(name: str) -> Dict[str, Any]:
+    return {"name": name, "version": "benchmark", "libraries": {}}
+
+
+class ClassifierHandler(http.server.BaseHTTPRequestHandler):
+    # Serves GET /{classifier name}/about and POST /{classifier name}/classify, so that one stub can stand in
+    # for every predict_nsfw_* classifier.
+    protocol_version = "HTTP/1.1"
+    latency: float
+
+    def do_GET(self) -> None:
+        name, _, action = self.path.strip("/").partition("/")
+        if action != "about" or name not in LABELS:
+            self.send_error(404)
+            return
+        self.send_json({"service": make_service(name), "time": datetime.datetime.now().timestamp()})
+
+    def do_POST(self) -> None:
+        bin = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.latency)
+
+        name, _, action = self.path.strip("/").partition("/")
+        if action != "classify" or name not in LABELS:
+            self.send_error(404)
+            return
+        self.send_json(
+            {
+                "service": make_service(name),
+                "time": datetime.datetime.now().timestamp(),
+                "labels": make_labels(LABELS[name], bin),
+            }
+        )
+
+    def send_json(self, value: Dict[str, Any]) -> None:
+        body = json.dumps(value).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format: str, *args: Any) -> None:
+        logging.debug(f"classifier: {format % args}")
+
+
+def make_classifier_server(latency: float, host: str = "127.0.0.1", port: int = 0) -> StoppableServer:
+    return make_server(ClassifierHandler, host, port, latency=latency)
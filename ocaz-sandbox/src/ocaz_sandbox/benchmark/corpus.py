@@ -0,0 +1,97 @@
+import json
+import logging
+import pathlib
+from typing import Any, Callable, Dict, List
+
+import cv2
+import numpy as np
+import PIL.Image
+
+MANIFEST_FILE_NAME = "manifest.json"
+KINDS = ["jpeg", "png", "gif", "mp4"]
+MIME_TYPES = {"jpeg": "image/jpeg", "png": "image/png", "gif": "image/gif", "mp4": "video/mp4"}
+# Larger than HEAD_BLOCK_SIZE of resolve_object_meta, so that these objects go through resolve_sha1.
+LARGE_IMAGE_SIZE = 2048
+
+
+def make_image(rng: np.random.Generator, width: int, height: int) -> np.ndarray:
+    # Random blocks over a gradient, so that every image has distinct perceptual hashes.
+    blocks = rng.integers(0, 256, size=(8, 8, 3), dtype=np.uint8)
+    image = cv2.resize(blocks, (width, height), interpolation=cv2.INTER_LINEAR)
+    gradient = np.linspace(0, 64, width, dtype=np.uint8)[np.newaxis, :, np.newaxis]
+    return cv2.add(image, np.broadcast_to(gradient, image.shape).copy())
+
+
+def write_jpeg(path: pathlib.Path, rng: np.random.Generator, image_size: int, video_frames: int) -> None:
+    cv2.imwrite(str(path), make_image(rng, image_size, image_size * 3 // 4), [cv2.IMWRITE_JPEG_QUALITY, 90])
+
+
+def write_png(path: pathlib.Path, rng: np.random.Generator, image_size: int, video_frames: int) -> None:
+    cv2.imwrite(str(path), make_image(rng, image_size * 3 // 4, image_size))
+
+
+def write_gif(path: pathlib.Path, rng: np.random.Generator, image_size: int, video_frames: int) -> None:
+    frames = [
+        PIL.Image.fromarray(cv2.cvtColor(make_image(rng, image_size // 2, image_size // 2), cv2.COLOR_BGR2RGB))
+        for _ in range(4)
+    ]
+    frames[0].save(path, save_all=True, append_images=frames[1:], duration=100, loop=0)
+
+
+def write_mp4(path: pathlib.Path, rng: np.random.Generator, image_size: int, video_frames: int) -> None:
+    width, height = image_size // 2, image_size * 3 // 8
+    image = make_image(rng, width * 2, height)
+    video_writer = cv2.VideoWriter(str(path), cv2.VideoWriter.fourcc(*"mp4v"), 30, (width, height))
+    try:
+        for index in range(video_frames):
+            offset = index * width // video_frames
+            video_writer.write(np.ascontiguousarray(image[:, offset : offset + width]))
+    finally:
+        video_writer.release()
+
+
+def write_large_png(path: pathlib.Path, rng: np.random.Generator) -> None:
+    # Noise does not compress, so the file is about 3 bytes per pixel.
+    cv2.imwrite(str(path), rng.integers(0, 256, size=(LARGE_IMAGE_SIZE, LARGE_IMAGE_SIZE, 3), dtype=np.uint8))
+
+
+WRITERS: Dict[str, Callable[[pathlib.Path, np.random.Generator, int, int], None]] = {
+    "jpeg": write_jpeg,
+    "png": write_png,
+    "gif": write_gif,
+    "mp4": write_mp4,
+}
+
+
+def read_manifest(corpus_dir: pathlib.Path) -> Dict[str, Any]:
+    with (corpus_dir / MANIFEST_FILE_NAME).open("r") as file:
+        return json.load(file)
+
+
+def generate_corpus(corpus_dir: pathlib.Path, parameters: Dict[str, Any]) -> List[Dict[str, Any]]:
+    try:
+        manifest = read_manifest(corpus_dir)
+        if manifest["parameters"] == parameters:
+            logging.info(f"reuse corpus in {corpus_dir}")
+            return manifest["files"]
+    except FileNotFoundError:
+        pass
+
+    logging.info(f"generate corpus in {corpus_dir}")
+    corpus_dir.mkdir(parents=True, exist_ok=True)
+    rng = np.random.default_rng(parameters["seed"])
+    files = []
+    for index in range(parameters["number_of_objects"]):
+        kind = KINDS[index % len(KINDS)]
+        path = corpus_dir / f"{index:06d}.{kind}"
+        WRITERS[kind](path, rng, parameters["image_size"], parameters["video_frames"])
+        files.append({"name": path.name, "mimeType": MIME_TYPES[kind], "size": path.stat().st_size})
+    for index in range(parameters["number_of_large_objects"]):
+        path = corpus_dir / f"large-{index:06d}.png"
+        write_large_png(path, rng)
+        files.append({"name": path.name, "mimeType": MIME_TYPES["png"], "size": path.stat().st_size})
+
+    with (corpus_dir / MANIFEST_FILE_NAME).open("w") as file:
+        json.dump({"parameters": parameters, "files": files}, file, indent=2)
+    logging.info(f"generated {len(files)} files, {sum(file['size'] for file in files)} bytes")
+    return files
@@ -0,0 +1,120 @@
+import http.server
+import logging
+import mimetypes
+import pathlib
+import re
+import threading
+import time
+from typing import Any, Optional, Tuple
+
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def parse_range(range_header: str, size: int) -> Optional[Tuple[int, int]]:
+    if not (match := RANGE_PATTERN.match(range_header.strip())):
+        return None
+    start, end = match.groups()
+    if start == "":
+        # A suffix range, "bytes=-N" is the last N bytes.
+        return max(0, size - int(end)), size - 1
+    return int(start), min(size - 1, int(end)) if end else size - 1
+
+
+def copy_range(source: Any, destination: Any, start_byte: int, length: int) -> None:
+    source.seek(start_byte)
+    while length > 0:
+        bin = source.read(min(length, 1000 * 1000))
+        if not bin:
+            break
+        destination.write(bin)
+        length -= len(bin)
+
+
+class OriginHandler(http.server.BaseHTTPRequestHandler):
+    # Keep-alive like a real origin, so that the pooled connections of HttpClient are exercised.
+    protocol_version = "HTTP/1.1"
+    root_dir: pathlib.Path
+    latency: float
+
+    def do_HEAD(self) -> None:
+        self.send_object(with_body=False)
+
+    def do_GET(self) -> None:
+        self.send_object(with_body=True)
+
+    def send_object(self, with_body: bool) -> None:
+        time.sleep(self.latency)
+        path = self.root_dir / self.path.lstrip("/").split("?")[0]
+        if not path.is_file() or self.root_dir not in path.resolve().parents:
+            self.send_error(404)
+            return
+
+        size = path.stat().st_size
+        start_byte, end_byte = 0, size - 1
+        status = 200
+        if range_header := self.headers.get("Range"):
+            if (byte_range := parse_range(range_header, size)) is None or byte_range[0] >= size:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            start_byte, end_byte = byte_range
+            status = 206
+
+        self.send_response(status)
+        self.send_header("Content-Type", mimetypes.guess_type(path.name)[0] or "application/octet-stream")
+        self.send_header("Content-Length", str(end_byte - start_byte + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Last-Modified", self.date_time_string(int(path.stat().st_mtime)))
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start_byte}-{end_byte}/{size}")
+        if self.headers.get("Connection", "").lower() == "close":
+            # Otherwise ffmpeg (cv2.VideoCapture) tries to reuse the connection when it seeks.
+            self.send_header("Connection", "close")
+        self.end_headers()
+        if with_body:
+            try:
+                with path.open("rb") as file:
+                    copy_range(file, self.wfile, start_byte, end_byte - start_byte + 1)
+            except (BrokenPipeError, ConnectionResetError):
+                # Clients close the stream once they have read what they need, e.g. the head block.
+                self.close_connection = True
+
+    def log_message(self, format: str, *args: Any) -> None:
+        logging.debug(f"origin: {format % args}")
+
+
+class StoppableServer:
+    def __init__(self, server: http.server.ThreadingHTTPServer) -> None:
+        self.server = server
+        self.thread = threading.Thread(target=server.serve_forever, daemon=True)
+
+    def get_base_url(self) -> str:
+        host, port = self.server.server_address[:2]
+        if isinstance(host, bytes):
+            host = host.decode("ascii")
+        return f"http://{host}:{port}"
+
+    def __enter__(self) -> "StoppableServer":
+        self.thread.start()
+        logging.info(f"serve {self.get_base_url()}")
+        return self
+
+    def __exit__(self, *args: Any) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+
+def make_server(handler_class: type, host: str, port: int, **attributes: Any) -> StoppableServer:
+    handler = type(handler_class.__name__, (handler_class,), attributes)
+    server = http.server.ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return StoppableServer(server)
+
+
+def make_origin_server(
+    root_dir: pathlib.Path, latency: float, host: str = "127.0.0.1", port: int = 0
+) -> StoppableServer:
+    return make_server(OriginHandler, host, port, root_dir=root_dir.resolve(), latency=latency)
@@ -0,0 +1,404 @@
+import concurrent.futures
+import dataclasses
+import functools
+import json
+import logging
+import os
+import pathlib
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import click
+import more_itertools
+import numpy as np
+import pymongo
+
+from .. import (
+    predict_nsfw_gantman,
+    predict_nsfw_opennsfw2,
+    resolve_media_meta,
+    resolve_object_meta,
+    resolve_phash,
+    resolve_sha1,
+    version,
+)
+from ..add_url import bulk_upsert_urls
+from ..blob_cache import make_blob_cache
+from ..command import (
+    option_cache_dir,
+    option_cache_max_bytes,
+    option_initial_connections_per_host,
+    option_latency_tolerance,
+    option_log_level,
+    option_max_connections_per_host,
+)
+from ..db import COLLECTION_OBJECT, COLLECTION_URL, get_database
+from ..http_client import configure_http_client
+from ..make_index import make_index
+from ..prediction_reuse import REUSE_SHA1, make_reuse_spec
+from ..status import (
+    STAGE_MEDIA_META,
+    STAGE_NSFW_GANTMAN,
+    STAGE_NSFW_OPENNSFW2,
+    STAGE_OBJECT_META,
+    STAGE_PHASH,
+    STAGE_SHA1,
+    make_pending_condition,
+)
+from .classifier import make_classifier_server
+from .corpus import generate_corpus
+from .origin import make_origin_server
+
+STAGE_ADD_URL = "addUrl"
+
+
+@dataclasses.dataclass
+class Stage:
+    name: str
+    collection_name: str
+    find_items: Callable[[pymongo.database.Database], List[Any]]
+    process: Callable[[List[Any]], None]
+    count_bytes: Callable[[pymongo.database.Database, List[Any]], int]
+    # False for add_url, which has no status of its own.
+    has_status: bool = True
+
+
+def add_urls(mongodb_url: str, records: List[Dict[str, Any]]) -> None:
+    bulk_upsert_urls(get_database(mongodb_url), records)
+
+
+def count_object_bytes(mongodb: pymongo.database.Database, object_ids: List[str]) -> int:
+    records = mongodb[COLLECTION_OBJECT].find({"_id": {"$in": object_ids}}, {"size": True})
+    return sum(record.get("size", 0) for record in records)
+
+
+def make_stages(mongodb_url: str, blob_cache: Any, classifier_base_url: str, url_sizes: Dict[str, int]) -> List[Stage]:
+    def count_url_bytes(mongodb: pymongo.database.Database, records: List[Dict[str, Any]]) -> int:
+        return sum(url_sizes[record["url"]] for record in records)
+
+    return [
+        Stage(
+            STAGE_ADD_URL,
+            COLLECTION_URL,
+            lambda mongodb: [{"url": url} for url in url_sizes.keys()],
+            functools.partial(add_urls, mongodb_url),
+            count_url_bytes,
+            has_status=False,
+        ),
+        Stage(
+            STAGE_OBJECT_META,
+            COLLECTION_URL,
+            lambda mongodb: list(resolve_object_meta.find_unresolved_urls(mongodb)),
+            functools.partial(resolve_object_meta.resolve, mongodb_url, blob_cache),
+            count_url_bytes,
+        ),
+        Stage(
+            STAGE_SHA1,
+            COLLECTION_OBJECT,
+            resolve_sha1.find_sha1_unresolved_object_ids,
+            functools.partial(resolve_sha1.resolve_objects, mongodb_url, blob_cache),
+            count_object_bytes,
+        ),
+        Stage(
+            STAGE_MEDIA_META,
+            COLLECTION_OBJECT,
+            resolve_media_meta.find_unresolved_object_ids,
+            functools.partial(resolve_media_meta.resolve_objects, mongodb_url, blob_cache),
+            count_object_bytes,
+        ),
+        Stage(
+            STAGE_PHASH,
+            COLLECTION_OBJECT,
+            resolve_phash.find_phash_unresolved_object_ids,
+            functools.partial(resolve_phash.resolve_objects, mongodb_url, blob_cache),
+            count_object_bytes,
+        ),
+        Stage(
+            STAGE_NSFW_GANTMAN,
+            COLLECTION_OBJECT,
+            predict_nsfw_gantman.find_unpredicted_object_ids,
+            functools.partial(
+                predict_nsfw_gantman.predict_objects,
+                mongodb_url,
+                f"{classifier_base_url}/{STAGE_NSFW_GANTMAN}",
+                blob_cache,
+                reuse_spec=make_reuse_spec(
+                    predict_nsfw_gantman.CLASSIFIER_NAME, f"{classifier_base_url}/{STAGE_NSFW_GANTMAN}", REUSE_SHA1
+                ),
+            ),
+            count_object_bytes,
+        ),
+        Stage(
+            STAGE_NSFW_OPENNSFW2,
+            COLLECTION_OBJECT,
+            predict_nsfw_opennsfw2.find_unpredicted_object_ids,
+            functools.partial(
+                predict_nsfw_opennsfw2.predict_objects,
+                mongodb_url,
+                f"{classifier_base_url}/{STAGE_NSFW_OPENNSFW2}",
+                blob_cache,
+                reuse_spec=make_reuse_spec(
+                    predict_nsfw_opennsfw2.CLASSIFIER_NAME, f"{classifier_base_url}/{STAGE_NSFW_OPENNSFW2}", REUSE_SHA1
+                ),
+            ),
+            count_object_bytes,
+        ),
+    ]
+
+
+def measure(process: Callable[[List[Any]], None], items: List[Any]) -> Tuple[float, bool]:
+    started_at = time.perf_counter()
+    try:
+        process(items)
+        success = True
+    except Exception:
+        # Not every stage isolates failures per object; a failed chunk still counts towards the latency.
+        logging.exception(f"failed to process {len(items)} items")
+        success = False
+    return time.perf_counter() - started_at, success
+
+
+def run_stage(executor: Any, mongodb: pymongo.database.Database, stage: Stage, chunk_size: int) -> Dict[str, Any]:
+    logging.info(f"stage {stage.name}")
+    found_at = time.perf_counter()
+    items = stage.find_items(mongodb)
+    started_at = time.perf_counter()
+    futures = [executor.submit(measure, stage.process, chunk) for chunk in more_itertools.chunked(items, chunk_size)]
+    latencies, successes = zip(*[future.result() for future in futures]) if futures else ((), ())
+    seconds = max(time.perf_counter() - started_at, 1e-9)
+
+    number_of_bytes = stage.count_bytes(mongodb, items)
+    p50, p99 = np.percentile(latencies, [50, 99]).tolist() if latencies else (None, None)
+    result = {
+        "stage": stage.name,
+        "objects": len(items),
+        "bytes": number_of_bytes,
+        "findSeconds": started_at - found_at,
+        "seconds": seconds,
+        "objectsPerSec": len(items) / seconds,
+        "megabytesPerSec": number_of_bytes / 1000 / 1000 / seconds,
+        # Latency of one chunk, i.e. of one object with --chunk-size 1.
+        "p50Seconds": p50,
+        "p99Seconds": p99,
+        "failedChunks": successes.count(False),
+    }
+    if stage.has_status:
+        collection = mongodb[stage.collection_name]
+        result["pending"] = collection.count_documents(make_pending_condition(stage.name))
+        result["failures"] = collection.count_documents({f"failure.{stage.name}": {"$exists": True}})
+    logging.info(f"result = {json.dumps(result)}")
+    return result
+
+
+def find_previous_result(results_file: pathlib.Path, parameters: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    previous_result = None
+    if results_file.exists():
+        with results_file.open("r") as file:
+            for line in file:
+                if (result := json.loads(line))["parameters"] == parameters:
+                    previous_result = result
+    return previous_result
+
+
+def format_change(value: Optional[float], previous_value: Optional[float]) -> str:
+    if value is None or not previous_value:
+        return ""
+    return f" ({(value / previous_value - 1) * 100:+.1f}%)"
+
+
+def format_seconds(value: Optional[float]) -> str:
+    return "-" if value is None else f"{value:.3f}"
+
+
+def print_report(result: Dict[str, Any], previous_result: Optional[Dict[str, Any]]) -> None:
+    previous_stages = {stage["stage"]: stage for stage in previous_result["stages"]} if previous_result else {}
+    if previous_result:
+        print(f"compared with {previous_result['startedAt']}")
+    for stage in result["stages"]:
+        previous_stage = previous_stages.get(stage["stage"], {})
+        print(
+            f"{stage['stage']:32s}"
+            f" objects = {stage['objects']:6d}"
+            f", objects/sec = {stage['objectsPerSec']:8.2f}"
+            f"{format_change(stage['objectsPerSec'], previous_stage.get('objectsPerSec'))}"
+            f", MB/sec = {stage['megabytesPerSec']:8.2f}"
+            f"{format_change(stage['megabytesPerSec'], previous_stage.get('megabytesPerSec'))}"
+            f", p50 = {format_seconds(stage['p50Seconds'])}"
+            f", p99 = {format_seconds(stage['p99Seconds'])}"
+            f"{format_change(stage['p99Seconds'], previous_stage.get('p99Seconds'))}"
+            f", pending = {stage.get('pending', '-')}"
+            f", failures = {stage.get('failures', '-')}"
+            f", failed chunks = {stage['failedChunks']}"
+        )
+
+
+def run_benchmark(
+    mongodb_url: str,
+    corpus_dir: pathlib.Path,
+    results_file: pathlib.Path,
+    corpus_parameters: Dict[str, Any],
+    origin_latency: float,
+    classifier_latency: float,
+    max_workers: int,
+    chunk_size: int,
+    cache_dir: Optional[pathlib.Path],
+    cache_max_bytes: int,
+    max_connections_per_host: int,
+    initial_connections_per_host: int,
+    latency_tolerance: float,
+) -> None:
+    logging.debug(f"mongodb_url = {json.dumps(mongodb_url)}")
+    logging.debug(f"corpus_dir = {json.dumps(str(corpus_dir))}")
+    logging.debug(f"results_file = {json.dumps(str(results_file))}")
+    logging.debug(f"corpus_parameters = {json.dumps(corpus_parameters)}")
+    logging.debug(f"origin_latency = {json.dumps(origin_latency)}")
+    logging.debug(f"classifier_latency = {json.dumps(classifier_latency)}")
+    logging.debug(f"max_workers = {json.dumps(max_workers)}")
+    logging.debug(f"chunk_size = {json.dumps(chunk_size)}")
+    logging.debug(f"cache_dir = {json.dumps(str(cache_dir))}")
+    logging.debug(f"cache_max_bytes = {json.dumps(cache_max_bytes)}")
+    logging.debug(f"max_connections_per_host = {json.dumps(max_connections_per_host)}")
+    logging.debug(f"initial_connections_per_host = {json.dumps(initial_connections_per_host)}")
+    logging.debug(f"latency_tolerance = {json.dumps(latency_tolerance)}")
+
+    mongodb = get_database(mongodb_url)
+    # Every run starts from an empty database, so make sure that it is not a real one.
+    assert "benchmark" in mongodb.name, f"database name must contain 'benchmark': {mongodb.name}"
+    mongodb.client.drop_database(mongodb.name)
+    make_index(mongodb_url)
+
+    files = generate_corpus(corpus_dir, corpus_parameters)
+    parameters = {
+        **corpus_parameters,
+        "origin_latency": origin_latency,
+        "classifier_latency": classifier_latency,
+        "max_workers": max_workers,
+        "chunk_size": chunk_size,
+        "cache": cache_dir is not None,
+        "max_connections_per_host": max_connections_per_host,
+        "initial_connections_per_host": initial_connections_per_host,
+        "latency_tolerance": latency_tolerance,
+    }
+    result: Dict[str, Any] = {
+        "startedAt": datetime.now().isoformat(),
+        "version": version,
+        "parameters": parameters,
+        "stages": [],
+    }
+
+    with make_origin_server(corpus_dir, origin_latency) as origin, make_classifier_server(
+        classifier_latency
+    ) as classifier:
+        url_sizes = {f"{origin.get_base_url()}/{file['name']}": file["size"] for file in files}
+        stages = make_stages(
+            mongodb_url, make_blob_cache(cache_dir, cache_max_bytes), classifier.get_base_url(), url_sizes
+        )
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=configure_http_client,
+            initargs=(max_connections_per_host, initial_connections_per_host, latency_tolerance),
+        ) as executor:
+            for stage in stages:
+                result["stages"].append(run_stage(executor, mongodb, stage, chunk_size))
+
+    previous_result = find_previous_result(results_file, parameters)
+    with results_file.open("a") as file:
+        file.write(json.dumps(result) + "\n")
+    print_report(result, previous_result)
+
+
+@click.command()
+@option_log_level
+@click.option(
+    "--mongodb-url",
+    type=str,
+    default=os.environ.get("OCAZ_BENCHMARK_MONGODB_URL", "mongodb://localhost:27017/ocaz-benchmark"),
+    show_default=True,
+    required=True,
+    help="dropped on every run; the database name must contain 'benchmark'",
+)
+@option_cache_dir
+@option_cache_max_bytes
+@option_max_connections_per_host
+@option_initial_connections_per_host
+@option_latency_tolerance
+@click.option(
+    "--corpus-dir",
+    type=click.Path(file_okay=False, path_type=pathlib.Path),
+    default="benchmark/corpus",
+    show_default=True,
+    required=True,
+    help="reused while the corpus parameters are unchanged",
+)
+@click.option(
+    "--results-file",
+    type=click.Path(dir_okay=False, path_type=pathlib.Path),
+    default="benchmark/results.jsonl",
+    show_default=True,
+    required=True,
+    help="every run is appended and compared with the last run of the same parameters",
+)
+@click.option("--number-of-objects", type=int, default=200, show_default=True, required=True)
+@click.option("--number-of-large-objects", type=int, default=2, show_default=True, required=True)
+@click.option("--image-size", type=int, default=640, show_default=True, required=True)
+@click.option("--video-frames", type=int, default=60, show_default=True, required=True)
+@click.option("--seed", type=int, default=0, show_default=True, required=True)
+@click.option("--origin-latency", type=float, default=0.0, show_default=True, required=True)
+@click.option("--classifier-latency", type=float, default=0.05, show_default=True, required=True)
+@click.option("--max-workers", type=int, default=4, show_default=True, required=True)
+@click.option("--chunk-size", type=int, default=1, show_default=True, required=True)
+def main(
+    log_level: str,
+    mongodb_url: str,
+    cache_dir: Optional[pathlib.Path],
+    cache_max_bytes: int,
+    max_connections_per_host: int,
+    initial_connections_per_host: int,
+    latency_tolerance: float,
+    corpus_dir: pathlib.Path,
+    results_file: pathlib.Path,
+    number_of_objects: int,
+    number_of_large_objects: int,
+    image_size: int,
+    video_frames: int,
+    seed: int,
+    origin_latency: float,
+    classifier_latency: float,
+    max_workers: int,
+    chunk_size: int,
+) -> None:
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)s pid:%(process)d %(message)s",
+        level=getattr(logging, log_level.upper(), logging.INFO),
+    )
+    logging.debug(f"log_level = {json.dumps(log_level)}")
+
+    results_file.parent.mkdir(parents=True, exist_ok=True)
+    run_benchmark(
+        mongodb_url=mongodb_url,
+        corpus_dir=corpus_dir,
+        results_file=results_file,
+        corpus_parameters={
+            "number_of_objects": number_of_objects,
+            "number_of_large_objects": number_of_large_objects,
+            "image_size": image_size,
+            "video_frames": video_frames,
+            "seed": seed,
+        },
+        origin_latency=origin_latency,
+        classifier_latency=classifier_latency,
+        max_workers=max_workers,
+        chunk_size=chunk_size,
+        cache_dir=cache_dir,
+        cache_max_bytes=cache_max_bytes,
+        max_connections_per_host=max_connections_per_host,
+        initial_connections_per_host=initial_connections_per_host,
+        latency_tolerance=latency_tolerance,
+    )
+
+    logging.info("done")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,157 @@
+import logging
+import os
+import pathlib
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import BinaryIO, Dict, Optional
+
+from .segmented_download import iter_segmented_content
+
+# A blob used within this many seconds is not evicted, so that a path just returned to another process stays valid.
+EVICTION_GRACE_PERIOD = 60.0
+
+
+def make_nested_id_name(id: str, ext: str = "") -> str:
+    return f"{id[0:2]}/{id[2:4]}/{id}{ext}"
+
+
+@dataclass
+class EvictionState:
+    pid: int
+    written_bytes: int = 0
+    scanned: bool = False
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+
+# The BlobCache itself is pickled into every submitted chunk, so what it has written is tracked per process here.
+eviction_states: Dict[pathlib.Path, EvictionState] = {}
+eviction_states_lock = threading.Lock()
+
+
+def get_eviction_state(blob_dir: pathlib.Path) -> EvictionState:
+    with eviction_states_lock:
+        state = eviction_states.get(blob_dir)
+        if state is None or state.pid != os.getpid():
+            state = eviction_states[blob_dir] = EvictionState(pid=os.getpid())
+        return state
+
+
+class BlobCache:
+    def __init__(self, cache_dir: pathlib.Path, max_bytes: int, scan_ratio: float = 0.05) -> None:
+        self.blob_dir = cache_dir / "blob"
+        self.max_bytes = max_bytes
+        self.scan_ratio = scan_ratio
+
+    def make_path(self, key: str) -> pathlib.Path:
+        return self.blob_dir / make_nested_id_name(key)
+
+    def get(self, key: str) -> Optional[pathlib.Path]:
+        path = self.make_path(key)
+        try:
+            # mtime doubles as the LRU clock.
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        logging.debug(f"cache hit {key}")
+        return path
+
+    def make_temp_path(self) -> pathlib.Path:
+        self.blob_dir.mkdir(parents=True, exist_ok=True)
+        return self.blob_dir / f"~{os.getpid()}.{threading.get_ident()}.{time.monotonic_ns()}"
+
+    def publish(self, key: str, temp_path: pathlib.Path) -> Optional[pathlib.Path]:
+        # None when the object does not fit in the cache at all; temp_path is then left to the caller.
+        size = temp_path.stat().st_size
+        if size > self.max_bytes:
+            logging.info(f"not caching {key}, size = {size}")
+            return None
+        path = self.make_path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path.replace(path)
+
+        state = get_eviction_state(self.blob_dir)
+        with state.lock:
+            state.written_bytes += size
+            if not state.scanned or state.written_bytes >= self.max_bytes * self.scan_ratio:
+                state.scanned = True
+                state.written_bytes = 0
+                self.evict()
+        return path
+
+    def open_cached(self, key: str) -> Optional[BinaryIO]:
+        # An open file stays readable even when another process evicts the blob afterwards.
+        if path := self.get(key):
+            try:
+                return path.open("rb")
+            except FileNotFoundError:
+                logging.debug(f"cache evicted {key}")
+        return None
+
+    def open(self, key: str, url: str) -> BinaryIO:
+        if cached_file := self.open_cached(key):
+            return cached_file
+        logging.info(f"get {url}")
+        temp_path = self.make_temp_path()
+        try:
+            with temp_path.open("wb") as temp_file:
+                for chunk in iter_segmented_content(url):
+                    temp_file.write(chunk)
+            file = temp_path.open("rb")
+            self.publish(key, temp_path)
+            return file
+        finally:
+            temp_path.unlink(missing_ok=True)
+
+    def read_bytes(self, key: str, url: str) -> bytes:
+        with self.open(key, url) as file:
+            return file.read()
+
+    def fetch(self, key: str, url: str) -> Optional[pathlib.Path]:
+        # A path for readers that cannot take a file, such as cv2; None when the object is too large to cache.
+        if path := self.get(key):
+            return path
+        self.open(key, url).close()
+        return self.get(key)
+
+    def evict(self) -> None:
+        protected_after = time.time() - EVICTION_GRACE_PERIOD
+        blobs = []
+        total_bytes = 0
+        for path in self.blob_dir.glob("*/*/*"):
+            if path.name.startswith("~"):
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            blobs.append((stat.st_mtime, stat.st_size, path))
+            total_bytes += stat.st_size
+
+        if total_bytes <= self.max_bytes:
+            return
+        started_at = time.monotonic()
+        for mtime, size, path in sorted(blobs):
+            if total_bytes <= self.max_bytes or mtime > protected_after:
+                break
+            try:
+                # Another process may have used the blob since the scan.
+                if path.stat().st_mtime > protected_after:
+                    continue
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total_bytes -= size
+        logging.info(f"cache evicted in {time.monotonic() - started_at:.3f} sec, total_bytes = {total_bytes}")
+
+
+def open_source(blob_cache: Optional[BlobCache], key: str, url: str) -> str:
+    # A local path when the cache is enabled, otherwise the origin URL itself (both work for cv2.VideoCapture).
+    if blob_cache and (path := blob_cache.fetch(key, url)):
+        return str(path)
+    else:
+        return url
+
+
+def make_blob_cache(cache_dir: Optional[pathlib.Path], cache_max_bytes: int) -> Optional[BlobCache]:
+    return BlobCache(cache_dir, max_bytes=cache_max_bytes) if cache_dir else None
@@ -0,0 +1,216 @@
+import json
+import logging
+import time
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+import click
+import more_itertools
+import numpy as np
+import pymongo
+
+from .command import option_log_level, option_mongodb_url
+from .db import COLLECTION_OBJECT, get_database
+from .hamming import HASH_BITS, HASH_CONDITION, HASH_PROJECTION, count_bits, get_hash, to_unsigned
+
+TARGET_FIELD = "duplicateGroup"
+
+
+def load_hashes(mongodb: pymongo.database.Database) -> Tuple[List[str], np.ndarray, List[Optional[str]]]:
+    ids = []
+    hashes = []
+    groups = []
+    # Sorted by _id, so that the smallest index of a group is also its smallest id.
+    records = (
+        mongodb[COLLECTION_OBJECT]
+        .find(HASH_CONDITION, {**HASH_PROJECTION, TARGET_FIELD: True}, batch_size=10000)
+        .sort("_id", pymongo.ASCENDING)
+    )
+    for record in records:
+        if (hash := get_hash(record)) is not None:
+            ids.append(record["_id"])
+            hashes.append(hash)
+            groups.append(record.get(TARGET_FIELD))
+    return ids, to_unsigned(hashes), groups
+
+
+def make_band_key(hashes: np.ndarray, bit_positions: np.ndarray) -> np.ndarray:
+    key = np.zeros(len(hashes), dtype=np.uint64)
+    for index, bit_position in enumerate(bit_positions):
+        key |= ((hashes >> np.uint64(bit_position)) & np.uint64(1)) << np.uint64(index)
+    return key
+
+
+def find_similar_pairs(
+    hashes: np.ndarray, key: np.ndarray, max_distance: int, max_bucket_size: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    order = np.argsort(key, kind="stable")
+    sorted_key = key[order]
+    sources = []
+    targets = []
+    # A bucket is a run of equal keys; pairs j apart in a run are compared in the j-th pass, which only
+    # visits the positions whose run is longer than j. The cost follows the number of pairs, not of hashes.
+    active = np.arange(len(order) - 1)
+    for gap in range(1, max_bucket_size):
+        active = active[active + gap < len(order)]
+        active = active[sorted_key[active + gap] == sorted_key[active]]
+        if len(active) == 0:
+            break
+        left, right = order[active], order[active + gap]
+        matched = count_bits(hashes[left] ^ hashes[right]) <= max_distance
+        sources.append(left[matched])
+        targets.append(right[matched])
+    else:
+        logging.warning(f"buckets larger than {max_bucket_size} are only partially compared")
+    if len(sources) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    return np.concatenate(sources), np.concatenate(targets)
+
+
+def union(labels: np.ndarray, sources: np.ndarray, targets: np.ndarray) -> np.ndarray:
+    # Union-find over whole arrays: every label points at a member with a smaller or equal index of the same
+    # group, so a root is its own label. Each round links the roots of every pair to the smaller one and
+    # then compresses the paths, until both ends of every pair share a root.
+    while True:
+        source_roots, target_roots = labels[sources], labels[targets]
+        if np.array_equal(source_roots, target_roots):
+            return labels
+        roots = np.minimum(source_roots, target_roots)
+        np.minimum.at(labels, source_roots, roots)
+        np.minimum.at(labels, target_roots, roots)
+        while not np.array_equal(compressed_labels := labels[labels], labels):
+            labels = compressed_labels
+
+
+def cluster_hashes(
+    hashes: np.ndarray, max_distance: int, band_bits: int, number_of_bands: int, max_bucket_size: int, seed: int
+) -> np.ndarray:
+    assert 0 < band_bits <= HASH_BITS, f"band_bits must be within 1 to {HASH_BITS}"
+    # Copies with the very same hash are grouped up front, so they do not turn into huge buckets.
+    unique_hashes, inverse = np.unique(hashes, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    logging.info(f"hashes = {len(hashes)}, unique hashes = {len(unique_hashes)}")
+
+    # LSH by bit sampling: bands of random bit permutations. A pair within max_distance lands in the same
+    # bucket of a band with probability (1 - max_distance / 64) ** band_bits.
+    rng = np.random.default_rng(seed)
+    labels = np.arange(len(unique_hashes))
+    bands_per_permutation = HASH_BITS // band_bits
+    for band_index in range(number_of_bands):
+        if band_index % bands_per_permutation == 0:
+            permutation = rng.permutation(HASH_BITS)
+        offset = band_index % bands_per_permutation * band_bits
+        started_at = time.monotonic()
+        key = make_band_key(unique_hashes, permutation[offset : offset + band_bits])
+        sources, targets = find_similar_pairs(unique_hashes, key, max_distance, max_bucket_size)
+        labels = union(labels, sources, targets)
+        logging.info(
+            f"band {band_index + 1}/{number_of_bands}: pairs = {len(sources)}"
+            f", elapsed = {time.monotonic() - started_at:.1f} sec"
+        )
+
+    # The smallest object index of every group represents it.
+    object_labels = labels[inverse]
+    representatives = np.full(len(unique_hashes), len(hashes))
+    np.minimum.at(representatives, object_labels, np.arange(len(hashes)))
+    group_sizes = np.bincount(object_labels, minlength=len(unique_hashes))
+    return np.where(group_sizes[object_labels] > 1, representatives[object_labels], -1)
+
+
+def make_group_operations(
+    ids: List[str], group_indexes: np.ndarray, current_groups: List[Optional[str]]
+) -> List[pymongo.UpdateOne]:
+    operations = []
+    for id, group_index, current_group in zip(ids, group_indexes.tolist(), current_groups):
+        group = ids[group_index] if group_index >= 0 else None
+        if group == current_group:
+            continue
+        elif group is None:
+            operations.append(
+                pymongo.UpdateOne(
+                    {"_id": id}, {"$set": {"updatedAt": datetime.now().timestamp()}, "$unset": {TARGET_FIELD: ""}}
+                )
+            )
+        else:
+            operations.append(
+                pymongo.UpdateOne({"_id": id}, {"$set": {"updatedAt": datetime.now().timestamp(), TARGET_FIELD: group}})
+            )
+    return operations
+
+
+def cluster_duplicates(
+    mongodb_url: str,
+    max_distance: int,
+    band_bits: int,
+    number_of_bands: int,
+    max_bucket_size: int,
+    seed: int,
+    chunk_size: int,
+    dry_run: bool,
+) -> None:
+    logging.debug(f"mongodb_url = {json.dumps(mongodb_url)}")
+    logging.debug(f"max_distance = {json.dumps(max_distance)}")
+    logging.debug(f"band_bits = {json.dumps(band_bits)}")
+    logging.debug(f"number_of_bands = {json.dumps(number_of_bands)}")
+    logging.debug(f"max_bucket_size = {json.dumps(max_bucket_size)}")
+    logging.debug(f"seed = {json.dumps(seed)}")
+    logging.debug(f"chunk_size = {json.dumps(chunk_size)}")
+    logging.debug(f"dry_run = {json.dumps(dry_run)}")
+
+    mongodb = get_database(mongodb_url)
+    ids, hashes, current_groups = load_hashes(mongodb)
+    group_indexes = cluster_hashes(hashes, max_distance, band_bits, number_of_bands, max_bucket_size, seed)
+    grouped_indexes = group_indexes[group_indexes >= 0]
+    logging.info(f"objects in groups = {len(grouped_indexes)}, groups = {len(np.unique(grouped_indexes))}")
+
+    operations = make_group_operations(ids, group_indexes, current_groups)
+    logging.info(f"operations.length = {len(operations)}")
+    if dry_run:
+        return
+    for chunked_operations in more_itertools.chunked(operations, chunk_size):
+        mongodb[COLLECTION_OBJECT].bulk_write(chunked_operations, ordered=False)
+
+
+@click.command()
+@option_log_level
+@option_mongodb_url
+@click.option("--max-distance", type=int, default=6, show_default=True, required=True)
+@click.option("--band-bits", type=int, default=24, show_default=True, required=True)
+@click.option("--number-of-bands", type=int, default=32, show_default=True, required=True)
+@click.option("--max-bucket-size", type=int, default=1000, show_default=True, required=True)
+@click.option("--seed", type=int, default=0, show_default=True, required=True)
+@click.option("--chunk-size", type=int, default=1000, show_default=True, required=True)
+@click.option("--dry-run", type=bool, default=False, is_flag=True, help="only log what would be written")
+def main(
+    log_level: str,
+    mongodb_url: str,
+    max_distance: int,
+    band_bits: int,
+    number_of_bands: int,
+    max_bucket_size: int,
+    seed: int,
+    chunk_size: int,
+    dry_run: bool,
+) -> None:
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)s pid:%(process)d %(message)s",
+        level=getattr(logging, log_level.upper(), logging.INFO),
+    )
+    logging.debug(f"log_level = {json.dumps(log_level)}")
+
+    cluster_duplicates(
+        mongodb_url=mongodb_url,
+        max_distance=max_distance,
+        band_bits=band_bits,
+        number_of_bands=number_of_bands,
+        max_bucket_size=max_bucket_size,
+        seed=seed,
+        chunk_size=chunk_size,
+        dry_run=dry_run,
+    )
+
+    logging.info("done")
+
+
+if __name__ == "__main__":
+    main()
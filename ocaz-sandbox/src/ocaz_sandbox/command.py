@@ -1,11 +1,12 @@
 import functools
 import os
+import pathlib
 from typing import Any, Callable
 
 import click
 
 
-def option_log_level(f: Callable) -> Callable:
+def option_log_level(f: Callable[..., Any]) -> Callable[..., Any]:
     @click.option(
         "-l",
         "--log-level",
@@ -22,7 +23,7 @@ def option_log_level(f: Callable) -> Callable:
     return wrapped
 
 
-def option_mongodb_url(f: Callable) -> Callable:
+def option_mongodb_url(f: Callable[..., Any]) -> Callable[..., Any]:
     @click.option(
         "--mongodb-url",
         type=str,
@@ -35,3 +36,126 @@ def option_mongodb_url(f: Callable) -> Callable:
         return f(*args, **kwargs)
 
     return wrapped
+
+
+def option_cache_dir(f: Callable[..., Any]) -> Callable[..., Any]:
+    @click.option(
+        "--cache-dir",
+        type=click.Path(file_okay=False, path_type=pathlib.Path),
+        default=os.environ.get("OCAZ_CACHE_DIR", None),
+        show_default=True,
+        help="shared blob cache directory; downloads are not cached when omitted",
+    )
+    @functools.wraps(f)
+    def wrapped(*args: Any, **kwargs: Any) -> Any:
+        return f(*args, **kwargs)
+
+    return wrapped
+
+
+def option_cache_max_bytes(f: Callable[..., Any]) -> Callable[..., Any]:
+    @click.option(
+        "--cache-max-bytes",
+        type=int,
+        default=int(os.environ.get("OCAZ_CACHE_MAX_BYTES", 10 * 1000 * 1000 * 1000)),
+        show_default=True,
+        required=True,
+    )
+    @functools.wraps(f)
+    def wrapped(*args: Any, **kwargs: Any) -> Any:
+        return f(*args, **kwargs)
+
+    return wrapped
+
+
+def option_follow(f: Callable[..., Any]) -> Callable[..., Any]:
+    @click.option(
+        "--follow",
+        type=bool,
+        default=False,
+        is_flag=True,
+        help="keep running and process new or updated records as they appear",
+    )
+    @functools.wraps(f)
+    def wrapped(*args: Any, **kwargs: Any) -> Any:
+        return f(*args, **kwargs)
+
+    return wrapped
+
+
+def option_lease_duration(f: Callable[..., Any]) -> Callable[..., Any]:
+    @click.option(
+        "--lease-duration",
+        type=float,
+        default=None,
+        show_default=True,
+        help="claim records with a lease of this many seconds so that several nodes can share the work",
+    )
+    @functools.wraps(f)
+    def wrapped(*args: Any, **kwargs: Any) -> Any:
+        return f(*args, **kwargs)
+
+    return wrapped
+
+
+def option_max_connections_per_host(f: Callable[..., Any]) -> Callable[..., Any]:
+    @click.option(
+        "--max-connections-per-host",
+        type=int,
+        default=int(os.environ.get("OCAZ_MAX_CONNECTIONS_PER_HOST", 16)),
+        show_default=True,
+        required=True,
+        help="maximum number of concurrent requests to a host from all workers on this node",
+    )
+    @functools.wraps(f)
+    def wrapped(*args: Any, **kwargs: Any) -> Any:
+        return f(*args, **kwargs)
+
+    return wrapped
+
+
+def option_initial_connections_per_host(f: Callable[..., Any]) -> Callable[..., Any]:
+    @click.option(
+        "--initial-connections-per-host",
+        type=int,
+        default=int(os.environ.get("OCAZ_INITIAL_CONNECTIONS_PER_HOST", 4)),
+        show_default=True,
+        required=True,
+        help="concurrent requests to a host to start with; adapted up to --max-connections-per-host",
+    )
+    @functools.wraps(f)
+    def wrapped(*args: Any, **kwargs: Any) -> Any:
+        return f(*args, **kwargs)
+
+    return wrapped
+
+
+def option_latency_tolerance(f: Callable[..., Any]) -> Callable[..., Any]:
+    @click.option(
+        "--latency-tolerance",
+        type=float,
+        default=float(os.environ.get("OCAZ_LATENCY_TOLERANCE", 2.0)),
+        show_default=True,
+        required=True,
+        help="back off while the median latency to a host exceeds its lowest one by this factor",
+    )
+    @functools.wraps(f)
+    def wrapped(*args: Any, **kwargs: Any) -> Any:
+        return f(*args, **kwargs)
+
+    return wrapped
+
+
+def option_scan_ranges(f: Callable[..., Any]) -> Callable[..., Any]:
+    @click.option(
+        "--scan-ranges",
+        type=int,
+        default=None,
+        show_default=True,
+        help="split the _id keyspace into this many ranges and stream each range in its own worker",
+    )
+    @functools.wraps(f)
+    def wrapped(*args: Any, **kwargs: Any) -> Any:
+        return f(*args, **kwargs)
+
+    return wrapped
@@ -0,0 +1,43 @@
+import pathlib
+import sqlite3
+import time
+from typing import List, Optional, Set, Tuple
+
+
+class CrawlCheckpoint:
+    def __init__(self, path: pathlib.Path, resume: bool, flush_interval: float = 10.0) -> None:
+        self.connection = sqlite3.connect(str(path))
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS frontier (url TEXT PRIMARY KEY, mtime REAL, done INTEGER NOT NULL DEFAULT 0)"
+        )
+        if not resume:
+            self.connection.execute("DELETE FROM frontier")
+        self.connection.commit()
+        self.flush_interval = flush_interval
+        self.flushed_at = time.monotonic()
+
+    def load_visited(self) -> Set[str]:
+        return {url for (url,) in self.connection.execute("SELECT url FROM frontier")}
+
+    def load_pending(self) -> List[Tuple[str, Optional[float]]]:
+        return self.connection.execute("SELECT url, mtime FROM frontier WHERE done = 0").fetchall()
+
+    def add(self, url: str, mtime: Optional[float]) -> None:
+        self.connection.execute("INSERT OR IGNORE INTO frontier (url, mtime) VALUES (?, ?)", (url, mtime))
+
+    def done(self, url: str) -> None:
+        self.connection.execute("UPDATE frontier SET done = 1 WHERE url = ?", (url,))
+
+    def flush_if_due(self) -> bool:
+        if time.monotonic() - self.flushed_at < self.flush_interval:
+            return False
+        self.flush()
+        return True
+
+    def flush(self) -> None:
+        self.connection.commit()
+        self.flushed_at = time.monotonic()
+
+    def close(self) -> None:
+        self.flush()
+        self.connection.close()
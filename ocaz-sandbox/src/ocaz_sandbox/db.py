@@ -1,4 +1,11 @@
+import logging
+import time
+from typing import Any, List, Optional, Set, Tuple
+
 import pymongo
+import pymongo.errors
+
+from .adaptive import AimdLimiter
 
 COLLECTION_URL = "url"
 COLLECTION_OBJECT = "object"
@@ -6,3 +13,65 @@ COLLECTION_OBJECT = "object"
 
 def get_database(mongodb_url: str) -> pymongo.database.Database:
     return pymongo.MongoClient(mongodb_url).get_database()
+
+
+class BulkWriter:
+    def __init__(
+        self,
+        collection: pymongo.collection.Collection,
+        max_operations: int = 100,
+        max_interval: float = 5.0,
+        max_flush_latency: float = 1.0,
+    ):
+        self.collection = collection
+        self.max_interval = max_interval
+        # max_operations is where the batch size starts; it grows while flushes stay fast and halves when they do not.
+        self.batch_limiter = AimdLimiter(
+            f"mongodb {collection.name} batch",
+            initial_limit=max_operations,
+            min_limit=max(1, max_operations // 10),
+            max_limit=max_operations * 10,
+            max_latency=max_flush_latency,
+            increase=max(1, max_operations // 10),
+            window_size=4,
+        )
+        self.operations: List[Tuple[Any, Optional[str]]] = []
+        self.flushed_at = time.monotonic()
+
+    def add(self, operation: Any, key: Optional[str] = None) -> None:
+        self.operations.append((operation, key))
+
+    def is_due(self) -> bool:
+        return len(self.operations) >= self.batch_limiter.get_limit() or (
+            len(self.operations) > 0 and time.monotonic() - self.flushed_at >= self.max_interval
+        )
+
+    def discard(self, keys: Set[str]) -> None:
+        self.operations = [(operation, key) for operation, key in self.operations if key not in keys]
+
+    def flush(self) -> Set[str]:
+        operations, self.operations = self.operations, []
+        self.flushed_at = time.monotonic()
+        if len(operations) == 0:
+            return set()
+
+        started_at = time.monotonic()
+        try:
+            self.collection.bulk_write([operation for operation, _ in operations], ordered=False)
+            self.batch_limiter.record(time.monotonic() - started_at)
+            return set()
+        except pymongo.errors.BulkWriteError as error:
+            # Rejected documents say nothing about the load on the server.
+            self.batch_limiter.record(time.monotonic() - started_at)
+            failed_keys = set()
+            for write_error in error.details["writeErrors"]:
+                _, key = operations[write_error["index"]]
+                logging.error(f"failed to write {self.collection.name} {key}: {write_error['errmsg']}")
+                if key is not None:
+                    failed_keys.add(key)
+            return failed_keys
+        except pymongo.errors.PyMongoError:
+            # Nothing is known to have been written, so the operations are kept for the next flush.
+            self.batch_limiter.record(time.monotonic() - started_at, success=False)
+            self.operations = operations + self.operations
+            raise
@@ -0,0 +1,54 @@
+import logging
+from datetime import datetime
+from typing import Any, Dict, List
+
+import pymongo
+
+RETRY_BACKOFF_BASE = 60.0
+RETRY_BACKOFF_MAX = 24 * 60 * 60.0
+
+
+def make_retryable_condition(stage: str) -> Dict[str, Any]:
+    # "$$NOW" is evaluated by the server on every query, so the condition can be shared by long-lived
+    # watchers and leases. Records without a failure have no retryAt and always match.
+    return {
+        "$expr": {
+            "$lte": [
+                {"$ifNull": [f"$failure.{stage}.retryAt", 0]},
+                {"$divide": [{"$toLong": "$$NOW"}, 1000]},
+            ]
+        }
+    }
+
+
+def find_attempts(
+    collection: pymongo.collection.Collection[Dict[str, Any]], stage: str, ids: List[Any]
+) -> Dict[Any, int]:
+    records = collection.find({"_id": {"$in": ids}}, {f"failure.{stage}.attempts": True})
+    return {record["_id"]: record.get("failure", {}).get(stage, {}).get("attempts", 0) for record in records}
+
+
+def get_retry_backoff(attempts: int) -> float:
+    retry_backoff: float = RETRY_BACKOFF_BASE * 2 ** (attempts - 1)
+    return min(RETRY_BACKOFF_MAX, retry_backoff)
+
+
+def make_failure_operation(stage: str, id: Any, error: Exception, attempts: int) -> pymongo.UpdateOne:
+    retry_backoff = get_retry_backoff(attempts)
+    logging.warning(f"{stage} of {id} failed {attempts} times; retry after {retry_backoff} sec")
+    return pymongo.UpdateOne(
+        {"_id": id},
+        {
+            "$set": {
+                f"failure.{stage}": {
+                    "detail": repr(error),
+                    "attempts": attempts,
+                    "retryAt": datetime.now().timestamp() + retry_backoff,
+                }
+            }
+        },
+    )
+
+
+def make_success_operation(stage: str, id: Any, new_record: Dict[str, Any]) -> pymongo.UpdateOne:
+    return pymongo.UpdateOne({"_id": id}, {"$set": new_record, "$unset": {f"failure.{stage}": ""}})
@@ -0,0 +1,163 @@
+import concurrent.futures
+import itertools
+import logging
+import time
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set
+
+import pymongo
+import pymongo.errors
+
+from .failure import make_retryable_condition
+
+# The "$changeStream stage is only supported on replica sets" error of a standalone server.
+CHANGE_STREAM_NOT_SUPPORTED_CODES = [40573]
+
+
+class Watcher:
+    def __init__(
+        self,
+        collection: pymongo.collection.Collection[Dict[str, Any]],
+        condition: Dict[str, Any],
+        projection: Dict[str, Any],
+        poll_interval: float = 5.0,
+        max_batch_size: int = 1000,
+        retry_stage: Optional[str] = None,
+        retry_interval: float = 60.0,
+    ) -> None:
+        self.collection = collection
+        self.condition = condition
+        self.projection = {**projection, "_id": True, "updatedAt": True}
+        self.poll_interval = poll_interval
+        self.max_batch_size = max_batch_size
+        self.retry_stage = retry_stage
+        self.retry_interval = retry_interval
+        # Opened before the backlog scan, so documents written during the scan are not missed.
+        self.since = datetime.now().timestamp()
+        # The _id of the last polled record at self.since, for the records that share its updatedAt.
+        self.since_id: Optional[Any] = None
+        self.change_stream = self.open_change_stream()
+
+    def open_change_stream(self) -> Optional[Any]:
+        try:
+            change_stream = self.collection.watch(
+                [{"$match": {"operationType": {"$in": ["insert", "update", "replace"]}}}],
+                max_await_time_ms=int(self.poll_interval * 1000),
+            )
+            logging.info(f"watch {self.collection.name} with a change stream")
+            return change_stream
+        except pymongo.errors.OperationFailure as error:
+            if error.code not in CHANGE_STREAM_NOT_SUPPORTED_CODES:
+                raise
+            logging.info(f"watch {self.collection.name} by polling updatedAt every {self.poll_interval} sec")
+            return None
+
+    def find_matched(self, ids: List[Any]) -> List[Dict[str, Any]]:
+        return list(self.collection.find({**self.condition, "_id": {"$in": ids}}, self.projection))
+
+    def iter_changes(self) -> Iterator[List[Dict[str, Any]]]:
+        while self.change_stream:
+            # Should the stream die, what has been written since this batch started is caught up by polling.
+            watched_at = datetime.now().timestamp()
+            ids: List[Any] = []
+            try:
+                while len(ids) < self.max_batch_size and (change := self.change_stream.try_next()):
+                    ids.append(change["documentKey"]["_id"])
+                alive = self.change_stream.alive
+            except pymongo.errors.PyMongoError as error:
+                # e.g. the resume token has fallen off the oplog.
+                logging.warning(f"change stream of {self.collection.name} died: {error!r}")
+                alive = False
+            yield self.find_matched(ids) if ids else []
+            if not alive:
+                self.change_stream.close()
+                self.since, self.since_id = watched_at, None
+                self.change_stream = self.open_change_stream()
+                yield from self.iter_polls(catch_up=True)
+
+    def poll(self) -> List[Dict[str, Any]]:
+        # The records sharing the updatedAt of the last one are told apart by _id, so a batch limit cannot skip them.
+        if self.since_id is None:
+            boundary_condition: Dict[str, Any] = {"updatedAt": {"$gte": self.since}}
+        else:
+            boundary_condition = {
+                "$or": [
+                    {"updatedAt": {"$gt": self.since}},
+                    {"updatedAt": self.since, "_id": {"$gt": self.since_id}},
+                ]
+            }
+        records = list(
+            self.collection.find({"$and": [self.condition, boundary_condition]}, self.projection)
+            .sort([("updatedAt", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)])
+            .limit(self.max_batch_size)
+        )
+        if records and "updatedAt" in records[-1]:
+            self.since, self.since_id = records[-1]["updatedAt"], records[-1]["_id"]
+        return records
+
+    def iter_polls(self, catch_up: bool = False) -> Iterator[List[Dict[str, Any]]]:
+        # With catch_up, only until the records written so far have been read.
+        while True:
+            polled_at = time.monotonic()
+            records = self.poll()
+            yield records
+            if len(records) < self.max_batch_size:
+                if catch_up:
+                    return
+                time.sleep(max(0.0, self.poll_interval - (time.monotonic() - polled_at)))
+
+    def find_retryable(self) -> List[Dict[str, Any]]:
+        assert self.retry_stage
+        condition = {
+            **self.condition,
+            **make_retryable_condition(self.retry_stage),
+            f"failure.{self.retry_stage}": {"$exists": True},
+        }
+        return list(self.collection.find(condition, self.projection).limit(self.max_batch_size))
+
+    def __iter__(self) -> Iterator[List[Dict[str, Any]]]:
+        # An expiring retryAt writes nothing, so failed records are looked up again every retry_interval.
+        retried_at = time.monotonic()
+        for records in itertools.chain(self.iter_changes(), self.iter_polls()):
+            if self.retry_stage and time.monotonic() - retried_at >= self.retry_interval:
+                retried_at = time.monotonic()
+                records = records + self.find_retryable()
+            yield records
+
+
+def dispatch_changes(
+    watcher: Watcher,
+    submit: Callable[[List[Dict[str, Any]]], "concurrent.futures.Future[None]"],
+    chunk_size: int,
+    max_in_flight: int,
+    max_chunk_delay: float = 1.0,
+) -> None:
+    pending: List[Dict[str, Any]] = []
+    pending_since = time.monotonic()
+    in_flight_ids: Set[Any] = set()
+    futures: Dict[concurrent.futures.Future[None], List[Any]] = {}
+
+    def reap(return_when: str) -> None:
+        done, _ = concurrent.futures.wait(list(futures.keys()), timeout=0, return_when=return_when)
+        for future in done:
+            for id in futures.pop(future):
+                in_flight_ids.discard(id)
+            if exception := future.exception():
+                logging.error(f"failed to process a chunk: {exception!r}")
+
+    for records in watcher:
+        for record in records:
+            if record["_id"] not in in_flight_ids:
+                if len(pending) == 0:
+                    pending_since = time.monotonic()
+                in_flight_ids.add(record["_id"])
+                pending.append(record)
+
+        reap(concurrent.futures.ALL_COMPLETED)
+        while pending and (len(pending) >= chunk_size or time.monotonic() - pending_since >= max_chunk_delay):
+            while len(futures) >= max_in_flight:
+                concurrent.futures.wait(list(futures.keys()), return_when=concurrent.futures.FIRST_COMPLETED)
+                reap(concurrent.futures.ALL_COMPLETED)
+            chunk, pending = pending[:chunk_size], pending[chunk_size:]
+            logging.info(f"dispatch {len(chunk)} records")
+            futures[submit(chunk)] = [record["_id"] for record in chunk]
@@ -1,12 +1,14 @@
 import os
 import re
-from typing import Any, Optional
+from typing import Any, Dict, Optional
 
 import fastapi
 import pymongo
 from fastapi.responses import RedirectResponse
 
 from .db import COLLECTION_OBJECT, COLLECTION_URL, get_database
+from .hamming import HASH_BITS, MultiIndexHash, start_following_hashes
+from .phash import hash_to_hex, hex_to_hash
 
 
 def not_found() -> fastapi.HTTPException:
@@ -20,6 +22,13 @@ def is_sha1(sha1: str) -> bool:
     return SHA1_PATTERN.match(sha1) is not None
 
 
+PERSEPTUAL_HASH_PATTERN = re.compile(r"^[0-9a-f]{16}$")
+
+
+def is_perseptual_hash(perseptual_hash: str) -> bool:
+    return PERSEPTUAL_HASH_PATTERN.match(perseptual_hash) is not None
+
+
 def get_url_from_url_sha1(mongodb: pymongo.database.Database, url_sha1: str) -> Optional[str]:
     if record := mongodb[COLLECTION_URL].find_one({"_id": url_sha1}, {"url": True}):
         return record["url"]
@@ -45,9 +54,32 @@ OCAZ_MONGODB_URL = os.environ.get("OCAZ_MONGODB_URL", None)
 
 mongodb = get_database(OCAZ_MONGODB_URL)
 
+hash_index = MultiIndexHash()
+
 app = fastapi.FastAPI()
 
 
+@app.on_event("startup")
+def start_hash_index() -> None:
+    start_following_hashes(hash_index, mongodb[COLLECTION_OBJECT])
+
+
+def require_hash_index() -> None:
+    if not hash_index.loaded.is_set():
+        raise fastapi.HTTPException(status_code=503, detail="hash index is loading")
+
+
+def find_similar_objects(hash: int, distance: int, limit: int) -> Dict[str, Any]:
+    return {
+        "perseptualHash": hash_to_hex(hash),
+        "distance": distance,
+        "objects": [
+            {"head10mbSha1": object_id, "distance": object_distance}
+            for object_id, object_distance in hash_index.search(hash, distance, limit)
+        ],
+    }
+
+
 @app.get("/")
 def get_root() -> Any:
     return {}
@@ -79,3 +111,29 @@ def get_object_sha1(object_sha1: str) -> Any:
         return RedirectResponse(url)
     else:
         raise not_found()
+
+
+@app.get("/object/head10mbSha1/{head_10mb_sha1}/similar")
+def get_object_head_10mb_sha1_similar(
+    head_10mb_sha1: str,
+    distance: int = fastapi.Query(default=8, ge=0, le=HASH_BITS),
+    limit: int = fastapi.Query(default=100, ge=1),
+) -> Any:
+    require_hash_index()
+    if is_sha1(head_10mb_sha1) and (hash := hash_index.get(head_10mb_sha1)) is not None:
+        return find_similar_objects(hash, distance, limit)
+    else:
+        raise not_found()
+
+
+@app.get("/perseptualHash/{perseptual_hash}/similar")
+def get_perseptual_hash_similar(
+    perseptual_hash: str,
+    distance: int = fastapi.Query(default=8, ge=0, le=HASH_BITS),
+    limit: int = fastapi.Query(default=100, ge=1),
+) -> Any:
+    require_hash_index()
+    if is_perseptual_hash(perseptual_hash):
+        return find_similar_objects(hex_to_hash(perseptual_hash), distance, limit)
+    else:
+        raise not_found()
@@ -0,0 +1,193 @@
+import itertools
+import logging
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+import pymongo
+
+from .follow import Watcher
+from .phash import hex_to_hash
+
+HASH_BITS = 64
+NUMBER_OF_SUBSTRINGS = 4
+SUBSTRING_BITS = HASH_BITS // NUMBER_OF_SUBSTRINGS
+SUBSTRING_MASK = np.uint64(2**SUBSTRING_BITS - 1)
+# Beyond this substring radius (distance 16 and above) the probes cost about as much as a linear scan.
+MAX_SUBSTRING_RADIUS = 3
+POPCOUNT_TABLE = np.array([bin(value).count("1") for value in range(2**SUBSTRING_BITS)], dtype=np.uint8)
+
+
+def make_flip_masks(bits: int, radius: int) -> np.ndarray:
+    return np.array(
+        [
+            sum(1 << bit for bit in flipped)
+            for r in range(radius + 1)
+            for flipped in itertools.combinations(range(bits), r)
+        ],
+        dtype=np.uint64,
+    )
+
+
+FLIP_MASKS = [make_flip_masks(SUBSTRING_BITS, radius) for radius in range(MAX_SUBSTRING_RADIUS + 1)]
+
+
+def to_unsigned(hashes: Any) -> np.ndarray:
+    # perseptualHashInt is a signed int64; the bit pattern is what matters.
+    return np.asarray(hashes, dtype=np.int64).view(np.uint64)
+
+
+def get_substrings(hashes: np.ndarray, index: int) -> np.ndarray:
+    return (hashes >> np.uint64(index * SUBSTRING_BITS)) & SUBSTRING_MASK
+
+
+def count_bits(hashes: np.ndarray) -> np.ndarray:
+    counts = np.zeros(hashes.shape, dtype=np.int32)
+    for index in range(NUMBER_OF_SUBSTRINGS):
+        counts += POPCOUNT_TABLE[get_substrings(hashes, index)]
+    return counts
+
+
+class MultiIndexHash:
+    # Multi-index hashing: a hash within distance d of the query matches at least one of its 16-bit substrings
+    # within d // 4, so only those buckets of sorted substring tables are probed and then verified.
+    # Additions go to a tail that is scanned linearly until it is merged by a rebuild.
+    def __init__(self, rebuild_ratio: float = 0.1, min_rebuild_size: int = 10000) -> None:
+        self.rebuild_ratio = rebuild_ratio
+        self.min_rebuild_size = min_rebuild_size
+        self.lock = threading.Lock()
+        self.loaded = threading.Event()
+        self.hash_by_id: Dict[Any, int] = {}
+        self.base_ids: List[Any] = []
+        self.base_hashes = np.zeros(0, dtype=np.uint64)
+        # Per substring, the sorted substrings and the base positions in that order, one after another in orders.
+        self.sorted_substrings: List[np.ndarray] = []
+        self.orders = np.zeros(0, dtype=np.int64)
+        self.tail_ids: List[Any] = []
+        self.tail_hashes: List[int] = []
+
+    def __len__(self) -> int:
+        return len(self.hash_by_id)
+
+    def get(self, id: Any) -> Optional[int]:
+        return self.hash_by_id.get(id)
+
+    def add(self, id: Any, hash: int) -> None:
+        with self.lock:
+            if self.hash_by_id.get(id) == hash:
+                return
+            # A replaced hash stays in the tables until the next rebuild; search() drops it by hash_by_id.
+            self.hash_by_id[id] = hash
+            self.tail_ids.append(id)
+            self.tail_hashes.append(hash)
+            if len(self.tail_ids) >= max(self.min_rebuild_size, len(self.base_ids) * self.rebuild_ratio):
+                self.rebuild()
+
+    def rebuild(self) -> None:
+        started_at = time.monotonic()
+        self.base_ids = list(self.hash_by_id.keys())
+        self.base_hashes = to_unsigned(list(self.hash_by_id.values()))
+        self.sorted_substrings = []
+        orders = []
+        for index in range(NUMBER_OF_SUBSTRINGS):
+            substrings = get_substrings(self.base_hashes, index)
+            order = np.argsort(substrings, kind="stable")
+            self.sorted_substrings.append(substrings[order])
+            orders.append(order)
+        self.orders = np.concatenate(orders)
+        self.tail_ids = []
+        self.tail_hashes = []
+        logging.info(f"rebuilt hamming index of {len(self.base_ids)} hashes in {time.monotonic() - started_at:.3f} sec")
+
+    def find_base_candidates(self, query: np.ndarray, distance: int) -> np.ndarray:
+        substring_radius = distance // NUMBER_OF_SUBSTRINGS
+        if substring_radius > MAX_SUBSTRING_RADIUS:
+            return np.arange(len(self.base_ids))
+        starts = []
+        ends = []
+        for index, substrings in enumerate(self.sorted_substrings):
+            keys = get_substrings(query, index) ^ FLIP_MASKS[substring_radius]
+            offset = index * len(self.base_ids)
+            starts.append(np.searchsorted(substrings, keys, side="left") + offset)
+            ends.append(np.searchsorted(substrings, keys, side="right") + offset)
+        # Every probed bucket is a range of orders; gather them all without a Python loop.
+        # A hash found through several substrings is a duplicate candidate, which search() collapses by id.
+        range_starts = np.concatenate(starts)
+        range_lengths = np.concatenate(ends) - range_starts
+        positions = np.repeat(range_starts - np.cumsum(range_lengths) + range_lengths, range_lengths)
+        return self.orders[positions + np.arange(len(positions))]
+
+    def search(self, hash: int, distance: int, limit: Optional[int] = None) -> List[Tuple[Any, int]]:
+        query = to_unsigned([hash])
+        with self.lock:
+            candidates = self.find_base_candidates(query, distance)
+            base_distances = count_bits(self.base_hashes[candidates] ^ query)
+            matched = base_distances <= distance
+            candidates, base_distances = candidates[matched], base_distances[matched]
+            tail_distances = count_bits(to_unsigned(self.tail_hashes) ^ query)
+            matches = list(
+                zip(
+                    [self.base_ids[candidate] for candidate in candidates.tolist()],
+                    base_distances.tolist(),
+                    self.base_hashes[candidates].view(np.int64).tolist(),
+                )
+            ) + [
+                (id, tail_distance, tail_hash)
+                for id, tail_distance, tail_hash in zip(self.tail_ids, tail_distances.tolist(), self.tail_hashes)
+                if tail_distance <= distance
+            ]
+            # Entries whose hash has since been replaced are stale.
+            results = {
+                id: match_distance
+                for id, match_distance, match_hash in matches
+                if self.hash_by_id.get(id) == match_hash
+            }
+        return sorted(results.items(), key=lambda item: (item[1], item[0]))[:limit]
+
+
+HASH_CONDITION = {"image.perseptualHash": {"$exists": True}}
+HASH_PROJECTION = {"image.perseptualHash": True, "image.perseptualHashInt": True}
+
+
+def get_hash(record: Dict[str, Any]) -> Optional[int]:
+    image = record.get("image", {})
+    if (hash := image.get("perseptualHashInt")) is not None:
+        return int(hash)
+    elif (hex := image.get("perseptualHash")) is not None:
+        return hex_to_hash(hex)
+    else:
+        return None
+
+
+def load_hashes(
+    index: MultiIndexHash, collection: pymongo.collection.Collection[Dict[str, Any]], batch_size: int = 10000
+) -> None:
+    started_at = time.monotonic()
+    hash_by_id = {}
+    for record in collection.find(HASH_CONDITION, HASH_PROJECTION, batch_size=batch_size):
+        if (hash := get_hash(record)) is not None:
+            hash_by_id[record["_id"]] = hash
+    with index.lock:
+        index.hash_by_id = hash_by_id
+        index.rebuild()
+    index.loaded.set()
+    logging.info(f"loaded {len(index)} hashes in {time.monotonic() - started_at:.1f} sec")
+
+
+def follow_hashes(index: MultiIndexHash, collection: pymongo.collection.Collection[Dict[str, Any]]) -> None:
+    # The watcher is opened before the load, so hashes written meanwhile are not missed.
+    watcher = Watcher(collection, HASH_CONDITION, HASH_PROJECTION)
+    load_hashes(index, collection)
+    for records in watcher:
+        for record in records:
+            if (hash := get_hash(record)) is not None:
+                index.add(record["_id"], hash)
+
+
+def start_following_hashes(
+    index: MultiIndexHash, collection: pymongo.collection.Collection[Dict[str, Any]]
+) -> threading.Thread:
+    thread = threading.Thread(target=follow_hashes, args=(index, collection), daemon=True)
+    thread.start()
+    return thread
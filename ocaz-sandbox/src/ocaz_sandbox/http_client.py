@@ -0,0 +1,186 @@
+import contextlib
+import fcntl
+import hashlib
+import logging
+import os
+import pathlib
+import random
+import re
+import tempfile
+import threading
+import time
+from typing import Any, Callable, Dict, Iterator, Optional, TypedDict
+from urllib.parse import urlparse
+
+import requests
+import requests.adapters
+
+from .adaptive import AimdLimiter
+
+DEFAULT_MAX_CONNECTIONS_PER_HOST = 16
+DEFAULT_INITIAL_CONNECTIONS_PER_HOST = 4
+DEFAULT_LATENCY_TOLERANCE = 2.0
+RETRY_STATUS_CODES = [429, 502, 503, 504]
+
+
+class ContentRange(TypedDict):
+    start_byte: int
+    end_byte: int
+    total_size: int
+
+
+def parse_content_range(content_range: Optional[str]) -> Optional[ContentRange]:
+    if content_range and (match := re.match(r"^bytes\s+(\d+)-(\d+)/(\d+)$", content_range)):
+        start_byte, end_byte, total_size = map(int, match.groups())
+        return ContentRange(start_byte=start_byte, end_byte=end_byte, total_size=total_size)
+    else:
+        return None
+
+
+class HostSlots:
+    # Slots are flock(2)ed files, so the cap is shared by every worker process on the node.
+    def __init__(self, slot_dir: pathlib.Path, max_slots: int, poll_interval: float = 0.05) -> None:
+        self.slot_dir = slot_dir
+        self.max_slots = max_slots
+        self.poll_interval = poll_interval
+        self.slot_dir.mkdir(parents=True, exist_ok=True)
+
+    def try_lock(self, host: str, number_of_slots: int) -> Optional[Any]:
+        name = hashlib.sha1(host.encode("utf-8")).hexdigest()
+        for index in range(max(1, min(self.max_slots, number_of_slots))):
+            file = (self.slot_dir / f"{name}.{index}").open("wb")
+            try:
+                fcntl.flock(file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return file
+            except BlockingIOError:
+                file.close()
+        return None
+
+    @contextlib.contextmanager
+    def acquire(self, host: str, get_number_of_slots: Callable[[], int]) -> Iterator[None]:
+        while (file := self.try_lock(host, get_number_of_slots())) is None:
+            time.sleep(self.poll_interval)
+        try:
+            yield
+        finally:
+            fcntl.flock(file, fcntl.LOCK_UN)
+            file.close()
+
+
+class HttpClient:
+    def __init__(
+        self,
+        max_connections_per_host: int = DEFAULT_MAX_CONNECTIONS_PER_HOST,
+        initial_connections_per_host: int = DEFAULT_INITIAL_CONNECTIONS_PER_HOST,
+        latency_tolerance: float = DEFAULT_LATENCY_TOLERANCE,
+        slot_dir: Optional[pathlib.Path] = None,
+        max_retries: int = 3,
+        backoff_base: float = 0.5,
+        backoff_max: float = 30.0,
+    ) -> None:
+        self.max_connections_per_host = max_connections_per_host
+        self.initial_connections_per_host = initial_connections_per_host
+        self.latency_tolerance = latency_tolerance
+        self.host_slots = HostSlots(
+            slot_dir or pathlib.Path(tempfile.gettempdir()) / "ocaz-host-slots", max_connections_per_host
+        )
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.sessions: Dict[str, requests.Session] = {}
+        self.limiters: Dict[str, AimdLimiter] = {}
+        self.lock = threading.Lock()
+
+    def get_session(self, host: str) -> requests.Session:
+        with self.lock:
+            if (session := self.sessions.get(host)) is None:
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.max_connections_per_host)
+                session = requests.Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self.sessions[host] = session
+            return session
+
+    def get_limiter(self, host: str) -> AimdLimiter:
+        with self.lock:
+            if (limiter := self.limiters.get(host)) is None:
+                limiter = AimdLimiter(
+                    f"http {host}",
+                    initial_limit=self.initial_connections_per_host,
+                    max_limit=self.max_connections_per_host,
+                    latency_tolerance=self.latency_tolerance,
+                )
+                self.limiters[host] = limiter
+            return limiter
+
+    def get_backoff(self, attempt: int) -> float:
+        # Full jitter, so that workers which failed together do not retry together.
+        return random.uniform(0.0, min(self.backoff_max, self.backoff_base * 2**attempt))
+
+    @contextlib.contextmanager
+    def request(self, method: str, url: str, host: Optional[str] = None, **kwargs: Any) -> Iterator[requests.Response]:
+        host = host or urlparse(url).netloc
+        session = self.get_session(host)
+        limiter = self.get_limiter(host)
+        # The limiter starts at --initial-connections-per-host, grows while the host keeps up and backs off while it
+        # is slow or failing, up to --max-connections-per-host.
+        with contextlib.ExitStack() as host_slot:
+            for attempt in range(self.max_retries + 1):
+                host_slot.enter_context(self.host_slots.acquire(host, limiter.get_limit))
+                # With stream=True this is the time to the response headers, which does not depend on the body size.
+                started_at = time.monotonic()
+                try:
+                    response = session.request(method, url, **kwargs)
+                except (requests.ConnectionError, requests.Timeout) as error:
+                    limiter.record(time.monotonic() - started_at, success=False)
+                    if attempt == self.max_retries:
+                        raise
+                    logging.warning(f"retry {method} {url}: {error!r}")
+                else:
+                    limiter.record(
+                        time.monotonic() - started_at, success=response.status_code not in RETRY_STATUS_CODES
+                    )
+                    if response.status_code not in RETRY_STATUS_CODES or attempt == self.max_retries:
+                        break
+                    logging.warning(f"retry {method} {url}: status {response.status_code}")
+                    response.close()
+                # The slot is given back during the backoff, so that it does not idle while other requests wait.
+                host_slot.close()
+                time.sleep(self.get_backoff(attempt))
+
+            with response:
+                yield response
+
+    def get(self, url: str, host: Optional[str] = None, **kwargs: Any) -> Any:
+        return self.request("GET", url, host=host, **kwargs)
+
+    def post(self, url: str, host: Optional[str] = None, **kwargs: Any) -> Any:
+        return self.request("POST", url, host=host, **kwargs)
+
+
+http_client: Optional[HttpClient] = None
+http_client_pid: Optional[int] = None
+http_client_options: Dict[str, Any] = {}
+
+
+def configure_http_client(
+    max_connections_per_host: int,
+    initial_connections_per_host: int = DEFAULT_INITIAL_CONNECTIONS_PER_HOST,
+    latency_tolerance: float = DEFAULT_LATENCY_TOLERANCE,
+) -> None:
+    global http_client, http_client_options
+    http_client = None
+    http_client_options = {
+        "max_connections_per_host": max_connections_per_host,
+        "initial_connections_per_host": initial_connections_per_host,
+        "latency_tolerance": latency_tolerance,
+    }
+
+
+def get_http_client() -> HttpClient:
+    global http_client, http_client_pid
+    # Pooled connections must not be shared with forked worker processes.
+    if http_client is None or http_client_pid != os.getpid():
+        http_client = HttpClient(**http_client_options)
+        http_client_pid = os.getpid()
+    return http_client
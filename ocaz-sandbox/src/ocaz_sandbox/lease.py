@@ -0,0 +1,159 @@
+import contextlib
+import dataclasses
+import logging
+import math
+import os
+import socket
+import threading
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+import pymongo
+
+from .db import get_database
+
+
+def make_owner() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+class Lease:
+    def __init__(
+        self, collection: pymongo.collection.Collection[Dict[str, Any]], stage: str, owner: str, duration: float
+    ) -> None:
+        self.collection = collection
+        self.field = f"lease.{stage}"
+        self.owner = owner
+        self.duration = duration
+
+    def claim(self, condition: Dict[str, Any], projection: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        now = datetime.now().timestamp()
+        # Unleased records and records whose lease has expired (a crashed or stalled owner) are claimable.
+        claimable_condition = {
+            "$and": [
+                condition,
+                {"$or": [{self.field: {"$exists": False}}, {f"{self.field}.expiresAt": {"$lt": now}}]},
+            ]
+        }
+        record: Optional[Dict[str, Any]] = self.collection.find_one_and_update(
+            claimable_condition,
+            {"$set": {self.field: {"owner": self.owner, "expiresAt": now + self.duration}}},
+            projection={**projection, "_id": True},
+            return_document=pymongo.ReturnDocument.AFTER,
+        )
+        return record
+
+    def claim_many(self, condition: Dict[str, Any], projection: Dict[str, Any], max_count: int) -> List[Dict[str, Any]]:
+        records: List[Dict[str, Any]] = []
+        while len(records) < max_count and (record := self.claim(condition, projection)):
+            records.append(record)
+        return records
+
+    def renew(self, ids: List[Any]) -> int:
+        result = self.collection.update_many(
+            {"_id": {"$in": ids}, f"{self.field}.owner": self.owner},
+            {"$set": {f"{self.field}.expiresAt": datetime.now().timestamp() + self.duration}},
+        )
+        if result.matched_count < len(ids):
+            logging.warning(f"lost {len(ids) - result.matched_count} of {len(ids)} leases on {self.collection.name}")
+        return result.matched_count
+
+    def release(self, ids: List[Any], condition: Dict[str, Any]) -> None:
+        # Records still matching the condition failed; they keep the lease until it expires so that
+        # they are retried later instead of being claimed again right away.
+        self.collection.update_many(
+            {"_id": {"$in": ids}, f"{self.field}.owner": self.owner, "$nor": [condition]},
+            {"$unset": {self.field: ""}},
+        )
+
+    @contextlib.contextmanager
+    def keep_alive(self, ids: List[Any]) -> Iterator[None]:
+        stopped = threading.Event()
+
+        def renew_periodically() -> None:
+            while not stopped.wait(self.duration / 3):
+                self.renew(ids)
+
+        thread = threading.Thread(target=renew_periodically, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            thread.join()
+
+
+@dataclasses.dataclass
+class LeaseSpec:
+    mongodb_url: str
+    collection_name: str
+    stage: str
+    condition: Dict[str, Any]
+    projection: Dict[str, Any]
+    duration: float
+
+    def narrow(self, ids: List[Any]) -> "LeaseSpec":
+        return dataclasses.replace(self, condition={**self.condition, "_id": {"$in": ids}})
+
+
+def process_ids(process: Callable[[List[Any]], None], records: List[Dict[str, Any]]) -> None:
+    process([record["_id"] for record in records])
+
+
+def process_leased(
+    lease_spec: LeaseSpec,
+    chunk_size: int,
+    max_records: Optional[int],
+    process: Callable[[List[Dict[str, Any]]], None],
+) -> int:
+    mongodb = get_database(lease_spec.mongodb_url)
+    lease = Lease(mongodb[lease_spec.collection_name], lease_spec.stage, make_owner(), lease_spec.duration)
+
+    number_of_records = 0
+    while max_records is None or number_of_records < max_records:
+        max_count = chunk_size if max_records is None else min(chunk_size, max_records - number_of_records)
+        records = lease.claim_many(lease_spec.condition, lease_spec.projection, max_count)
+        if len(records) == 0:
+            break
+        logging.info(f"claimed {len(records)} records from {lease_spec.collection_name}")
+
+        ids = [record["_id"] for record in records]
+        with lease.keep_alive(ids):
+            try:
+                process(records)
+            except Exception as error:
+                logging.error(f"failed to process {len(records)} records: {error!r}")
+        lease.release(ids, lease_spec.condition)
+        number_of_records += len(records)
+
+    return number_of_records
+
+
+def submit_leased(
+    executor: Any,
+    lease_spec: LeaseSpec,
+    max_workers: int,
+    chunk_size: int,
+    max_records: Optional[int],
+    process: Callable[[List[Dict[str, Any]]], None],
+) -> List[Any]:
+    max_records_per_worker = None if max_records is None else math.ceil(max_records / max_workers)
+    return [
+        executor.submit(process_leased, lease_spec, chunk_size, max_records_per_worker, process)
+        for _ in range(max_workers)
+    ]
+
+
+def submit_records(
+    executor: Any,
+    lease_spec: Optional[LeaseSpec],
+    chunk_size: int,
+    process: Callable[[List[Dict[str, Any]]], None],
+    records: List[Dict[str, Any]],
+) -> Any:
+    if lease_spec:
+        # Other nodes may see the same change, so the records are claimed rather than processed directly.
+        ids = [record["_id"] for record in records]
+        return executor.submit(process_leased, lease_spec.narrow(ids), chunk_size, None, process)
+    else:
+        return executor.submit(process, records)
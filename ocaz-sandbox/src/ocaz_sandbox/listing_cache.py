@@ -0,0 +1,85 @@
+import json
+import pathlib
+import sqlite3
+from dataclasses import dataclass
+from typing import List, NamedTuple, Optional
+
+
+class Entry(NamedTuple):
+    url: str
+    size: Optional[int]
+    mtime: Optional[float]
+
+
+@dataclass
+class Listing:
+    etag: Optional[str]
+    last_modified: Optional[str]
+    mtime: Optional[float]
+    entries: List[Entry]
+    # When the origin served the listing, by its own clock.
+    listed_at: Optional[float] = None
+
+
+class ListingCache:
+    def __init__(self, path: pathlib.Path, commit_interval: Optional[int] = 1000) -> None:
+        self.connection = sqlite3.connect(str(path))
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS listing ("
+            " url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, mtime REAL, entries TEXT NOT NULL, listed_at REAL"
+            ")"
+        )
+        # Caches written before listed_at existed; their rows have no listed_at and are listed again once.
+        columns = [row[1] for row in self.connection.execute("PRAGMA table_info(listing)")]
+        if "listed_at" not in columns:
+            self.connection.execute("ALTER TABLE listing ADD COLUMN listed_at REAL")
+        self.commit_interval = commit_interval
+        self.pending_writes = 0
+
+    def get(self, url: str) -> Optional[Listing]:
+        row = self.connection.execute(
+            "SELECT etag, last_modified, mtime, entries, listed_at FROM listing WHERE url = ?", (url,)
+        ).fetchone()
+        if row is None:
+            return None
+        etag, last_modified, mtime, entries, listed_at = row
+        return Listing(
+            etag=etag,
+            last_modified=last_modified,
+            mtime=mtime,
+            entries=[Entry(*entry) for entry in json.loads(entries)],
+            listed_at=listed_at,
+        )
+
+    def put(self, url: str, listing: Listing) -> None:
+        self.connection.execute(
+            "INSERT OR REPLACE INTO listing (url, etag, last_modified, mtime, entries, listed_at)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            (url, listing.etag, listing.last_modified, listing.mtime, json.dumps(listing.entries), listing.listed_at),
+        )
+        self.count_write()
+
+    def delete_subtree(self, url: str) -> List[str]:
+        rows = self.connection.execute(
+            "SELECT url, entries FROM listing WHERE substr(url, 1, ?) = ?", (len(url), url)
+        ).fetchall()
+        file_urls = [
+            entry_url for _, entries in rows for entry_url, *_ in json.loads(entries) if not entry_url.endswith("/")
+        ]
+        self.connection.execute("DELETE FROM listing WHERE substr(url, 1, ?) = ?", (len(url), url))
+        self.count_write()
+        return file_urls
+
+    def count_write(self) -> None:
+        self.pending_writes += 1
+        # With commit_interval None the owner decides when to commit (e.g. together with a crawl checkpoint).
+        if self.commit_interval is not None and self.pending_writes >= self.commit_interval:
+            self.commit()
+
+    def commit(self) -> None:
+        self.connection.commit()
+        self.pending_writes = 0
+
+    def close(self) -> None:
+        self.commit()
+        self.connection.close()
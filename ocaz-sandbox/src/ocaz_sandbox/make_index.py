@@ -6,6 +6,7 @@ import pymongo
 
 from .command import option_log_level, option_mongodb_url
 from .db import get_database
+from .status import OBJECT_STAGES, URL_STAGES, make_pending_condition
 
 COLLECTION_URL = "url"
 COLLECTION_OBJECT = "object"
@@ -17,10 +18,21 @@ def make_index(mongodb_url: str) -> None:
     mongodb = get_database(mongodb_url)
     mongodb[COLLECTION_URL].create_index([("url", pymongo.ASCENDING)], unique=True)
     mongodb[COLLECTION_URL].create_index([("head10mbSha1", pymongo.ASCENDING)])
+    mongodb[COLLECTION_URL].create_index([("updatedAt", pymongo.ASCENDING)])
     mongodb[COLLECTION_OBJECT].create_index([("size", pymongo.ASCENDING)])
     mongodb[COLLECTION_OBJECT].create_index([("mimeType", pymongo.ASCENDING)])
     mongodb[COLLECTION_OBJECT].create_index([("sha1", pymongo.ASCENDING)])
     mongodb[COLLECTION_OBJECT].create_index([("perseptualHash", pymongo.ASCENDING)])
+    mongodb[COLLECTION_OBJECT].create_index([("image.perseptualHashInt", pymongo.ASCENDING)])
+    mongodb[COLLECTION_OBJECT].create_index([("updatedAt", pymongo.ASCENDING)])
+    mongodb[COLLECTION_OBJECT].create_index([("duplicateGroup", pymongo.ASCENDING)])
+    # Partial indexes only hold pending records, so finding work stays cheap however large the collections grow.
+    for collection_name, stages in [(COLLECTION_URL, URL_STAGES), (COLLECTION_OBJECT, OBJECT_STAGES)]:
+        for stage in stages:
+            mongodb[collection_name].create_index(
+                [(f"status.{stage}", pymongo.ASCENDING), ("_id", pymongo.ASCENDING)],
+                partialFilterExpression=make_pending_condition(stage),
+            )
 
 
 @click.command()
@@ -0,0 +1,241 @@
+import logging
+import struct
+from typing import Any, BinaryIO, Dict, Iterator, Optional, Tuple
+
+import requests
+
+from .http_client import get_http_client, parse_content_range
+
+BLOCK_SIZE = 4 * 1000
+# SOF0-SOF15 except DHT (C4), JPG (C8) and DAC (CC).
+JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+# Markers without a length: TEM, RST0-RST7, SOI and EOI.
+JPEG_STANDALONE_MARKERS = {0x01, *range(0xD0, 0xDA)}
+
+
+class RangeReader:
+    # Reads a URL by Range requests of whole blocks, so that the small reads of a parser cost few round trips.
+    def __init__(self, url: str, block_size: int = BLOCK_SIZE) -> None:
+        self.url = url
+        self.block_size = block_size
+        self.size: Optional[int] = None
+        self.blocks: Dict[int, bytes] = {}
+        self.read_bytes = 0
+
+    def fetch_blocks(self, first_index: int, last_index: int) -> int:
+        # One request for the whole span, so that reading a large moov is not a round trip per block.
+        start_byte = first_index * self.block_size
+        end_byte = (last_index + 1) * self.block_size - 1
+        with get_http_client().get(
+            self.url, headers={"Range": f"bytes={start_byte}-{end_byte}"}, stream=True
+        ) as response:
+            # Without Range support the whole object would come back; leave it to the fallback.
+            assert response.status_code == requests.codes.partial, f"Range is not supported by {self.url}"
+            content_range = parse_content_range(response.headers.get("Content-Range"))
+            assert content_range and content_range["start_byte"] == start_byte
+            size: int = content_range["total_size"]
+            content = response.content
+        self.read_bytes += len(content)
+        for index in range(first_index, last_index + 1):
+            offset = (index - first_index) * self.block_size
+            self.blocks[index] = content[offset : offset + self.block_size]
+        return size
+
+    def get_size(self) -> int:
+        if self.size is None:
+            self.size = self.fetch_blocks(0, 0)
+        return self.size
+
+    def read(self, offset: int, size: int) -> bytes:
+        end = min(offset + size, self.get_size())
+        if end <= offset:
+            return b""
+        indexes = range(offset // self.block_size, (end - 1) // self.block_size + 1)
+        if missing_indexes := [index for index in indexes if index not in self.blocks]:
+            self.size = self.fetch_blocks(missing_indexes[0], missing_indexes[-1])
+        return b"".join(
+            self.blocks[index][max(offset - index * self.block_size, 0) : end - index * self.block_size]
+            for index in indexes
+        )
+
+    def close(self) -> None:
+        pass
+
+
+class FileReader:
+    def __init__(self, file: BinaryIO) -> None:
+        self.file = file
+        self.read_bytes = 0
+
+    def get_size(self) -> int:
+        return self.file.seek(0, 2)
+
+    def read(self, offset: int, size: int) -> bytes:
+        self.file.seek(offset)
+        data = self.file.read(size)
+        self.read_bytes += len(data)
+        return data
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def read_exactly(reader: Any, offset: int, size: int) -> bytes:
+    data: bytes = reader.read(offset, size)
+    assert len(data) == size, f"truncated at {offset}"
+    return data
+
+
+def probe_jpeg(reader: Any) -> Dict[str, Any]:
+    offset = 2
+    while True:
+        marker, length = struct.unpack(">2sH", read_exactly(reader, offset, 4))
+        assert marker[0] == 0xFF, f"broken marker at {offset}"
+        if marker[1] == 0xFF:
+            # A fill byte.
+            offset += 1
+        elif marker[1] in JPEG_STANDALONE_MARKERS:
+            offset += 2
+        elif marker[1] in JPEG_SOF_MARKERS:
+            height, width = struct.unpack(">HH", read_exactly(reader, offset + 5, 4))
+            return {"width": width, "height": height}
+        else:
+            assert marker[1] != 0xDA, "no SOF before the scan"
+            offset += 2 + length
+
+
+def probe_png(reader: Any) -> Dict[str, Any]:
+    chunk_type, width, height = struct.unpack(">4sII", read_exactly(reader, 12, 12))
+    assert chunk_type == b"IHDR"
+    return {"width": width, "height": height}
+
+
+def probe_gif(reader: Any) -> Dict[str, Any]:
+    # The logical screen descriptor follows the 6-byte signature.
+    width, height = struct.unpack("<HH", read_exactly(reader, 6, 4))
+    return {"width": width, "height": height}
+
+
+def iter_boxes(data: bytes, offset: int = 0) -> Iterator[Tuple[bytes, bytes]]:
+    while offset + 8 <= len(data):
+        size, box_type = struct.unpack(">I4s", data[offset : offset + 8])
+        header_size = 8
+        if size == 1:
+            (size,) = struct.unpack(">Q", data[offset + 8 : offset + 16])
+            header_size = 16
+        elif size == 0:
+            size = len(data) - offset
+        assert size >= header_size, f"broken {box_type!r} box"
+        yield box_type, data[offset + header_size : offset + size]
+        offset += size
+
+
+def find_box(data: bytes, box_type: bytes) -> Optional[bytes]:
+    return next((body for found_type, body in iter_boxes(data) if found_type == box_type), None)
+
+
+def find_moov(reader: Any) -> bytes:
+    # Only the top-level box headers are read on the way, so a moov behind a large mdat costs one tail range.
+    offset = 0
+    size = reader.get_size()
+    while offset + 8 <= size:
+        box_size, box_type = struct.unpack(">I4s", read_exactly(reader, offset, 8))
+        header_size = 8
+        if box_size == 1:
+            (box_size,) = struct.unpack(">Q", read_exactly(reader, offset + 8, 8))
+            header_size = 16
+        elif box_size == 0:
+            box_size = size - offset
+        assert box_size >= header_size, f"broken {box_type!r} box at {offset}"
+        if box_type == b"moov":
+            return read_exactly(reader, offset + header_size, box_size - header_size)
+        offset += box_size
+    raise AssertionError("no moov box")
+
+
+def parse_mdhd_times(body: bytes) -> Tuple[int, int]:
+    # timescale and duration, whose fields are 64-bit in version 1.
+    timescale, duration = struct.unpack(">IQ", body[20:32]) if body[0] == 1 else struct.unpack(">II", body[12:20])
+    return timescale, duration
+
+
+def parse_tkhd_rotated(body: bytes) -> bool:
+    # Whether the display matrix turns the track by 90 or 270 degrees, which cv2 applies to the frame size.
+    matrix_offset = 52 if body[0] == 1 else 40
+    a, b = struct.unpack(">ii", body[matrix_offset : matrix_offset + 8])
+    return bool(a == 0 and b != 0)
+
+
+def parse_stsd_size(body: bytes) -> Optional[Tuple[int, int]]:
+    # The first visual sample entry: size, type, 6 reserved, data_reference_index, 16 pre-defined, width, height.
+    if len(body) < 8 + 36:
+        return None
+    width, height = struct.unpack(">HH", body[8 + 32 : 8 + 36])
+    return width, height
+
+
+def parse_stts_frames(body: bytes) -> int:
+    (number_of_entries,) = struct.unpack(">I", body[4:8])
+    counts = struct.unpack(f">{number_of_entries * 2}I", body[8 : 8 + number_of_entries * 8])
+    return sum(counts[0::2])
+
+
+def probe_mp4(reader: Any) -> Dict[str, Any]:
+    moov = find_moov(reader)
+    for box_type, trak in iter_boxes(moov):
+        if box_type != b"trak":
+            continue
+        mdia = find_box(trak, b"mdia")
+        if mdia is None:
+            continue
+        hdlr = find_box(mdia, b"hdlr")
+        if hdlr is None or hdlr[8:12] != b"vide":
+            continue
+        minf = find_box(mdia, b"minf")
+        stbl = find_box(minf, b"stbl") if minf is not None else None
+        if stbl is None:
+            raise AssertionError("no sample table in the video track")
+        tkhd = find_box(trak, b"tkhd")
+        mdhd = find_box(mdia, b"mdhd")
+        stts = find_box(stbl, b"stts")
+        stsd = find_box(stbl, b"stsd")
+        if tkhd is None or mdhd is None or stts is None or stsd is None:
+            raise AssertionError("incomplete video track")
+
+        if size := parse_stsd_size(stsd):
+            width, height = size
+        else:
+            width, height = [value >> 16 for value in struct.unpack(">II", tkhd[-8:])]
+        if parse_tkhd_rotated(tkhd):
+            width, height = height, width
+        timescale, duration = parse_mdhd_times(mdhd)
+        number_of_frames = parse_stts_frames(stts)
+        assert timescale > 0 and duration > 0 and number_of_frames > 0, "empty video track"
+        return {
+            "width": width,
+            "height": height,
+            "numberOfFrames": number_of_frames,
+            "fps": number_of_frames * timescale / duration,
+        }
+    raise AssertionError("no video track")
+
+
+PROBERS = {
+    "image/jpeg": probe_jpeg,
+    "image/png": probe_png,
+    "image/gif": probe_gif,
+    "video/mp4": probe_mp4,
+}
+
+
+def probe_media(reader: Any, mime_type: str) -> Optional[Dict[str, Any]]:
+    # None when the header cannot be read, so that the caller falls back to opening the whole stream.
+    if (prober := PROBERS.get(mime_type)) is None:
+        return None
+    try:
+        video_info = prober(reader)
+    except (AssertionError, struct.error, IndexError, TypeError) as error:
+        logging.warning(f"failed to probe the {mime_type} header: {error}")
+        return None
+    logging.info(f"probed the header in {reader.read_bytes} bytes")
+    return video_info
@@ -0,0 +1,59 @@
+import json
+import logging
+
+import click
+import more_itertools
+import pymongo
+
+from ..command import option_log_level, option_mongodb_url
+from ..db import get_database
+from ..phash import hex_to_hash
+
+COLLECTION_OBJECT = "object"
+
+
+def add_phash_int(
+    mongodb_url: str,
+    chunk_size: int,
+) -> None:
+    mongodb = get_database(mongodb_url)
+
+    records = mongodb[COLLECTION_OBJECT].find(
+        {"image.perseptualHash": {"$exists": True}, "image.perseptualHashInt": {"$exists": False}},
+        {"image.perseptualHash": True},
+    )
+
+    number_of_records = 0
+    for chunked_records in more_itertools.chunked(records, chunk_size):
+        mongodb[COLLECTION_OBJECT].bulk_write(
+            [
+                pymongo.UpdateOne(
+                    {"_id": record["_id"]},
+                    {"$set": {"image.perseptualHashInt": hex_to_hash(record["image"]["perseptualHash"])}},
+                )
+                for record in chunked_records
+            ],
+            ordered=False,
+        )
+        number_of_records += len(chunked_records)
+        logging.info(f"updated {number_of_records} records")
+
+
+@click.command()
+@option_log_level
+@option_mongodb_url
+@click.option("--chunk-size", type=int, default=1000, show_default=True, required=True)
+def main(log_level: str, mongodb_url: str, chunk_size: int) -> None:
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)s pid:%(process)d %(message)s",
+        level=getattr(logging, log_level.upper(), logging.INFO),
+    )
+    logging.debug(f"log_level = {json.dumps(log_level)}")
+
+    add_phash_int(mongodb_url=mongodb_url, chunk_size=chunk_size)
+
+    logging.info("done")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import json
+import logging
+from typing import Any, Dict, List, Tuple
+
+import click
+
+from ..command import option_log_level, option_mongodb_url
+from ..db import get_database
+from ..status import (
+    STAGE_MEDIA_META,
+    STAGE_NSFW_GANTMAN,
+    STAGE_NSFW_OPENNSFW2,
+    STAGE_OBJECT_META,
+    STAGE_PHASH,
+    STAGE_SHA1,
+    STATUS_DONE,
+    STATUS_PENDING,
+)
+
+COLLECTION_URL = "url"
+COLLECTION_OBJECT = "object"
+SUPPORT_MIME_TYPES = ["image/jpeg", "image/png", "image/gif", "video/mp4"]
+
+# (collection, stage, pending condition, done condition), as the resolvers selected their work before the status field.
+STAGES: List[Tuple[str, str, Dict[str, Any], Dict[str, Any]]] = [
+    (
+        COLLECTION_URL,
+        STAGE_OBJECT_META,
+        {"head10mbSha1": {"$exists": False}},
+        {"head10mbSha1": {"$exists": True}},
+    ),
+    (
+        COLLECTION_OBJECT,
+        STAGE_SHA1,
+        {"sha1": {"$exists": False}},
+        {"sha1": {"$exists": True}},
+    ),
+    (
+        COLLECTION_OBJECT,
+        STAGE_MEDIA_META,
+        {"mimeType": {"$in": SUPPORT_MIME_TYPES}, "image": {"$exists": False}, "video": {"$exists": False}},
+        {"$or": [{"image": {"$exists": True}}, {"video": {"$exists": True}}]},
+    ),
+    (
+        COLLECTION_OBJECT,
+        STAGE_PHASH,
+        {"image": {"$exists": True}, "image.perseptualHash": {"$exists": False}},
+        {"image.perseptualHash": {"$exists": True}},
+    ),
+    (
+        COLLECTION_OBJECT,
+        STAGE_NSFW_GANTMAN,
+        {"image": {"$exists": True}, f"image.predictions.{STAGE_NSFW_GANTMAN}": {"$exists": False}},
+        {f"image.predictions.{STAGE_NSFW_GANTMAN}": {"$exists": True}},
+    ),
+    (
+        COLLECTION_OBJECT,
+        STAGE_NSFW_OPENNSFW2,
+        {"image": {"$exists": True}, f"image.predictions.{STAGE_NSFW_OPENNSFW2}": {"$exists": False}},
+        {f"image.predictions.{STAGE_NSFW_OPENNSFW2}": {"$exists": True}},
+    ),
+]
+
+
+def add_status(
+    mongodb_url: str,
+) -> None:
+    mongodb = get_database(mongodb_url)
+
+    for collection_name, stage, pending_condition, done_condition in STAGES:
+        for status, condition in [(STATUS_PENDING, pending_condition), (STATUS_DONE, done_condition)]:
+            result = mongodb[collection_name].update_many(
+                {**condition, f"status.{stage}": {"$exists": False}},
+                {"$set": {f"status.{stage}": status}},
+            )
+            logging.info(f"{collection_name} status.{stage} = {status}: {result.modified_count} records")
+
+
+@click.command()
+@option_log_level
+@option_mongodb_url
+def main(log_level: str, mongodb_url: str) -> None:
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)s pid:%(process)d %(message)s",
+        level=getattr(logging, log_level.upper(), logging.INFO),
+    )
+    logging.debug(f"log_level = {json.dumps(log_level)}")
+
+    add_status(mongodb_url=mongodb_url)
+
+    logging.info("done")
+
+
+if __name__ == "__main__":
+    main()
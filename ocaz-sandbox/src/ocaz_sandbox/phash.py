@@ -0,0 +1,80 @@
+from typing import Any, Dict, List
+
+import numpy as np
+import PIL.Image
+
+HASH_SIZE = 8
+# The same 32x32 input as imagehash.phash(hash_size=8, highfreq_factor=4), so that the legacy string is unchanged.
+THUMBNAIL_SIZE = HASH_SIZE * 4
+
+
+def make_dct_matrix(size: int, number_of_coefficients: int) -> np.ndarray:
+    # Unnormalized DCT-II rows as scipy.fftpack.dct computes them, truncated to the low frequencies.
+    k = np.arange(number_of_coefficients)[:, np.newaxis]
+    n = np.arange(size)[np.newaxis, :]
+    return 2 * np.cos(np.pi * k * (2 * n + 1) / (2 * size))
+
+
+def make_area_matrix(size: int, new_size: int) -> np.ndarray:
+    # Averaging weights of an area resize from size to new_size samples, also for a non-integer ratio.
+    edges = np.linspace(0, size, new_size + 1)
+    starts = np.maximum(edges[:-1, np.newaxis], np.arange(size)[np.newaxis, :])
+    ends = np.minimum(edges[1:, np.newaxis], np.arange(1, size + 1)[np.newaxis, :])
+    weights = np.clip(ends - starts, 0, None)
+    area_matrix: np.ndarray = weights / weights.sum(axis=1, keepdims=True)
+    return area_matrix
+
+
+DCT_MATRIX = make_dct_matrix(THUMBNAIL_SIZE, HASH_SIZE)
+AVERAGE_MATRIX = make_area_matrix(THUMBNAIL_SIZE, HASH_SIZE)
+DIFFERENCE_MATRIX = make_area_matrix(THUMBNAIL_SIZE, HASH_SIZE + 1)
+
+
+def make_thumbnail(image: PIL.Image.Image) -> np.ndarray:
+    return np.asarray(image.convert("L").resize((THUMBNAIL_SIZE, THUMBNAIL_SIZE), PIL.Image.Resampling.LANCZOS))
+
+
+def pack_bits(bits: np.ndarray) -> np.ndarray:
+    # Row-major and most significant bit first like str(ImageHash), reinterpreted as int64 for MongoDB.
+    return np.packbits(bits.reshape(len(bits), -1), axis=1).view(">i8").astype(np.int64).reshape(-1)
+
+
+def calc_perceptual_hashes(thumbnails: np.ndarray) -> np.ndarray:
+    dct = DCT_MATRIX @ thumbnails @ DCT_MATRIX.T
+    return pack_bits(dct > np.median(dct.reshape(len(dct), -1), axis=1)[:, np.newaxis, np.newaxis])
+
+
+# averageHashInt and differenceHashInt are area-reduced from the 32x32 pHash thumbnail, so that they come with the
+# same batch; they are not imagehash.average_hash / dhash, which resize the original image to 8x8 / 9x8 directly.
+def calc_average_hashes(thumbnails: np.ndarray) -> np.ndarray:
+    pixels = AVERAGE_MATRIX @ thumbnails @ AVERAGE_MATRIX.T
+    return pack_bits(pixels > pixels.mean(axis=(1, 2))[:, np.newaxis, np.newaxis])
+
+
+def calc_difference_hashes(thumbnails: np.ndarray) -> np.ndarray:
+    pixels = AVERAGE_MATRIX @ thumbnails @ DIFFERENCE_MATRIX.T
+    return pack_bits(pixels[:, :, 1:] > pixels[:, :, :-1])
+
+
+def hash_to_hex(hash: int) -> str:
+    return format(hash & (2**64 - 1), "016x")
+
+
+def hex_to_hash(hex: str) -> int:
+    value = int(hex, 16)
+    return value - 2**64 if value >= 2**63 else value
+
+
+def calc_hashes(thumbnails: List[np.ndarray], extra_hashes: bool = False) -> List[Dict[str, Any]]:
+    if len(thumbnails) == 0:
+        return []
+    # Only make_thumbnail is per image; the transforms run once over the stacked thumbnails.
+    stacked_thumbnails = np.stack(thumbnails).astype(np.float64)
+    columns = {"perseptualHashInt": calc_perceptual_hashes(stacked_thumbnails).tolist()}
+    if extra_hashes:
+        columns["differenceHashInt"] = calc_difference_hashes(stacked_thumbnails).tolist()
+        columns["averageHashInt"] = calc_average_hashes(stacked_thumbnails).tolist()
+    records = [dict(zip(columns.keys(), values)) for values in zip(*columns.values())]
+    for record in records:
+        record["perseptualHash"] = hash_to_hex(record["perseptualHashInt"])
+    return records
@@ -1,7 +1,9 @@
 import concurrent.futures
+import functools
 import json
 import logging
 import os
+import pathlib
 import random
 from datetime import datetime
 from typing import Any, Dict, List, Optional
@@ -11,21 +13,43 @@ import more_itertools
 import pymongo
 import requests
 
-from .command import option_log_level, option_mongodb_url
-from .db import get_database
+from .blob_cache import BlobCache, make_blob_cache
+from .command import (
+    option_cache_dir,
+    option_cache_max_bytes,
+    option_follow,
+    option_initial_connections_per_host,
+    option_latency_tolerance,
+    option_lease_duration,
+    option_log_level,
+    option_max_connections_per_host,
+    option_mongodb_url,
+    option_scan_ranges,
+)
+from .db import BulkWriter, get_database
+from .follow import Watcher, dispatch_changes
+from .http_client import configure_http_client, get_http_client
+from .lease import LeaseSpec, process_ids, submit_leased, submit_records
+from .prediction_reuse import (
+    REUSE_MODES,
+    REUSE_SHA1,
+    PredictionReuser,
+    ReuseSpec,
+    make_reuse_spec,
+    make_reused_prediction,
+)
+from .scan_range import submit_range_scans
+from .status import STATUS_DONE, make_pending_condition, make_status_record
 
 COLLECTION_URL = "url"
 COLLECTION_OBJECT = "object"
 CLASSIFIER_NAME = "ocaz-classifier-nsfw-gantman"
 TARGET_FIELD = f"image.predictions.{CLASSIFIER_NAME}"
+UNPREDICTED_CONDITION = make_pending_condition(CLASSIFIER_NAME)
 
 
 def find_unpredicted_object_ids(mongodb: pymongo.database.Database, max_records: Optional[int] = None) -> List[str]:
-    records = (
-        mongodb[COLLECTION_OBJECT]
-        .find({"image": {"$exists": True}, TARGET_FIELD: {"$exists": False}})
-        .sort("_id", pymongo.ASCENDING)
-    )
+    records = mongodb[COLLECTION_OBJECT].find(UNPREDICTED_CONDITION, {"_id": True}).sort("_id", pymongo.ASCENDING)
     if max_records:
         records = records.limit(max_records)
     return [record["_id"] for record in records]
@@ -44,60 +68,88 @@ def find_url(mongodb: pymongo.database.Database, object_id: str) -> Optional[str
 
 def get(url: str) -> Any:
     logging.info(f"get {url}")
-    response = requests.get(url)
-    assert response.status_code == requests.codes.ok
-    return response
+    with get_http_client().get(url) as response:
+        assert response.status_code == requests.codes.ok
+        return response
+
+
+def read_object(blob_cache: Optional[BlobCache], object_id: str, url: str) -> bytes:
+    if blob_cache:
+        return blob_cache.read_bytes(object_id, url)
+    else:
+        return get(url).content
 
 
 def predict(base_url: str, bin: bytes, file_name: str, mime_type: str) -> Dict:
-    response = requests.post(
+    with get_http_client().post(
         base_url + "/classify",
         files={"file": (file_name, bin, mime_type)},
+    ) as response:
+        assert response.status_code == requests.codes.ok
+        return response.json()
+
+
+def make_prediction_operation(object_id: str, prediction: Dict[str, Any]) -> pymongo.UpdateOne:
+    return pymongo.UpdateOne(
+        {"_id": object_id},
+        {
+            "$set": {
+                TARGET_FIELD: prediction,
+                "updatedAt": datetime.now().timestamp(),
+                **make_status_record([CLASSIFIER_NAME], STATUS_DONE),
+            },
+        },
     )
-    assert response.status_code == requests.codes.ok
-    return response.json()
 
 
-def predict_objects(mongodb_url: str, classifier_base_url: str, object_ids: List[str]) -> None:
+def predict_objects(
+    mongodb_url: str,
+    classifier_base_url: str,
+    blob_cache: Optional[BlobCache],
+    object_ids: List[str],
+    reuse_spec: Optional[ReuseSpec] = None,
+    max_bulk_operations: int = 100,
+) -> None:
     logging.info(f"object_ids.length = {len(object_ids)}")
 
     mongodb = get_database(mongodb_url)
-    operations = []
+    object_writer = BulkWriter(mongodb[COLLECTION_OBJECT], max_operations=max_bulk_operations)
+    reuser = PredictionReuser(mongodb[COLLECTION_OBJECT], reuse_spec, object_ids) if reuse_spec else None
 
     for object_id in object_ids:
         logging.info(f"object_id = {object_id}")
 
-        object_record = find_object(mongodb, object_id)
-        object_url = find_url(mongodb, object_id)
-        object_response = get(object_url)
-
-        prediction = predict(
-            base_url=classifier_base_url,
-            bin=object_response.content,
-            file_name=object_id,
-            mime_type=object_record["mimeType"],
-        )
-        assert prediction["service"]["name"] == CLASSIFIER_NAME
-
-        now = datetime.now()
-        operations.append(
-            pymongo.UpdateOne(
-                {"_id": object_id},
-                {
-                    "$set": {
-                        TARGET_FIELD: {
-                            "version": prediction["service"]["version"],
-                            "predictedAt": now.timestamp(),
-                            "labels": prediction["labels"],
-                        },
-                        "updatedAt": now.timestamp(),
-                    },
-                },
+        # A copy of the same image that is already predicted by this classifier version needs no download.
+        if reuser and (donor := reuser.find(object_id)):
+            logging.info(f"reuse prediction of {donor[0]}")
+            object_writer.add(make_prediction_operation(object_id, make_reused_prediction(*donor)), object_id)
+        else:
+            object_record = find_object(mongodb, object_id)
+            object_url = find_url(mongodb, object_id)
+            object_bin = read_object(blob_cache, object_id, object_url)
+
+            prediction = predict(
+                base_url=classifier_base_url,
+                bin=object_bin,
+                file_name=object_id,
+                mime_type=object_record["mimeType"],
             )
-        )
+            assert prediction["service"]["name"] == CLASSIFIER_NAME
+
+            prediction_record = {
+                "version": prediction["service"]["version"],
+                "predictedAt": datetime.now().timestamp(),
+                "labels": prediction["labels"],
+            }
+            object_writer.add(make_prediction_operation(object_id, prediction_record), object_id)
+            if reuser:
+                reuser.add(object_id, prediction_record)
 
-    if len(operations) > 0:
-        mongodb[COLLECTION_OBJECT].bulk_write(operations)
+        # Flushed by size and age, so a long chunk does not hold back the predictions made so far.
+        if object_writer.is_due():
+            object_writer.flush()
+
+    object_writer.flush()
 
 
 def predict_nsfw_gantman(
@@ -106,27 +158,93 @@ def predict_nsfw_gantman(
     max_records: Optional[int],
     max_workers: int,
     chunk_size: int,
+    cache_dir: Optional[pathlib.Path],
+    cache_max_bytes: int,
+    follow: bool,
+    lease_duration: Optional[float],
+    max_connections_per_host: int,
+    initial_connections_per_host: int,
+    latency_tolerance: float,
+    scan_ranges: Optional[int],
+    reuse: str,
 ) -> None:
     logging.debug(f"mongodb_url = {json.dumps(mongodb_url)}")
     logging.debug(f"classifier_base_url = {json.dumps(classifier_base_url)}")
     logging.debug(f"max_records = {json.dumps(max_records)}")
     logging.debug(f"max_workers = {json.dumps(max_workers)}")
     logging.debug(f"chunk_size = {json.dumps(chunk_size)}")
+    logging.debug(f"cache_dir = {json.dumps(str(cache_dir))}")
+    logging.debug(f"cache_max_bytes = {json.dumps(cache_max_bytes)}")
+    logging.debug(f"follow = {json.dumps(follow)}")
+    logging.debug(f"lease_duration = {json.dumps(lease_duration)}")
+    logging.debug(f"max_connections_per_host = {json.dumps(max_connections_per_host)}")
+    logging.debug(f"initial_connections_per_host = {json.dumps(initial_connections_per_host)}")
+    logging.debug(f"latency_tolerance = {json.dumps(latency_tolerance)}")
+    logging.debug(f"scan_ranges = {json.dumps(scan_ranges)}")
+    logging.debug(f"reuse = {json.dumps(reuse)}")
 
     mongodb = get_database(mongodb_url)
+    blob_cache = make_blob_cache(cache_dir, cache_max_bytes)
+    watcher = Watcher(mongodb[COLLECTION_OBJECT], UNPREDICTED_CONDITION, {}) if follow else None
+    reuse_spec = make_reuse_spec(CLASSIFIER_NAME, classifier_base_url, reuse)
+    process = functools.partial(
+        process_ids,
+        functools.partial(predict_objects, mongodb_url, classifier_base_url, blob_cache, reuse_spec=reuse_spec),
+    )
+    lease_spec = (
+        LeaseSpec(mongodb_url, COLLECTION_OBJECT, CLASSIFIER_NAME, UNPREDICTED_CONDITION, {}, lease_duration)
+        if lease_duration
+        else None
+    )
 
-    object_ids = find_unpredicted_object_ids(mongodb=mongodb, max_records=max_records)
+    # With a lease or range scans the workers find records themselves instead of splitting a private list.
+    object_ids = (
+        [] if lease_spec or scan_ranges else find_unpredicted_object_ids(mongodb=mongodb, max_records=max_records)
+    )
     random.shuffle(object_ids)
     logging.info(f"object_ids.length = {len(object_ids)}")
 
-    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=configure_http_client,
+        initargs=(max_connections_per_host, initial_connections_per_host, latency_tolerance),
+    ) as executor:
         try:
-            results = [
-                executor.submit(predict_objects, mongodb_url, classifier_base_url, chunked_object_ids)
-                for chunked_object_ids in more_itertools.chunked(object_ids, chunk_size)
-            ]
+            if lease_spec:
+                results = submit_leased(executor, lease_spec, max_workers, chunk_size, max_records, process)
+            elif scan_ranges:
+                results = submit_range_scans(
+                    executor,
+                    mongodb_url,
+                    COLLECTION_OBJECT,
+                    UNPREDICTED_CONDITION,
+                    {},
+                    scan_ranges,
+                    chunk_size,
+                    max_records,
+                    process,
+                )
+            else:
+                results = [
+                    executor.submit(
+                        predict_objects,
+                        mongodb_url,
+                        classifier_base_url,
+                        blob_cache,
+                        chunked_object_ids,
+                        reuse_spec=reuse_spec,
+                    )
+                    for chunked_object_ids in more_itertools.chunked(object_ids, chunk_size)
+                ]
             for result in results:
                 result.result()
+            if watcher:
+                dispatch_changes(
+                    watcher,
+                    submit=functools.partial(submit_records, executor, lease_spec, chunk_size, process),
+                    chunk_size=chunk_size,
+                    max_in_flight=max_workers * 2,
+                )
         except KeyboardInterrupt:
             executor.shutdown(wait=False)
 
@@ -141,16 +259,41 @@ def predict_nsfw_gantman(
     show_default=True,
     required=True,
 )
+@option_cache_dir
+@option_cache_max_bytes
+@option_follow
+@option_lease_duration
+@option_max_connections_per_host
+@option_initial_connections_per_host
+@option_latency_tolerance
+@option_scan_ranges
 @click.option("--max-records", type=int, default=None, show_default=True)
 @click.option("--max-workers", type=int, default=4, show_default=True, required=True)
 @click.option("--chunk-size", type=int, default=10, show_default=True, required=True)
+@click.option(
+    "--reuse",
+    type=click.Choice(REUSE_MODES),
+    default=REUSE_SHA1,
+    show_default=True,
+    required=True,
+    help="copy predictions of the same classifier version from objects with the same key",
+)
 def main(
     log_level: str,
     mongodb_url: str,
     classifier_base_url: str,
+    cache_dir: Optional[pathlib.Path],
+    cache_max_bytes: int,
+    follow: bool,
+    lease_duration: Optional[float],
+    max_connections_per_host: int,
+    initial_connections_per_host: int,
+    latency_tolerance: float,
+    scan_ranges: Optional[int],
     max_records: Optional[int],
     max_workers: int,
     chunk_size: int,
+    reuse: str,
 ) -> None:
     logging.basicConfig(
         format="%(asctime)s %(levelname)s pid:%(process)d %(message)s",
@@ -164,6 +307,15 @@ def main(
         max_records=max_records,
         max_workers=max_workers,
         chunk_size=chunk_size,
+        cache_dir=cache_dir,
+        cache_max_bytes=cache_max_bytes,
+        follow=follow,
+        lease_duration=lease_duration,
+        max_connections_per_host=max_connections_per_host,
+        initial_connections_per_host=initial_connections_per_host,
+        latency_tolerance=latency_tolerance,
+        scan_ranges=scan_ranges,
+        reuse=reuse,
     )
 
     logging.info("done")
@@ -0,0 +1,96 @@
+import dataclasses
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+import pymongo
+import requests
+
+from .http_client import get_http_client
+
+REUSE_NONE = "none"
+REUSE_SHA1 = "sha1"
+REUSE_PHASH = "phash"
+REUSE_MODES = [REUSE_NONE, REUSE_SHA1, REUSE_PHASH]
+# Fields that identify the same image, from the strictest to the loosest.
+REUSE_KEYS: Dict[str, List[str]] = {
+    REUSE_NONE: [],
+    REUSE_SHA1: ["sha1"],
+    REUSE_PHASH: ["sha1", "image.perseptualHashInt"],
+}
+
+
+@dataclasses.dataclass
+class ReuseSpec:
+    classifier_name: str
+    version: str
+    keys: List[str]
+
+    def get_target_field(self) -> str:
+        return f"image.predictions.{self.classifier_name}"
+
+
+def get_classifier_version(classifier_base_url: str) -> str:
+    with get_http_client().get(classifier_base_url + "/about") as response:
+        assert response.status_code == requests.codes.ok
+        version: str = response.json()["service"]["version"]
+        return version
+
+
+def make_reuse_spec(classifier_name: str, classifier_base_url: str, reuse: str) -> Optional[ReuseSpec]:
+    if reuse == REUSE_NONE:
+        return None
+    # Only predictions of the running classifier version are copied; older ones are predicted again.
+    version = get_classifier_version(classifier_base_url)
+    logging.info(f"reuse predictions of {classifier_name} {version} by {', '.join(REUSE_KEYS[reuse])}")
+    return ReuseSpec(classifier_name, version, REUSE_KEYS[reuse])
+
+
+def get_field(record: Dict[str, Any], path: str) -> Any:
+    for name in path.split("."):
+        if not isinstance(record, dict) or name not in record:
+            return None
+        record = record[name]
+    return record
+
+
+class PredictionReuser:
+    # Finds a prediction for an object among other objects with the same key, in the database or earlier in the chunk.
+    def __init__(
+        self, collection: pymongo.collection.Collection[Dict[str, Any]], spec: ReuseSpec, object_ids: List[str]
+    ) -> None:
+        self.spec = spec
+        self.object_records = {
+            record["_id"]: record
+            for record in collection.find({"_id": {"$in": object_ids}}, {key: True for key in spec.keys})
+        }
+        self.donors: Dict[Tuple[str, Any], Tuple[str, Dict[str, Any]]] = {}
+
+        target_field = spec.get_target_field()
+        for key in spec.keys:
+            values = list(
+                {value for record in self.object_records.values() if (value := get_field(record, key)) is not None}
+            )
+            if len(values) == 0:
+                continue
+            donors = collection.find(
+                {key: {"$in": values}, f"{target_field}.version": spec.version, "_id": {"$nin": object_ids}},
+                {key: True, target_field: True},
+            )
+            for donor in donors:
+                self.donors.setdefault((key, get_field(donor, key)), (donor["_id"], get_field(donor, target_field)))
+
+    def get_keys(self, object_id: str) -> List[Tuple[str, Any]]:
+        object_record = self.object_records.get(object_id, {})
+        return [(key, value) for key in self.spec.keys if (value := get_field(object_record, key)) is not None]
+
+    def find(self, object_id: str) -> Optional[Tuple[str, Dict[str, Any]]]:
+        return next((self.donors[key] for key in self.get_keys(object_id) if key in self.donors), None)
+
+    def add(self, object_id: str, prediction: Dict[str, Any]) -> None:
+        if prediction["version"] == self.spec.version:
+            for key in self.get_keys(object_id):
+                self.donors.setdefault(key, (object_id, prediction))
+
+
+def make_reused_prediction(donor_id: str, prediction: Dict[str, Any]) -> Dict[str, Any]:
+    return {**prediction, "reusedFrom": prediction.get("reusedFrom", donor_id)}
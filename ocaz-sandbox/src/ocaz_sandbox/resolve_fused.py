@@ -0,0 +1,405 @@
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import json
+import logging
+import os
+import pathlib
+import random
+import tempfile
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import click
+import magic
+import more_itertools
+import pymongo
+import requests
+
+from .blob_cache import BlobCache, make_blob_cache
+from .command import (
+    option_cache_dir,
+    option_cache_max_bytes,
+    option_follow,
+    option_initial_connections_per_host,
+    option_latency_tolerance,
+    option_lease_duration,
+    option_log_level,
+    option_max_connections_per_host,
+    option_mongodb_url,
+    option_scan_ranges,
+)
+from .db import BulkWriter, get_database
+from .failure import find_attempts, make_failure_operation, make_success_operation
+from .follow import Watcher, dispatch_changes
+from .http_client import configure_http_client, get_http_client
+from .lease import LeaseSpec, submit_leased, submit_records
+from .phash import calc_hashes, make_thumbnail
+from .resolve_media_meta import SUPPORT_MIME_TYPES, get_video_info, is_image, is_video, open_video_capture
+from .resolve_object_meta import (
+    HEAD_BLOCK_SIZE,
+    LEASE_STAGE,
+    MIME_SNIFF_SIZE,
+    UNRESOLVED_CONDITION,
+    URL_PROJECTION,
+    find_unresolved_urls,
+)
+from .resolve_phash import cv2_image_to_pillow_image, read_frame
+from .scan_range import submit_range_scans
+from .status import (
+    STAGE_MEDIA_META,
+    STAGE_NSFW_GANTMAN,
+    STAGE_NSFW_OPENNSFW2,
+    STAGE_OBJECT_META,
+    STAGE_PHASH,
+    STAGE_SHA1,
+    STATUS_DONE,
+    STATUS_PENDING,
+    make_status_record,
+)
+
+COLLECTION_URL = "url"
+COLLECTION_OBJECT = "object"
+
+
+@contextlib.contextmanager
+def open_temp_path(blob_cache: Optional[BlobCache]) -> Iterator[pathlib.Path]:
+    # Inside the cache directory the finished download can be published by a rename.
+    if blob_cache:
+        temp_path = blob_cache.make_temp_path()
+    else:
+        file_descriptor, temp_name = tempfile.mkstemp(prefix="ocaz-")
+        os.close(file_descriptor)
+        temp_path = pathlib.Path(temp_name)
+    try:
+        yield temp_path
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+
+def is_resolved_object(mongodb: pymongo.database.Database[Dict[str, Any]], object_id: str) -> bool:
+    return mongodb[COLLECTION_OBJECT].count_documents({"_id": object_id, "sha1": {"$exists": True}}, limit=1) > 0
+
+
+def download(
+    mongodb: pymongo.database.Database[Dict[str, Any]],
+    url: str,
+    host: Optional[str],
+    temp_path: pathlib.Path,
+    chunk_size: int = 1000 * 1000,
+) -> Dict[str, Any]:
+    head_sha1_hash = hashlib.sha1()
+    sha1_hash = hashlib.sha1()
+    prefix = b""
+    size = 0
+    head_10mb_sha1 = None
+
+    logging.info(f"get {url}")
+    with get_http_client().get(url, host=host, stream=True) as response, temp_path.open("wb") as file:
+        assert response.status_code == requests.codes.ok
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            if size < HEAD_BLOCK_SIZE:
+                head_sha1_hash.update(chunk[: HEAD_BLOCK_SIZE - size])
+            if len(prefix) < MIME_SNIFF_SIZE:
+                prefix += chunk[: MIME_SNIFF_SIZE - len(prefix)]
+            sha1_hash.update(chunk)
+            file.write(chunk)
+            size += len(chunk)
+
+            if head_10mb_sha1 is None and size >= HEAD_BLOCK_SIZE:
+                head_10mb_sha1 = head_sha1_hash.hexdigest()
+                # Another URL of the same object has already been resolved; the rest of the body is not needed.
+                if is_resolved_object(mongodb, head_10mb_sha1):
+                    return {"head10mbSha1": head_10mb_sha1, "complete": False}
+
+    if head_10mb_sha1 is None:
+        head_10mb_sha1 = head_sha1_hash.hexdigest()
+        # A smaller object is hashed only once the whole body is in, but may have been resolved all the same.
+        if is_resolved_object(mongodb, head_10mb_sha1):
+            return {"head10mbSha1": head_10mb_sha1, "complete": False}
+
+    return {
+        "head10mbSha1": head_10mb_sha1,
+        "complete": True,
+        "size": size,
+        "sha1": sha1_hash.hexdigest(),
+        "mimeType": magic.from_buffer(prefix, mime=True),
+    }
+
+
+def probe_media(path: pathlib.Path, mime_type: str) -> Dict[str, Any]:
+    with open_video_capture(str(path)) as video_capture:
+        video_info = get_video_info(video_capture)
+        if is_image(mime_type):
+            del video_info["numberOfFrames"]
+            del video_info["fps"]
+            frame = read_frame(video_capture)
+            video_info.update(calc_hashes([make_thumbnail(cv2_image_to_pillow_image(frame))])[0])
+            return {"image": video_info}
+        elif is_video(mime_type):
+            video_info["duration"] = video_info["numberOfFrames"] / video_info["fps"]
+            return {"video": video_info}
+        else:
+            return {}
+
+
+def find_stages(new_object_record: Dict[str, Any]) -> Tuple[List[str], List[str]]:
+    done_stages = [STAGE_SHA1]
+    pending_stages = []
+    if "image" in new_object_record or "video" in new_object_record:
+        done_stages.append(STAGE_MEDIA_META)
+    elif new_object_record["mimeType"] in SUPPORT_MIME_TYPES:
+        pending_stages.append(STAGE_MEDIA_META)
+    if "image" in new_object_record:
+        done_stages.append(STAGE_PHASH)
+        pending_stages.extend([STAGE_NSFW_GANTMAN, STAGE_NSFW_OPENNSFW2])
+    return done_stages, pending_stages
+
+
+def make_object_fields(new_object_record: Dict[str, Any]) -> Dict[str, Any]:
+    # The media fields are set one by one, so that an object resolved concurrently keeps its image.predictions.
+    fields: Dict[str, Any] = {}
+    for key, value in new_object_record.items():
+        if key in ["image", "video"]:
+            fields.update({f"{key}.{media_key}": media_value for media_key, media_value in value.items()})
+        else:
+            fields[key] = value
+    return fields
+
+
+def resolve_url(
+    mongodb: pymongo.database.Database[Dict[str, Any]],
+    blob_cache: Optional[BlobCache],
+    url_record: Dict[str, Any],
+    object_writer: BulkWriter,
+    url_writer: BulkWriter,
+) -> None:
+    url = url_record["url"]
+    new_url_record: Dict[str, Any] = {"updatedAt": datetime.now().timestamp(), "accessedAt": datetime.now().timestamp()}
+    new_object_record: Optional[Dict[str, Any]] = None
+
+    with open_temp_path(blob_cache) as temp_path:
+        result = download(mongodb, url, url_record.get("host"), temp_path)
+        new_url_record["head10mbSha1"] = result["head10mbSha1"]
+        new_url_record.update(make_status_record([STAGE_OBJECT_META], STATUS_DONE))
+
+        if not result["complete"]:
+            new_url_record.update({"available": True, "error": None})
+        elif result["size"] == 0:
+            new_url_record.update({"available": False, "error": {"detail": "content length is zero"}})
+        else:
+            new_url_record.update({"available": True, "error": None})
+            new_object_record = {
+                "updatedAt": datetime.now().timestamp(),
+                "size": result["size"],
+                "mimeType": result["mimeType"],
+                "sha1": result["sha1"],
+            }
+            if result["mimeType"] in SUPPORT_MIME_TYPES:
+                try:
+                    new_object_record.update(probe_media(temp_path, result["mimeType"]))
+                except Exception:
+                    # resolve_media_meta / resolve_phash will retry these later.
+                    logging.exception(f"failed to probe {url}")
+            if blob_cache:
+                blob_cache.publish(result["head10mbSha1"], temp_path)
+
+    logging.info(f"new_object_record = {json.dumps(new_object_record)}")
+    if new_object_record:
+        done_stages, pending_stages = find_stages(new_object_record)
+        object_writer.add(
+            pymongo.UpdateOne(
+                {"_id": result["head10mbSha1"]},
+                {
+                    "$set": {**make_object_fields(new_object_record), **make_status_record(done_stages, STATUS_DONE)},
+                    "$setOnInsert": {
+                        "createdAt": datetime.now().timestamp(),
+                        **make_status_record(pending_stages, STATUS_PENDING),
+                    },
+                },
+                upsert=True,
+            ),
+            key=result["head10mbSha1"],
+        )
+
+    logging.info(f"new_url_record = {json.dumps(new_url_record)}")
+    url_writer.add(
+        make_success_operation(STAGE_OBJECT_META, url_record["_id"], new_url_record), key=result["head10mbSha1"]
+    )
+
+
+def resolve(
+    mongodb_url: str, blob_cache: Optional[BlobCache], url_records: List[Dict[str, Any]], max_bulk_operations: int = 100
+) -> None:
+    logging.info(f"url_records.length = {len(url_records)}")
+
+    mongodb = get_database(mongodb_url)
+    attempts = find_attempts(
+        mongodb[COLLECTION_URL], STAGE_OBJECT_META, [url_record["_id"] for url_record in url_records]
+    )
+    object_writer = BulkWriter(mongodb[COLLECTION_OBJECT], max_operations=max_bulk_operations)
+    url_writer = BulkWriter(mongodb[COLLECTION_URL], max_operations=max_bulk_operations)
+
+    def flush() -> None:
+        # A url is only marked as resolved once its object has been written.
+        failed_object_ids = object_writer.flush()
+        url_writer.discard(failed_object_ids)
+        url_writer.flush()
+
+    for url_record in url_records:
+        try:
+            resolve_url(mongodb, blob_cache, url_record, object_writer, url_writer)
+        except Exception as error:
+            # Same as resolve_object_meta: the url backs off instead of aborting the rest of the chunk.
+            logging.exception(f"failed to resolve {url_record['url']}")
+            url_writer.add(
+                make_failure_operation(
+                    STAGE_OBJECT_META, url_record["_id"], error, attempts.get(url_record["_id"], 0) + 1
+                )
+            )
+        if object_writer.is_due() or url_writer.is_due():
+            flush()
+
+    flush()
+
+
+def resolve_fused(
+    mongodb_url: str,
+    max_records: Optional[int],
+    max_workers: int,
+    chunk_size: int,
+    cache_dir: Optional[pathlib.Path],
+    cache_max_bytes: int,
+    follow: bool,
+    lease_duration: Optional[float],
+    max_connections_per_host: int,
+    initial_connections_per_host: int,
+    latency_tolerance: float,
+    scan_ranges: Optional[int],
+) -> None:
+    logging.debug(f"mongodb_url = {json.dumps(mongodb_url)}")
+    logging.debug(f"max_records = {json.dumps(max_records)}")
+    logging.debug(f"max_workers = {json.dumps(max_workers)}")
+    logging.debug(f"chunk_size = {json.dumps(chunk_size)}")
+    logging.debug(f"cache_dir = {json.dumps(str(cache_dir))}")
+    logging.debug(f"cache_max_bytes = {json.dumps(cache_max_bytes)}")
+    logging.debug(f"follow = {json.dumps(follow)}")
+    logging.debug(f"lease_duration = {json.dumps(lease_duration)}")
+    logging.debug(f"max_connections_per_host = {json.dumps(max_connections_per_host)}")
+    logging.debug(f"initial_connections_per_host = {json.dumps(initial_connections_per_host)}")
+    logging.debug(f"latency_tolerance = {json.dumps(latency_tolerance)}")
+    logging.debug(f"scan_ranges = {json.dumps(scan_ranges)}")
+
+    mongodb = get_database(mongodb_url)
+    blob_cache = make_blob_cache(cache_dir, cache_max_bytes)
+    watcher = (
+        Watcher(mongodb[COLLECTION_URL], UNRESOLVED_CONDITION, URL_PROJECTION, retry_stage=STAGE_OBJECT_META)
+        if follow
+        else None
+    )
+    process = functools.partial(resolve, mongodb_url, blob_cache)
+    lease_spec = (
+        LeaseSpec(mongodb_url, COLLECTION_URL, LEASE_STAGE, UNRESOLVED_CONDITION, URL_PROJECTION, lease_duration)
+        if lease_duration
+        else None
+    )
+
+    # With a lease or range scans the workers find records themselves instead of splitting a private list.
+    url_records = [] if lease_spec or scan_ranges else list(find_unresolved_urls(mongodb, max_records))
+    random.shuffle(url_records)
+    logging.info(f"url_records.length = {len(url_records)}")
+
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=configure_http_client,
+        initargs=(max_connections_per_host, initial_connections_per_host, latency_tolerance),
+    ) as executor:
+        try:
+            if lease_spec:
+                results = submit_leased(executor, lease_spec, max_workers, chunk_size, max_records, process)
+            elif scan_ranges:
+                results = submit_range_scans(
+                    executor,
+                    mongodb_url,
+                    COLLECTION_URL,
+                    UNRESOLVED_CONDITION,
+                    URL_PROJECTION,
+                    scan_ranges,
+                    chunk_size,
+                    max_records,
+                    process,
+                )
+            else:
+                results = [
+                    executor.submit(resolve, mongodb_url, blob_cache, chunked_url_records)
+                    for chunked_url_records in more_itertools.chunked(url_records, chunk_size)
+                ]
+            for result in results:
+                result.result()
+            if watcher:
+                dispatch_changes(
+                    watcher,
+                    submit=functools.partial(submit_records, executor, lease_spec, chunk_size, process),
+                    chunk_size=chunk_size,
+                    max_in_flight=max_workers * 2,
+                )
+        except KeyboardInterrupt:
+            executor.shutdown(wait=False)
+
+
+@click.command()
+@option_log_level
+@option_mongodb_url
+@option_cache_dir
+@option_cache_max_bytes
+@option_follow
+@option_lease_duration
+@option_max_connections_per_host
+@option_initial_connections_per_host
+@option_latency_tolerance
+@option_scan_ranges
+@click.option("--max-records", type=int, default=None, show_default=True)
+@click.option("--max-workers", type=int, default=4, show_default=True, required=True)
+@click.option("--chunk-size", type=int, default=10, show_default=True, required=True)
+def main(
+    log_level: str,
+    mongodb_url: str,
+    cache_dir: Optional[pathlib.Path],
+    cache_max_bytes: int,
+    follow: bool,
+    lease_duration: Optional[float],
+    max_connections_per_host: int,
+    initial_connections_per_host: int,
+    latency_tolerance: float,
+    scan_ranges: Optional[int],
+    max_records: Optional[int],
+    max_workers: int,
+    chunk_size: int,
+) -> None:
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)s pid:%(process)d %(message)s",
+        level=getattr(logging, log_level.upper(), logging.INFO),
+    )
+    logging.debug(f"log_level = {json.dumps(log_level)}")
+
+    resolve_fused(
+        mongodb_url=mongodb_url,
+        max_records=max_records,
+        max_workers=max_workers,
+        chunk_size=chunk_size,
+        cache_dir=cache_dir,
+        cache_max_bytes=cache_max_bytes,
+        follow=follow,
+        lease_duration=lease_duration,
+        max_connections_per_host=max_connections_per_host,
+        initial_connections_per_host=initial_connections_per_host,
+        latency_tolerance=latency_tolerance,
+        scan_ranges=scan_ranges,
+    )
+
+    logging.info("done")
+
+
+if __name__ == "__main__":
+    main()
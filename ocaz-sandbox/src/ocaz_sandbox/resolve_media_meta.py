@@ -1,7 +1,9 @@
 import concurrent.futures
 import contextlib
+import functools
 import json
 import logging
+import pathlib
 import random
 from datetime import datetime
 from typing import Any, Dict, List, Optional
@@ -11,28 +13,43 @@ import cv2
 import more_itertools
 import pymongo
 
-from .command import option_log_level, option_mongodb_url
+from .blob_cache import BlobCache, make_blob_cache, open_source
+from .command import (
+    option_cache_dir,
+    option_cache_max_bytes,
+    option_follow,
+    option_initial_connections_per_host,
+    option_latency_tolerance,
+    option_lease_duration,
+    option_log_level,
+    option_max_connections_per_host,
+    option_mongodb_url,
+    option_scan_ranges,
+)
 from .db import get_database
+from .follow import Watcher, dispatch_changes
+from .http_client import configure_http_client
+from .lease import LeaseSpec, process_ids, submit_leased, submit_records
+from .media_probe import FileReader, RangeReader, probe_media
+from .scan_range import submit_range_scans
+from .status import (
+    IMAGE_STAGES,
+    STAGE_MEDIA_META,
+    STATUS_DONE,
+    STATUS_PENDING,
+    make_pending_condition,
+    make_status_record,
+)
 
 COLLECTION_URL = "url"
 COLLECTION_OBJECT = "object"
 
 SUPPORT_MIME_TYPES = ["image/jpeg", "image/png", "image/gif", "video/mp4"]
+UNRESOLVED_CONDITION = make_pending_condition(STAGE_MEDIA_META)
 
 
 def find_unresolved_object_ids(mongodb: pymongo.database.Database, max_records: Optional[int] = None) -> List[str]:
-    records = (
-        mongodb[COLLECTION_OBJECT]
-        .find(
-            {
-                "mimeType": {"$in": SUPPORT_MIME_TYPES},
-                "image": {"$exists": False},
-                "video": {"$exists": False},
-            },
-            {"_id": True},
-        )
-        .sort("_id", pymongo.ASCENDING)
-    )
+    records = mongodb[COLLECTION_OBJECT].find(UNRESOLVED_CONDITION, {"_id": True}).sort("_id", pymongo.ASCENDING)
     if max_records:
         records = records.limit(max_records)
     return [record["_id"] for record in records]
@@ -80,7 +97,14 @@ def is_video(mime_type: str) -> bool:
     return mime_type.startswith("video/")
 
 
-def resolve_object(mongodb: pymongo.database.Database, object_id: str) -> None:
+def probe_header(blob_cache: Optional[BlobCache], object_id: str, url: str, mime_type: str) -> Optional[Dict[str, Any]]:
+    # A cached blob is read locally; otherwise only the header ranges are requested, without filling the cache.
+    file = blob_cache.open_cached(object_id) if blob_cache else None
+    with contextlib.closing(FileReader(file) if file else RangeReader(url)) as reader:
+        return probe_media(reader, mime_type)
+
+
+def resolve_object(mongodb: pymongo.database.Database, blob_cache: Optional[BlobCache], object_id: str) -> None:
     logging.info(f"object_id = {object_id}")
 
     object_record = find_object(mongodb, object_id)
@@ -88,6 +112,9 @@ def resolve_object(mongodb: pymongo.database.Database, object_id: str) -> None:
 
     if has_media_meta(object_record):
         logging.warning("the record already has image/video meta info.")
+        mongodb[COLLECTION_OBJECT].update_one(
+            {"_id": object_id}, {"$set": make_status_record([STAGE_MEDIA_META], STATUS_DONE)}
+        )
         return
 
     url_record = find_url(mongodb, object_id)
@@ -95,16 +122,23 @@ def resolve_object(mongodb: pymongo.database.Database, object_id: str) -> None:
 
     url = url_record["url"]
 
-    logging.info(f"get {url}")
-    with open_video_capture(url) as video_capture:
-        video_info = get_video_info(video_capture)
+    video_info = probe_header(blob_cache, object_id, url, object_record["mimeType"])
+    if video_info is None:
+        logging.info(f"get {url}")
+        with open_video_capture(open_source(blob_cache, object_id, url)) as video_capture:
+            video_info = get_video_info(video_capture)
 
     logging.info(f"video_info = {json.dumps(video_info)}")
 
     if is_image(object_record["mimeType"]):
-        del video_info["numberOfFrames"]
-        del video_info["fps"]
-        new_object_record = {"updatedAt": datetime.now().timestamp(), "image": video_info}
+        # Only cv2 reports them for images.
+        video_info.pop("numberOfFrames", None)
+        video_info.pop("fps", None)
+        new_object_record = {
+            "updatedAt": datetime.now().timestamp(),
+            "image": video_info,
+            **make_status_record(IMAGE_STAGES, STATUS_PENDING),
+        }
     elif is_video(object_record["mimeType"]):
         video_info["duration"] = video_info["numberOfFrames"] / video_info["fps"]
         new_object_record = {"updatedAt": datetime.now().timestamp(), "video": video_info}
@@ -113,6 +147,7 @@ def resolve_object(mongodb: pymongo.database.Database, object_id: str) -> None:
 
     logging.info(f"new_object_record = {json.dumps(new_object_record)}")
     if new_object_record:
+        new_object_record.update(make_status_record([STAGE_MEDIA_META], STATUS_DONE))
         mongodb[COLLECTION_OBJECT].update_one(
             {"_id": object_id},
             {
@@ -121,35 +156,91 @@ def resolve_object(mongodb: pymongo.database.Database, object_id: str) -> None:
         )
 
 
-def resolve_objects(mongodb_url: str, object_ids: List[str]) -> None:
+def resolve_objects(mongodb_url: str, blob_cache: Optional[BlobCache], object_ids: List[str]) -> None:
     logging.info(f"object_ids.length = {len(object_ids)}")
 
     mongodb = get_database(mongodb_url)
 
     for object_id in object_ids:
-        resolve_object(mongodb, object_id)
-
-
-def resolve_media_meta(mongodb_url: str, max_records: Optional[int], max_workers: int, chunk_size: int) -> None:
+        resolve_object(mongodb, blob_cache, object_id)
+
+
+def resolve_media_meta(
+    mongodb_url: str,
+    max_records: Optional[int],
+    max_workers: int,
+    chunk_size: int,
+    cache_dir: Optional[pathlib.Path],
+    cache_max_bytes: int,
+    follow: bool,
+    lease_duration: Optional[float],
+    max_connections_per_host: int,
+    initial_connections_per_host: int,
+    latency_tolerance: float,
+    scan_ranges: Optional[int],
+) -> None:
     logging.debug(f"mongodb_url = {json.dumps(mongodb_url)}")
     logging.debug(f"max_records = {json.dumps(max_records)}")
     logging.debug(f"max_workers = {json.dumps(max_workers)}")
     logging.debug(f"chunk_size = {json.dumps(chunk_size)}")
+    logging.debug(f"cache_dir = {json.dumps(str(cache_dir))}")
+    logging.debug(f"cache_max_bytes = {json.dumps(cache_max_bytes)}")
+    logging.debug(f"follow = {json.dumps(follow)}")
+    logging.debug(f"lease_duration = {json.dumps(lease_duration)}")
+    logging.debug(f"max_connections_per_host = {json.dumps(max_connections_per_host)}")
+    logging.debug(f"initial_connections_per_host = {json.dumps(initial_connections_per_host)}")
+    logging.debug(f"latency_tolerance = {json.dumps(latency_tolerance)}")
+    logging.debug(f"scan_ranges = {json.dumps(scan_ranges)}")
 
     mongodb = get_database(mongodb_url)
+    blob_cache = make_blob_cache(cache_dir, cache_max_bytes)
+    watcher = Watcher(mongodb[COLLECTION_OBJECT], UNRESOLVED_CONDITION, {}) if follow else None
+    process = functools.partial(process_ids, functools.partial(resolve_objects, mongodb_url, blob_cache))
+    lease_spec = (
+        LeaseSpec(mongodb_url, COLLECTION_OBJECT, STAGE_MEDIA_META, UNRESOLVED_CONDITION, {}, lease_duration)
+        if lease_duration
+        else None
+    )
 
-    object_ids = find_unresolved_object_ids(mongodb, max_records)
+    # With a lease or range scans the workers find records themselves instead of splitting a private list.
+    object_ids = [] if lease_spec or scan_ranges else find_unresolved_object_ids(mongodb, max_records)
     random.shuffle(object_ids)
     logging.info(f"object_ids.length = {len(object_ids)}")
 
-    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=configure_http_client,
+        initargs=(max_connections_per_host, initial_connections_per_host, latency_tolerance),
+    ) as executor:
         try:
-            results = [
-                executor.submit(resolve_objects, mongodb_url, chunked_object_ids)
-                for chunked_object_ids in more_itertools.chunked(object_ids, chunk_size)
-            ]
+            if lease_spec:
+                results = submit_leased(executor, lease_spec, max_workers, chunk_size, max_records, process)
+            elif scan_ranges:
+                results = submit_range_scans(
+                    executor,
+                    mongodb_url,
+                    COLLECTION_OBJECT,
+                    UNRESOLVED_CONDITION,
+                    {},
+                    scan_ranges,
+                    chunk_size,
+                    max_records,
+                    process,
+                )
+            else:
+                results = [
+                    executor.submit(resolve_objects, mongodb_url, blob_cache, chunked_object_ids)
+                    for chunked_object_ids in more_itertools.chunked(object_ids, chunk_size)
+                ]
             for result in results:
                 result.result()
+            if watcher:
+                dispatch_changes(
+                    watcher,
+                    submit=functools.partial(submit_records, executor, lease_spec, chunk_size, process),
+                    chunk_size=chunk_size,
+                    max_in_flight=max_workers * 2,
+                )
         except KeyboardInterrupt:
             executor.shutdown(wait=False)
 
@@ -157,17 +248,52 @@ def resolve_media_meta(mongodb_url: str, max_records: Optional[int], max_workers
 @click.command()
 @option_log_level
 @option_mongodb_url
+@option_cache_dir
+@option_cache_max_bytes
+@option_follow
+@option_lease_duration
+@option_max_connections_per_host
+@option_initial_connections_per_host
+@option_latency_tolerance
+@option_scan_ranges
 @click.option("--max-records", type=int, default=None, show_default=True)
 @click.option("--max-workers", type=int, default=4, show_default=True, required=True)
 @click.option("--chunk-size", type=int, default=100, show_default=True, required=True)
-def main(log_level: str, mongodb_url: str, max_records: Optional[int], max_workers: int, chunk_size: int) -> None:
+def main(
+    log_level: str,
+    mongodb_url: str,
+    cache_dir: Optional[pathlib.Path],
+    cache_max_bytes: int,
+    follow: bool,
+    lease_duration: Optional[float],
+    max_connections_per_host: int,
+    initial_connections_per_host: int,
+    latency_tolerance: float,
+    scan_ranges: Optional[int],
+    max_records: Optional[int],
+    max_workers: int,
+    chunk_size: int,
+) -> None:
     logging.basicConfig(
         format="%(asctime)s %(levelname)s pid:%(process)d %(message)s",
         level=getattr(logging, log_level.upper(), logging.INFO),
     )
     logging.debug(f"log_level = {json.dumps(log_level)}")
 
-    resolve_media_meta(mongodb_url=mongodb_url, max_records=max_records, max_workers=max_workers, chunk_size=chunk_size)
+    resolve_media_meta(
+        mongodb_url=mongodb_url,
+        max_records=max_records,
+        max_workers=max_workers,
+        chunk_size=chunk_size,
+        cache_dir=cache_dir,
+        cache_max_bytes=cache_max_bytes,
+        follow=follow,
+        lease_duration=lease_duration,
+        max_connections_per_host=max_connections_per_host,
+        initial_connections_per_host=initial_connections_per_host,
+        latency_tolerance=latency_tolerance,
+        scan_ranges=scan_ranges,
+    )
 
     logging.info("done")
 
@@ -1,11 +1,13 @@
 import concurrent.futures
+import contextlib
+import functools
 import hashlib
 import json
 import logging
+import pathlib
 import random
-import re
 from datetime import datetime
-from typing import Any, Dict, List, Optional
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Tuple
 
 import click
 import magic
@@ -13,18 +15,51 @@ import more_itertools
 import pymongo
 import requests
 
-from .command import option_log_level, option_mongodb_url
-from .db import get_database
+from .blob_cache import BlobCache, make_blob_cache
+from .command import (
+    option_cache_dir,
+    option_cache_max_bytes,
+    option_follow,
+    option_initial_connections_per_host,
+    option_latency_tolerance,
+    option_lease_duration,
+    option_log_level,
+    option_max_connections_per_host,
+    option_mongodb_url,
+    option_scan_ranges,
+)
+from .db import BulkWriter, get_database
+from .failure import find_attempts, make_failure_operation, make_retryable_condition, make_success_operation
+from .follow import Watcher, dispatch_changes
+from .http_client import configure_http_client, get_http_client, parse_content_range
+from .lease import LeaseSpec, submit_leased, submit_records
+from .resolve_media_meta import SUPPORT_MIME_TYPES
+from .scan_range import submit_range_scans
+from .status import (
+    STAGE_MEDIA_META,
+    STAGE_OBJECT_META,
+    STAGE_SHA1,
+    STATUS_DONE,
+    STATUS_PENDING,
+    make_pending_condition,
+    make_status_record,
+)
 
 COLLECTION_URL = "url"
 COLLECTION_OBJECT = "object"
 HEAD_BLOCK_SIZE = 10 * 1000 * 1000
+HEAD_READ_CHUNK_SIZE = 64 * 1000
+MIME_SNIFF_SIZE = 64 * 1000
+STAGE = STAGE_OBJECT_META
+UNRESOLVED_CONDITION = {**make_pending_condition(STAGE), **make_retryable_condition(STAGE)}
+URL_PROJECTION = {"url": True, "host": True}
+LEASE_STAGE = STAGE
 
 
-def find_unresolved_urls(mongodb: pymongo.database.Database, max_records: Optional[int] = None) -> Any:
+def find_unresolved_urls(mongodb: pymongo.database.Database[Dict[str, Any]], max_records: Optional[int] = None) -> Any:
     records = (
         mongodb[COLLECTION_URL]
-        .find({"head10mbSha1": {"$exists": False}}, {"_id": True, "url": True})
+        .find(UNRESOLVED_CONDITION, {"_id": True, **URL_PROJECTION})
         .sort("_id", pymongo.ASCENDING)
     )
     if max_records:
@@ -32,18 +67,11 @@ def find_unresolved_urls(mongodb: pymongo.database.Database, max_records: Option
     return records
 
 
-def get_range(url: str, start_byte: int, end_byte: int) -> Any:
-    return requests.get(url, headers={"Range": f"bytes={start_byte}-{end_byte}"})
+def get_range(url: str, start_byte: int, end_byte: int, host: Optional[str] = None) -> Any:
+    return get_http_client().get(url, host=host, headers={"Range": f"bytes={start_byte}-{end_byte}"}, stream=True)
 
 
-def parse_content_range(content_range: str) -> Optional[Dict]:
-    if content_range and (match := re.match(r"^bytes\s+(\d+)-(\d+)/(\d+)$", content_range)):
-        return dict(zip(["start_byte", "end_byte", "total_size"], map(int, match.groups())))
-    else:
-        return None
-
-
-def parse_response_headers(headers: Any) -> Dict:
+def parse_response_headers(headers: Any) -> Dict[str, Any]:
     return {
         "content_length": int(headers.get("Content-Length")),
         "content_range": parse_content_range(headers.get("Content-Range")),
@@ -51,107 +79,243 @@ def parse_response_headers(headers: Any) -> Dict:
     }
 
 
-def calc_sha1(bin: bytes) -> str:
-    return hashlib.sha1(bin).hexdigest()
+def read_head_block(response: Any, file: Optional[BinaryIO]) -> Tuple[str, bytes, int]:
+    # Only one chunk and the MIME sniffing prefix are held in memory at a time.
+    sha1_hash = hashlib.sha1()
+    prefix = b""
+    size = 0
+    for chunk in response.iter_content(chunk_size=HEAD_READ_CHUNK_SIZE):
+        sha1_hash.update(chunk)
+        if len(prefix) < MIME_SNIFF_SIZE:
+            prefix += chunk[: MIME_SNIFF_SIZE - len(prefix)]
+        if file:
+            file.write(chunk)
+        size += len(chunk)
+    return sha1_hash.hexdigest(), prefix, size
 
 
 def guess_mime_type(bin: bytes) -> str:
     return magic.from_buffer(bin, mime=True)
 
 
-def resolve(mongodb_url: str, url_records: List[Dict]) -> None:
-    logging.info(f"url_records.length = {len(url_records)}")
-
-    mongodb = get_database(mongodb_url)
-
-    for url_record in url_records:
-        url = url_record["url"]
-
-        logging.info(f"get {url}")
-        response = get_range(url, start_byte=0, end_byte=HEAD_BLOCK_SIZE - 1)
+@contextlib.contextmanager
+def open_cache_temp_file(
+    blob_cache: Optional[BlobCache], response_headers: Dict[str, Any]
+) -> Iterator[Optional[BinaryIO]]:
+    content_range = response_headers["content_range"]
+    if blob_cache is None or content_range is None or content_range["total_size"] > HEAD_BLOCK_SIZE:
+        yield None
+        return
+    temp_path = blob_cache.make_temp_path()
+    try:
+        with temp_path.open("wb") as file:
+            yield file
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+
+def resolve_url(
+    blob_cache: Optional[BlobCache], url: str, host: Optional[str] = None
+) -> Tuple[str, Dict[str, Any], Optional[Dict[str, Any]]]:
+    logging.info(f"get {url}")
+    with get_range(url, start_byte=0, end_byte=HEAD_BLOCK_SIZE - 1, host=host) as response:
         assert response.status_code in [requests.codes.partial, requests.codes.ok]
         response_headers = parse_response_headers(response.headers)
         assert response_headers["content_length"] <= HEAD_BLOCK_SIZE
 
-        head_10mb_sha1 = calc_sha1(response.content)
-        new_url_record = {
+        with open_cache_temp_file(blob_cache, response_headers) as cache_file:
+            head_10mb_sha1, prefix, size = read_head_block(response, cache_file)
+            assert size == response_headers["content_length"]
+            if cache_file and blob_cache:
+                # The head block is the whole object, so later stages can read it from the cache.
+                cache_file.close()
+                blob_cache.publish(head_10mb_sha1, pathlib.Path(cache_file.name))
+
+    new_url_record: Dict[str, Any] = {
+        "updatedAt": datetime.now().timestamp(),
+        "head10mbSha1": head_10mb_sha1,
+        "accessedAt": datetime.now().timestamp(),
+        **make_status_record([STAGE_OBJECT_META], STATUS_DONE),
+    }
+
+    if response_headers["content_length"] == 0:
+        new_url_record.update({"available": False, "error": {"detail": "content length is zero"}})
+        new_object_record: Optional[Dict[str, Any]] = None
+    else:
+        total_size = response_headers["content_range"]["total_size"]
+        assert response.status_code == requests.codes.partial
+        assert response_headers["content_range"]["start_byte"] == 0
+        assert response_headers["content_range"]["end_byte"] <= response_headers["content_length"] - 1
+        assert total_size > 0
+
+        mime_type = guess_mime_type(prefix)
+        if mime_type != response_headers["content_type"]:
+            logging.warning(f"MIME type is not matched. {mime_type} != {response_headers['content_type']}")
+        if mime_type not in ["image/jpeg", "image/png", "image/gif", "video/mp4"]:
+            logging.warning(f"{mime_type} is unknown MIME type.")
+
+        new_url_record.update(
+            {
+                "available": True,
+                "error": None,
+            }
+        )
+        new_object_record = {
             "updatedAt": datetime.now().timestamp(),
-            "head10mbSha1": head_10mb_sha1,
-            "accessedAt": datetime.now().timestamp(),
+            "size": total_size,
+            "mimeType": mime_type,
         }
+        if total_size <= HEAD_BLOCK_SIZE:
+            new_object_record.update({"sha1": head_10mb_sha1, **make_status_record([STAGE_SHA1], STATUS_DONE)})
+
+    return head_10mb_sha1, new_url_record, new_object_record
+
 
-        if response_headers["content_length"] == 0:
-            new_url_record.update({"available": False, "error": {"detail": "content length is zero"}})
-            new_object_record = None
-        else:
-            total_size = response_headers["content_range"]["total_size"]
-            assert response.status_code == requests.codes.partial
-            assert response_headers["content_range"]["start_byte"] == 0
-            assert response_headers["content_range"]["end_byte"] <= response_headers["content_length"] - 1
-            assert total_size > 0
-
-            mime_type = guess_mime_type(response.content)
-            if mime_type != response_headers["content_type"]:
-                logging.warning(f"MIME type is not matched. {mime_type} != {response_headers['content_type']}")
-            if mime_type not in ["image/jpeg", "image/png", "image/gif", "video/mp4"]:
-                logging.warning(f"{mime_type} is unknown MIME type.")
-
-            new_url_record.update(
-                {
-                    "available": True,
-                    "error": None,
-                }
+def find_pending_stages(new_object_record: Dict[str, Any]) -> List[str]:
+    stages = []
+    if "sha1" not in new_object_record:
+        stages.append(STAGE_SHA1)
+    if new_object_record["mimeType"] in SUPPORT_MIME_TYPES:
+        stages.append(STAGE_MEDIA_META)
+    return stages
+
+
+def resolve(
+    mongodb_url: str, blob_cache: Optional[BlobCache], url_records: List[Dict[str, Any]], max_bulk_operations: int = 100
+) -> None:
+    logging.info(f"url_records.length = {len(url_records)}")
+
+    mongodb = get_database(mongodb_url)
+    attempts = find_attempts(mongodb[COLLECTION_URL], STAGE, [url_record["_id"] for url_record in url_records])
+    object_writer = BulkWriter(mongodb[COLLECTION_OBJECT], max_operations=max_bulk_operations)
+    url_writer = BulkWriter(mongodb[COLLECTION_URL], max_operations=max_bulk_operations)
+
+    def flush() -> None:
+        # A url is only marked as resolved once its object has been written.
+        failed_object_ids = object_writer.flush()
+        url_writer.discard(failed_object_ids)
+        url_writer.flush()
+
+    for url_record in url_records:
+        try:
+            head_10mb_sha1, new_url_record, new_object_record = resolve_url(
+                blob_cache, url_record["url"], url_record.get("host")
             )
-            new_object_record = {
-                "updatedAt": datetime.now().timestamp(),
-                "size": total_size,
-                "mimeType": mime_type,
-            }
-            if total_size <= HEAD_BLOCK_SIZE:
-                new_object_record.update({"sha1": head_10mb_sha1})
+        except Exception as error:
+            # A url that keeps failing (404, DNS, TLS) backs off instead of being fetched again on every run.
+            logging.exception(f"failed to resolve {url_record['url']}")
+            url_writer.add(
+                make_failure_operation(STAGE, url_record["_id"], error, attempts.get(url_record["_id"], 0) + 1)
+            )
+            if url_writer.is_due():
+                flush()
+            continue
 
         logging.info(f"new_object_record = {json.dumps(new_object_record)}")
         if new_object_record:
-            mongodb[COLLECTION_OBJECT].update_one(
-                {"_id": head_10mb_sha1},
-                {
-                    "$set": new_object_record,
-                    "$setOnInsert": {
-                        "createdAt": datetime.now().timestamp(),
+            object_writer.add(
+                pymongo.UpdateOne(
+                    {"_id": head_10mb_sha1},
+                    {
+                        "$set": new_object_record,
+                        "$setOnInsert": {
+                            "createdAt": datetime.now().timestamp(),
+                            # Only a new object starts its stages; an existing one keeps its progress.
+                            **make_status_record(find_pending_stages(new_object_record), STATUS_PENDING),
+                        },
                     },
-                },
-                upsert=True,
+                    upsert=True,
+                ),
+                key=head_10mb_sha1,
             )
 
         logging.info(f"new_url_record = {json.dumps(new_url_record)}")
-        mongodb[COLLECTION_URL].update_one(
-            {"_id": url_record["_id"]},
-            {
-                "$set": new_url_record,
-            },
-        )
-
-
-def resolve_object_meta(mongodb_url: str, max_records: Optional[int], max_workers: int, chunk_size: int) -> None:
+        url_writer.add(make_success_operation(STAGE, url_record["_id"], new_url_record), key=head_10mb_sha1)
+
+        if object_writer.is_due() or url_writer.is_due():
+            flush()
+
+    flush()
+
+
+def resolve_object_meta(
+    mongodb_url: str,
+    max_records: Optional[int],
+    max_workers: int,
+    chunk_size: int,
+    cache_dir: Optional[pathlib.Path],
+    cache_max_bytes: int,
+    follow: bool,
+    lease_duration: Optional[float],
+    max_connections_per_host: int,
+    initial_connections_per_host: int,
+    latency_tolerance: float,
+    scan_ranges: Optional[int],
+) -> None:
     logging.debug(f"mongodb_url = {json.dumps(mongodb_url)}")
     logging.debug(f"max_records = {json.dumps(max_records)}")
     logging.debug(f"max_workers = {json.dumps(max_workers)}")
     logging.debug(f"chunk_size = {json.dumps(chunk_size)}")
+    logging.debug(f"cache_dir = {json.dumps(str(cache_dir))}")
+    logging.debug(f"cache_max_bytes = {json.dumps(cache_max_bytes)}")
+    logging.debug(f"follow = {json.dumps(follow)}")
+    logging.debug(f"lease_duration = {json.dumps(lease_duration)}")
+    logging.debug(f"max_connections_per_host = {json.dumps(max_connections_per_host)}")
+    logging.debug(f"initial_connections_per_host = {json.dumps(initial_connections_per_host)}")
+    logging.debug(f"latency_tolerance = {json.dumps(latency_tolerance)}")
+    logging.debug(f"scan_ranges = {json.dumps(scan_ranges)}")
 
     mongodb = get_database(mongodb_url)
+    blob_cache = make_blob_cache(cache_dir, cache_max_bytes)
+    watcher = (
+        Watcher(mongodb[COLLECTION_URL], UNRESOLVED_CONDITION, URL_PROJECTION, retry_stage=STAGE) if follow else None
+    )
+    process = functools.partial(resolve, mongodb_url, blob_cache)
+    lease_spec = (
+        LeaseSpec(mongodb_url, COLLECTION_URL, LEASE_STAGE, UNRESOLVED_CONDITION, URL_PROJECTION, lease_duration)
+        if lease_duration
+        else None
+    )
 
-    url_records = list(find_unresolved_urls(mongodb, max_records))
+    # With a lease or range scans the workers find records themselves instead of splitting a private list.
+    url_records = [] if lease_spec or scan_ranges else list(find_unresolved_urls(mongodb, max_records))
     random.shuffle(url_records)
     logging.info(f"url_records.length = {len(url_records)}")
 
-    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=configure_http_client,
+        initargs=(max_connections_per_host, initial_connections_per_host, latency_tolerance),
+    ) as executor:
         try:
-            results = [
-                executor.submit(resolve, mongodb_url, chunked_url_records)
-                for chunked_url_records in more_itertools.chunked(url_records, chunk_size)
-            ]
+            if lease_spec:
+                results = submit_leased(executor, lease_spec, max_workers, chunk_size, max_records, process)
+            elif scan_ranges:
+                results = submit_range_scans(
+                    executor,
+                    mongodb_url,
+                    COLLECTION_URL,
+                    UNRESOLVED_CONDITION,
+                    URL_PROJECTION,
+                    scan_ranges,
+                    chunk_size,
+                    max_records,
+                    process,
+                )
+            else:
+                results = [
+                    executor.submit(resolve, mongodb_url, blob_cache, chunked_url_records)
+                    for chunked_url_records in more_itertools.chunked(url_records, chunk_size)
+                ]
             for result in results:
                 result.result()
+            if watcher:
+                dispatch_changes(
+                    watcher,
+                    submit=functools.partial(submit_records, executor, lease_spec, chunk_size, process),
+                    chunk_size=chunk_size,
+                    max_in_flight=max_workers * 2,
+                )
         except KeyboardInterrupt:
             executor.shutdown(wait=False)
 
@@ -159,10 +323,32 @@ def resolve_object_meta(mongodb_url: str, max_records: Optional[int], max_worker
 @click.command()
 @option_log_level
 @option_mongodb_url
+@option_cache_dir
+@option_cache_max_bytes
+@option_follow
+@option_lease_duration
+@option_max_connections_per_host
+@option_initial_connections_per_host
+@option_latency_tolerance
+@option_scan_ranges
 @click.option("--max-records", type=int, default=None, show_default=True)
 @click.option("--max-workers", type=int, default=4, show_default=True, required=True)
 @click.option("--chunk-size", type=int, default=100, show_default=True, required=True)
-def main(log_level: str, mongodb_url: str, max_records: Optional[int], max_workers: int, chunk_size: int) -> None:
+def main(
+    log_level: str,
+    mongodb_url: str,
+    cache_dir: Optional[pathlib.Path],
+    cache_max_bytes: int,
+    follow: bool,
+    lease_duration: Optional[float],
+    max_connections_per_host: int,
+    initial_connections_per_host: int,
+    latency_tolerance: float,
+    scan_ranges: Optional[int],
+    max_records: Optional[int],
+    max_workers: int,
+    chunk_size: int,
+) -> None:
     logging.basicConfig(
         format="%(asctime)s %(levelname)s pid:%(process)d %(message)s",
         level=getattr(logging, log_level.upper(), logging.INFO),
@@ -170,7 +356,18 @@ def main(log_level: str, mongodb_url: str, max_records: Optional[int], max_worke
     logging.debug(f"log_level = {json.dumps(log_level)}")
 
     resolve_object_meta(
-        mongodb_url=mongodb_url, max_records=max_records, max_workers=max_workers, chunk_size=chunk_size
+        mongodb_url=mongodb_url,
+        max_records=max_records,
+        max_workers=max_workers,
+        chunk_size=chunk_size,
+        cache_dir=cache_dir,
+        cache_max_bytes=cache_max_bytes,
+        follow=follow,
+        lease_duration=lease_duration,
+        max_connections_per_host=max_connections_per_host,
+        initial_connections_per_host=initial_connections_per_host,
+        latency_tolerance=latency_tolerance,
+        scan_ranges=scan_ranges,
     )
 
     logging.info("done")
@@ -1,38 +1,66 @@
 import concurrent.futures
 import contextlib
+import functools
+import io
 import json
 import logging
+import pathlib
+import time
 from datetime import datetime
-from typing import Any, List, Optional
+from typing import Any, Dict, List, Optional
 
 import click
 import cv2
-import imagehash
 import more_itertools
 import numpy as np
 import PIL.Image
 import pymongo
 
-from .command import option_log_level, option_mongodb_url
-from .db import get_database
+from .blob_cache import BlobCache, make_blob_cache, open_source
+from .command import (
+    option_cache_dir,
+    option_cache_max_bytes,
+    option_follow,
+    option_initial_connections_per_host,
+    option_latency_tolerance,
+    option_lease_duration,
+    option_log_level,
+    option_max_connections_per_host,
+    option_mongodb_url,
+    option_scan_ranges,
+)
+from .db import BulkWriter, get_database
+from .failure import find_attempts, make_failure_operation, make_retryable_condition, make_success_operation
+from .follow import Watcher, dispatch_changes
+from .http_client import configure_http_client
+from .lease import LeaseSpec, process_ids, submit_leased, submit_records
+from .phash import THUMBNAIL_SIZE, calc_hashes, make_thumbnail
+from .scan_range import submit_range_scans
+from .segmented_download import iter_segmented_content
+from .status import STAGE_PHASH, STATUS_DONE, make_pending_condition, make_status_record
 
 COLLECTION_URL = "url"
 COLLECTION_OBJECT = "object"
+STAGE = STAGE_PHASH
+UNRESOLVED_CONDITION = {**make_pending_condition(STAGE), **make_retryable_condition(STAGE)}
+# JPEGs are decoded at 1/2 to 1/8 scale but no smaller than this, which keeps the hashes within a few bits.
+DRAFT_SIZE = THUMBNAIL_SIZE * 8
 
 
 def find_phash_unresolved_object_ids(
     mongodb: pymongo.database.Database, max_records: Optional[int] = None
 ) -> List[Any]:
-    records = (
-        mongodb[COLLECTION_OBJECT]
-        .find({"image": {"$exists": True}, "image.perseptualHash": {"$exists": False}}, {"_id": True})
-        .sort("_id", pymongo.ASCENDING)
-    )
+    records = mongodb[COLLECTION_OBJECT].find(UNRESOLVED_CONDITION, {"_id": True}).sort("_id", pymongo.ASCENDING)
     if max_records:
         records = records.limit(max_records)
     return [record["_id"] for record in records]
 
 
+def find_mime_types(mongodb: pymongo.database.Database, object_ids: List[str]) -> Dict[str, str]:
+    records = mongodb[COLLECTION_OBJECT].find({"_id": {"$in": object_ids}}, {"mimeType": True})
+    return {record["_id"]: record.get("mimeType") for record in records}
+
+
 def find_url(mongodb: pymongo.database.Database, object_id: str) -> Optional[str]:
     if record := mongodb[COLLECTION_URL].find_one({"head10mbSha1": object_id, "available": True}, {"url": True}):
         return record["url"]
@@ -62,61 +90,183 @@ def cv2_image_to_pillow_image(cv_image: np.ndarray) -> PIL.Image:
     return PIL.Image.fromarray(cv2.cvtColor(cv_image, cv2.COLOR_BGR2RGB))
 
 
-def calc_phash_from_url(url: str) -> str:
+def read_image_from_url(url: str) -> PIL.Image:
     with open_video_capture(url) as video_capture:
-        image = read_frame(video_capture)
-        image = cv2_image_to_pillow_image(image)
-        return str(imagehash.phash(image))
+        return cv2_image_to_pillow_image(read_frame(video_capture))
+
+
+def read_object(blob_cache: Optional[BlobCache], object_id: str, url: str) -> bytes:
+    if blob_cache:
+        return blob_cache.read_bytes(object_id, url)
+    else:
+        return b"".join(iter_segmented_content(url))
 
 
-def resolve_objects(mongodb_url: str, object_ids: List[str]) -> None:
+def read_jpeg_thumbnail(bin: bytes) -> Optional[np.ndarray]:
+    image = PIL.Image.open(io.BytesIO(bin))
+    # The EXIF orientation is ignored, as cv2.VideoCapture of the other media types does.
+    if image.format != "JPEG":
+        return None
+    # libjpeg scales down in the DCT domain, so only a fraction of the pixels of a large photo is decoded.
+    image.draft("L", (DRAFT_SIZE, DRAFT_SIZE))
+    return make_thumbnail(image)
+
+
+def read_thumbnail(blob_cache: Optional[BlobCache], object_id: str, url: str, mime_type: Optional[str]) -> np.ndarray:
+    if mime_type == "image/jpeg":
+        bin = read_object(blob_cache, object_id, url)
+        thumbnail = read_jpeg_thumbnail(bin)
+        if thumbnail is not None:
+            return thumbnail
+        # The bytes are already in hand, so decode them rather than fetching the object again, unrotated as above.
+        cv_image = cv2.imdecode(np.frombuffer(bin, np.uint8), cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+        assert cv_image is not None, f"failed to decode {url}"
+        return make_thumbnail(cv2_image_to_pillow_image(cv_image))
+    return make_thumbnail(read_image_from_url(open_source(blob_cache, object_id, url)))
+
+
+def resolve_objects(
+    mongodb_url: str,
+    blob_cache: Optional[BlobCache],
+    object_ids: List[str],
+    extra_hashes: bool = False,
+    max_bulk_operations: int = 100,
+    max_hash_batch_size: int = 32,
+    max_hash_batch_interval: float = 5.0,
+) -> None:
     logging.info(f"object_ids.length = {len(object_ids)}")
 
     mongodb = get_database(mongodb_url)
+    attempts = find_attempts(mongodb[COLLECTION_OBJECT], STAGE, object_ids)
+    mime_types = find_mime_types(mongodb, object_ids)
+    object_writer = BulkWriter(mongodb[COLLECTION_OBJECT], max_operations=max_bulk_operations)
+
+    decoded_object_ids: List[str] = []
+    # Decoded images are reduced right away, so that a chunk of large images does not pile up in memory.
+    thumbnails: List[np.ndarray] = []
+    batch_started_at = time.monotonic()
+
+    def hash_batch() -> None:
+        nonlocal decoded_object_ids, thumbnails, batch_started_at
+        # Thumbnails are hashed together, but in bounded batches, so that a crash or a slow object late in the
+        # chunk does not lose or hold back the hashes of the objects before it.
+        for object_id, hash_record in zip(decoded_object_ids, calc_hashes(thumbnails, extra_hashes)):
+            logging.info(f"hash_record = {json.dumps(hash_record)}")
+            new_object_record: Dict[str, Any] = {
+                "updatedAt": datetime.now().timestamp(),
+                **{f"image.{key}": value for key, value in hash_record.items()},
+                **make_status_record([STAGE], STATUS_DONE),
+            }
+            object_writer.add(make_success_operation(STAGE, object_id, new_object_record), object_id)
+        decoded_object_ids = []
+        thumbnails = []
+        batch_started_at = time.monotonic()
 
-    operations = []
     for object_id in object_ids:
         logging.info(f"object_id = {object_id}")
 
-        url = find_url(mongodb, object_id)
-        logging.info(f"get {url}")
-
-        phash = calc_phash_from_url(url)
-        logging.info(f"phash = {phash}")
-
-        operations.append(
-            pymongo.UpdateOne(
-                {"_id": object_id},
-                {
-                    "$set": {"updatedAt": datetime.now().timestamp(), "image.perseptualHash": phash},
-                },
+        try:
+            url = find_url(mongodb, object_id)
+            assert url, "no available url"
+            logging.info(f"get {url}")
+
+            thumbnails.append(read_thumbnail(blob_cache, object_id, url, mime_types.get(object_id)))
+            decoded_object_ids.append(object_id)
+        except Exception as error:
+            logging.exception(f"failed to resolve {object_id}")
+            object_writer.add(
+                make_failure_operation(STAGE, object_id, error, attempts.get(object_id, 0) + 1), object_id
             )
-        )
-
-    if len(operations) > 0:
-        mongodb[COLLECTION_OBJECT].bulk_write(operations)
-
 
-def resolve_phash(mongodb_url: str, max_records: Optional[int], max_workers: int, chunk_size: int) -> None:
+        if len(thumbnails) >= max_hash_batch_size or time.monotonic() - batch_started_at >= max_hash_batch_interval:
+            hash_batch()
+        if object_writer.is_due():
+            object_writer.flush()
+
+    hash_batch()
+    object_writer.flush()
+
+
+def resolve_phash(
+    mongodb_url: str,
+    max_records: Optional[int],
+    max_workers: int,
+    chunk_size: int,
+    cache_dir: Optional[pathlib.Path],
+    cache_max_bytes: int,
+    follow: bool,
+    lease_duration: Optional[float],
+    max_connections_per_host: int,
+    initial_connections_per_host: int,
+    latency_tolerance: float,
+    scan_ranges: Optional[int],
+    extra_hashes: bool,
+) -> None:
     logging.debug(f"mongodb_url = {json.dumps(mongodb_url)}")
     logging.debug(f"max_records = {json.dumps(max_records)}")
     logging.debug(f"max_workers = {json.dumps(max_workers)}")
     logging.debug(f"chunk_size = {json.dumps(chunk_size)}")
+    logging.debug(f"cache_dir = {json.dumps(str(cache_dir))}")
+    logging.debug(f"cache_max_bytes = {json.dumps(cache_max_bytes)}")
+    logging.debug(f"follow = {json.dumps(follow)}")
+    logging.debug(f"lease_duration = {json.dumps(lease_duration)}")
+    logging.debug(f"max_connections_per_host = {json.dumps(max_connections_per_host)}")
+    logging.debug(f"initial_connections_per_host = {json.dumps(initial_connections_per_host)}")
+    logging.debug(f"latency_tolerance = {json.dumps(latency_tolerance)}")
+    logging.debug(f"scan_ranges = {json.dumps(scan_ranges)}")
+    logging.debug(f"extra_hashes = {json.dumps(extra_hashes)}")
 
     mongodb = get_database(mongodb_url)
+    blob_cache = make_blob_cache(cache_dir, cache_max_bytes)
+    watcher = Watcher(mongodb[COLLECTION_OBJECT], UNRESOLVED_CONDITION, {}, retry_stage=STAGE) if follow else None
+    process = functools.partial(
+        process_ids, functools.partial(resolve_objects, mongodb_url, blob_cache, extra_hashes=extra_hashes)
+    )
+    lease_spec = (
+        LeaseSpec(mongodb_url, COLLECTION_OBJECT, STAGE, UNRESOLVED_CONDITION, {}, lease_duration)
+        if lease_duration
+        else None
+    )
 
-    object_ids = list(find_phash_unresolved_object_ids(mongodb, max_records))
+    # With a lease or range scans the workers find records themselves instead of splitting a private list.
+    object_ids = [] if lease_spec or scan_ranges else list(find_phash_unresolved_object_ids(mongodb, max_records))
     # random.shuffle(object_ids)
     logging.info(f"object_ids.length = {len(object_ids)}")
 
-    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=configure_http_client,
+        initargs=(max_connections_per_host, initial_connections_per_host, latency_tolerance),
+    ) as executor:
         try:
-            results = [
-                executor.submit(resolve_objects, mongodb_url, chunked_object_ids)
-                for chunked_object_ids in more_itertools.chunked(object_ids, chunk_size)
-            ]
+            if lease_spec:
+                results = submit_leased(executor, lease_spec, max_workers, chunk_size, max_records, process)
+            elif scan_ranges:
+                results = submit_range_scans(
+                    executor,
+                    mongodb_url,
+                    COLLECTION_OBJECT,
+                    UNRESOLVED_CONDITION,
+                    {},
+                    scan_ranges,
+                    chunk_size,
+                    max_records,
+                    process,
+                )
+            else:
+                results = [
+                    executor.submit(resolve_objects, mongodb_url, blob_cache, chunked_object_ids, extra_hashes)
+                    for chunked_object_ids in more_itertools.chunked(object_ids, chunk_size)
+                ]
             for result in results:
                 result.result()
+            if watcher:
+                dispatch_changes(
+                    watcher,
+                    submit=functools.partial(submit_records, executor, lease_spec, chunk_size, process),
+                    chunk_size=chunk_size,
+                    max_in_flight=max_workers * 2,
+                )
         except KeyboardInterrupt:
             executor.shutdown(wait=False)
 
@@ -124,17 +274,61 @@ def resolve_phash(mongodb_url: str, max_records: Optional[int], max_workers: int
 @click.command()
 @option_log_level
 @option_mongodb_url
+@option_cache_dir
+@option_cache_max_bytes
+@option_follow
+@option_lease_duration
+@option_max_connections_per_host
+@option_initial_connections_per_host
+@option_latency_tolerance
+@option_scan_ranges
 @click.option("--max-records", type=int, default=None, show_default=True)
 @click.option("--max-workers", type=int, default=4, show_default=True, required=True)
 @click.option("--chunk-size", type=int, default=10, show_default=True, required=True)
-def main(log_level: str, mongodb_url: str, max_records: Optional[int], max_workers: int, chunk_size: int) -> None:
+@click.option(
+    "--extra-hashes",
+    type=bool,
+    default=False,
+    is_flag=True,
+    help="also store differenceHashInt and averageHashInt (from the pHash thumbnail, unlike imagehash)",
+)
+def main(
+    log_level: str,
+    mongodb_url: str,
+    cache_dir: Optional[pathlib.Path],
+    cache_max_bytes: int,
+    follow: bool,
+    lease_duration: Optional[float],
+    max_connections_per_host: int,
+    initial_connections_per_host: int,
+    latency_tolerance: float,
+    scan_ranges: Optional[int],
+    max_records: Optional[int],
+    max_workers: int,
+    chunk_size: int,
+    extra_hashes: bool,
+) -> None:
     logging.basicConfig(
         format="%(asctime)s %(levelname)s pid:%(process)d %(message)s",
         level=getattr(logging, log_level.upper(), logging.INFO),
     )
     logging.debug(f"log_level = {json.dumps(log_level)}")
 
-    resolve_phash(mongodb_url=mongodb_url, max_records=max_records, max_workers=max_workers, chunk_size=chunk_size)
+    resolve_phash(
+        mongodb_url=mongodb_url,
+        max_records=max_records,
+        max_workers=max_workers,
+        chunk_size=chunk_size,
+        cache_dir=cache_dir,
+        cache_max_bytes=cache_max_bytes,
+        follow=follow,
+        lease_duration=lease_duration,
+        max_connections_per_host=max_connections_per_host,
+        initial_connections_per_host=initial_connections_per_host,
+        latency_tolerance=latency_tolerance,
+        scan_ranges=scan_ranges,
+        extra_hashes=extra_hashes,
+    )
 
     logging.info("done")
 
@@ -1,27 +1,47 @@
 import concurrent.futures
+import functools
 import hashlib
 import json
 import logging
+import pathlib
 import random
 from datetime import datetime
-from typing import Any, List, Optional
+from typing import Any, BinaryIO, List, Optional
 
 import click
 import more_itertools
 import pymongo
-import requests
 
-from .command import option_log_level, option_mongodb_url
-from .db import get_database
+from .blob_cache import BlobCache, make_blob_cache
+from .command import (
+    option_cache_dir,
+    option_cache_max_bytes,
+    option_follow,
+    option_initial_connections_per_host,
+    option_latency_tolerance,
+    option_lease_duration,
+    option_log_level,
+    option_max_connections_per_host,
+    option_mongodb_url,
+    option_scan_ranges,
+)
+from .db import BulkWriter, get_database
+from .failure import find_attempts, make_failure_operation, make_retryable_condition, make_success_operation
+from .follow import Watcher, dispatch_changes
+from .http_client import configure_http_client
+from .lease import LeaseSpec, process_ids, submit_leased, submit_records
+from .scan_range import submit_range_scans
+from .segmented_download import iter_segmented_content
+from .status import STAGE_SHA1, STATUS_DONE, make_pending_condition, make_status_record
 
 COLLECTION_URL = "url"
 COLLECTION_OBJECT = "object"
+STAGE = STAGE_SHA1
+UNRESOLVED_CONDITION = {**make_pending_condition(STAGE), **make_retryable_condition(STAGE)}
 
 
 def find_sha1_unresolved_object_ids(mongodb: pymongo.database.Database, max_records: Optional[int] = None) -> Any:
-    records = (
-        mongodb[COLLECTION_OBJECT].find({"sha1": {"$exists": False}}, {"_id": True}).sort("_id", pymongo.ASCENDING)
-    )
+    records = mongodb[COLLECTION_OBJECT].find(UNRESOLVED_CONDITION, {"_id": True}).sort("_id", pymongo.ASCENDING)
     if max_records:
         records = records.limit(max_records)
     return [record["_id"] for record in records]
@@ -35,63 +55,141 @@ def find_url(mongodb: pymongo.database.Database, object_id: str) -> Optional[str
         return None
 
 
-def calc_sha1_from_url(url: str, chunk_size: int = 1000 * 1000) -> str:
-    response = requests.get(url, stream=True)
-    assert response.status_code == requests.codes.ok
+def calc_sha1_from_url(url: str) -> str:
+    sha1_hash = hashlib.sha1()
+    for chunk in iter_segmented_content(url):
+        sha1_hash.update(chunk)
+    return sha1_hash.hexdigest()
+
+
+def calc_sha1_from_file(file: BinaryIO, chunk_size: int = 1000 * 1000) -> str:
     sha1_hash = hashlib.sha1()
-    for chunk in response.iter_content(chunk_size=chunk_size):
+    while chunk := file.read(chunk_size):
         sha1_hash.update(chunk)
     return sha1_hash.hexdigest()
 
 
-def resolve_objects(mongodb_url: str, object_ids: List[str]) -> None:
+def calc_sha1(blob_cache: Optional[BlobCache], object_id: str, url: str) -> str:
+    if blob_cache:
+        with blob_cache.open(object_id, url) as file:
+            return calc_sha1_from_file(file)
+    else:
+        return calc_sha1_from_url(url)
+
+
+def resolve_objects(
+    mongodb_url: str, blob_cache: Optional[BlobCache], object_ids: List[str], max_bulk_operations: int = 100
+) -> None:
     logging.info(f"object_ids.length = {len(object_ids)}")
 
     mongodb = get_database(mongodb_url)
+    attempts = find_attempts(mongodb[COLLECTION_OBJECT], STAGE, object_ids)
+    object_writer = BulkWriter(mongodb[COLLECTION_OBJECT], max_operations=max_bulk_operations)
 
-    operations = []
     for object_id in object_ids:
         logging.info(f"object_id = {object_id}")
 
-        url = find_url(mongodb, object_id)
-        logging.info(f"get {url}")
-
-        new_object_record = {"updatedAt": datetime.now().timestamp(), "sha1": calc_sha1_from_url(url)}
-        logging.info(f"new_object_record = {json.dumps(new_object_record)}")
-
-        operations.append(
-            pymongo.UpdateOne(
-                {"_id": object_id},
-                {
-                    "$set": new_object_record,
-                },
+        try:
+            url = find_url(mongodb, object_id)
+            assert url, "no available url"
+            logging.info(f"get {url}")
+
+            new_object_record = {
+                "updatedAt": datetime.now().timestamp(),
+                "sha1": calc_sha1(blob_cache, object_id, url),
+                **make_status_record([STAGE], STATUS_DONE),
+            }
+            logging.info(f"new_object_record = {json.dumps(new_object_record)}")
+            object_writer.add(make_success_operation(STAGE, object_id, new_object_record), object_id)
+        except Exception as error:
+            # One bad object must not discard the hashes already computed for the rest of the chunk.
+            logging.exception(f"failed to resolve {object_id}")
+            object_writer.add(
+                make_failure_operation(STAGE, object_id, error, attempts.get(object_id, 0) + 1), object_id
             )
-        )
 
-    if len(operations) > 0:
-        mongodb[COLLECTION_OBJECT].bulk_write(operations)
-
-
-def resolve_sha1(mongodb_url: str, max_records: Optional[int], max_workers: int, chunk_size: int) -> None:
+        if object_writer.is_due():
+            object_writer.flush()
+
+    object_writer.flush()
+
+
+def resolve_sha1(
+    mongodb_url: str,
+    max_records: Optional[int],
+    max_workers: int,
+    chunk_size: int,
+    cache_dir: Optional[pathlib.Path],
+    cache_max_bytes: int,
+    follow: bool,
+    lease_duration: Optional[float],
+    max_connections_per_host: int,
+    initial_connections_per_host: int,
+    latency_tolerance: float,
+    scan_ranges: Optional[int],
+) -> None:
     logging.debug(f"mongodb_url = {json.dumps(mongodb_url)}")
     logging.debug(f"max_records = {json.dumps(max_records)}")
     logging.debug(f"max_workers = {json.dumps(max_workers)}")
     logging.debug(f"chunk_size = {json.dumps(chunk_size)}")
+    logging.debug(f"cache_dir = {json.dumps(str(cache_dir))}")
+    logging.debug(f"cache_max_bytes = {json.dumps(cache_max_bytes)}")
+    logging.debug(f"follow = {json.dumps(follow)}")
+    logging.debug(f"lease_duration = {json.dumps(lease_duration)}")
+    logging.debug(f"max_connections_per_host = {json.dumps(max_connections_per_host)}")
+    logging.debug(f"initial_connections_per_host = {json.dumps(initial_connections_per_host)}")
+    logging.debug(f"latency_tolerance = {json.dumps(latency_tolerance)}")
+    logging.debug(f"scan_ranges = {json.dumps(scan_ranges)}")
 
     mongodb = get_database(mongodb_url)
+    blob_cache = make_blob_cache(cache_dir, cache_max_bytes)
+    watcher = Watcher(mongodb[COLLECTION_OBJECT], UNRESOLVED_CONDITION, {}, retry_stage=STAGE) if follow else None
+    process = functools.partial(process_ids, functools.partial(resolve_objects, mongodb_url, blob_cache))
+    lease_spec = (
+        LeaseSpec(mongodb_url, COLLECTION_OBJECT, STAGE, UNRESOLVED_CONDITION, {}, lease_duration)
+        if lease_duration
+        else None
+    )
 
-    object_ids = list(find_sha1_unresolved_object_ids(mongodb, max_records))
+    # With a lease or range scans the workers find records themselves instead of splitting a private list.
+    object_ids = [] if lease_spec or scan_ranges else list(find_sha1_unresolved_object_ids(mongodb, max_records))
     random.shuffle(object_ids)
     logging.info(f"object_ids.length = {len(object_ids)}")
 
-    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+    with concurrent.futures.ProcessPoolExecutor(
+        max_workers=max_workers,
+        initializer=configure_http_client,
+        initargs=(max_connections_per_host, initial_connections_per_host, latency_tolerance),
+    ) as executor:
         try:
-            results = [
-                executor.submit(resolve_objects, mongodb_url, chunked_object_ids)
-                for chunked_object_ids in more_itertools.chunked(object_ids, chunk_size)
-            ]
+            if lease_spec:
+                results = submit_leased(executor, lease_spec, max_workers, chunk_size, max_records, process)
+            elif scan_ranges:
+                results = submit_range_scans(
+                    executor,
+                    mongodb_url,
+                    COLLECTION_OBJECT,
+                    UNRESOLVED_CONDITION,
+                    {},
+                    scan_ranges,
+                    chunk_size,
+                    max_records,
+                    process,
+                )
+            else:
+                results = [
+                    executor.submit(resolve_objects, mongodb_url, blob_cache, chunked_object_ids)
+                    for chunked_object_ids in more_itertools.chunked(object_ids, chunk_size)
+                ]
             for result in results:
                 result.result()
+            if watcher:
+                dispatch_changes(
+                    watcher,
+                    submit=functools.partial(submit_records, executor, lease_spec, chunk_size, process),
+                    chunk_size=chunk_size,
+                    max_in_flight=max_workers * 2,
+                )
         except KeyboardInterrupt:
             executor.shutdown(wait=False)
 
@@ -99,17 +197,52 @@ def resolve_sha1(mongodb_url: str, max_records: Optional[int], max_workers: int,
 @click.command()
 @option_log_level
 @option_mongodb_url
+@option_cache_dir
+@option_cache_max_bytes
+@option_follow
+@option_lease_duration
+@option_max_connections_per_host
+@option_initial_connections_per_host
+@option_latency_tolerance
+@option_scan_ranges
 @click.option("--max-records", type=int, default=None, show_default=True)
 @click.option("--max-workers", type=int, default=4, show_default=True, required=True)
 @click.option("--chunk-size", type=int, default=10, show_default=True, required=True)
-def main(log_level: str, mongodb_url: str, max_records: Optional[int], max_workers: int, chunk_size: int) -> None:
+def main(
+    log_level: str,
+    mongodb_url: str,
+    cache_dir: Optional[pathlib.Path],
+    cache_max_bytes: int,
+    follow: bool,
+    lease_duration: Optional[float],
+    max_connections_per_host: int,
+    initial_connections_per_host: int,
+    latency_tolerance: float,
+    scan_ranges: Optional[int],
+    max_records: Optional[int],
+    max_workers: int,
+    chunk_size: int,
+) -> None:
     logging.basicConfig(
         format="%(asctime)s %(levelname)s pid:%(process)d %(message)s",
         level=getattr(logging, log_level.upper(), logging.INFO),
     )
     logging.debug(f"log_level = {json.dumps(log_level)}")
 
-    resolve_sha1(mongodb_url=mongodb_url, max_records=max_records, max_workers=max_workers, chunk_size=chunk_size)
+    resolve_sha1(
+        mongodb_url=mongodb_url,
+        max_records=max_records,
+        max_workers=max_workers,
+        chunk_size=chunk_size,
+        cache_dir=cache_dir,
+        cache_max_bytes=cache_max_bytes,
+        follow=follow,
+        lease_duration=lease_duration,
+        max_connections_per_host=max_connections_per_host,
+        initial_connections_per_host=initial_connections_per_host,
+        latency_tolerance=latency_tolerance,
+        scan_ranges=scan_ranges,
+    )
 
     logging.info("done")
 
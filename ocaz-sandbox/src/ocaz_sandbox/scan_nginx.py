@@ -1,75 +1,386 @@
-import concurrent.futures
-import itertools
+import asyncio
+import collections
+import email.utils
+import html
 import json
 import logging
+import pathlib
+import re
 import time
-from typing import Any, List
-from urllib.parse import urljoin
+import xml.etree.ElementTree
+from datetime import datetime, timezone
+from typing import Callable, DefaultDict, Dict, List, Optional, Set, TextIO, Tuple
+from urllib.parse import quote, urljoin, urlparse
 
+import aiohttp
 import click
-import requests
-from bs4 import BeautifulSoup
 
 from .command import option_log_level
+from .crawl_checkpoint import CrawlCheckpoint
+from .listing_cache import Entry, Listing, ListingCache
 
+# <a href="name">name</a>    17-Oct-2023 12:34    12345
+AUTOINDEX_HTML_ENTRY_PATTERN = re.compile(
+    r'<a href="([^"]+)">[^<]*</a>\s*(?:(\d{2}-[A-Za-z]{3}-\d{4} \d{2}:\d{2})\s+(\S+))?'
+)
+# The HTML autoindex shows mtimes in minutes (JSON and XML in seconds); a directory changed within that long after
+# it was listed can keep the same mtime, so only a listing taken later than this is trusted by mtime.
+MTIME_PRECISION = 60.0
+MTIME_MARGIN = 5.0
 
-def get_with_retry(url: str, retries: int = 3, delay: float = 1.0) -> Any:
+
+async def get_with_retry(
+    session: aiohttp.ClientSession, url: str, headers: Dict[str, str], retries: int = 3, delay: float = 1.0
+) -> Tuple[int, Dict[str, str], str]:
     for _ in range(retries):
         try:
             logging.info(f"get {url}")
-            return requests.get(url)
-        except (requests.RequestException, ValueError):
+            async with session.get(url, headers=headers) as response:
+                return response.status, dict(response.headers), await response.text()
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError):
             logging.error(f"faild to get {url}")
-            time.sleep(delay)
+            await asyncio.sleep(delay)
             continue
 
     raise Exception(f"Failed to get the URL after {retries} retries")
 
 
-def extract_urls(url: str) -> List[str]:
-    html = get_with_retry(url).text
-    soup = BeautifulSoup(html, "html.parser")
-    return [urljoin(url, href) for a in soup.find_all("a") if (href := a.get("href")) != "../"]
+def parse_html_mtime(mtime: str) -> float:
+    return datetime.strptime(mtime, "%d-%b-%Y %H:%M").replace(tzinfo=timezone.utc).timestamp()
+
+
+def parse_html_entries(url: str, text: str) -> List[Entry]:
+    entries = []
+    for match in AUTOINDEX_HTML_ENTRY_PATTERN.finditer(text):
+        href, mtime, size = match.groups()
+        if href == "../":
+            continue
+        entries.append(
+            Entry(
+                url=urljoin(url, html.unescape(href)),
+                size=int(size) if size and size.isdigit() else None,
+                mtime=parse_html_mtime(mtime) if mtime else None,
+            )
+        )
+    return entries
+
+
+def make_child_url(url: str, name: str, is_directory: bool) -> str:
+    # Escape like the hrefs of the HTML autoindex, so every format yields the same URL (and URL id).
+    return urljoin(url, quote(name, safe="!$&'()*+,:;=@") + ("/" if is_directory else ""))
+
+
+def parse_json_entries(url: str, text: str) -> List[Entry]:
+    return [
+        Entry(
+            url=make_child_url(url, item["name"], item["type"] == "directory"),
+            size=item.get("size"),
+            mtime=email.utils.parsedate_to_datetime(item["mtime"]).timestamp() if "mtime" in item else None,
+        )
+        for item in json.loads(text)
+    ]
+
+
+def parse_xml_mtime(mtime: str) -> float:
+    return datetime.strptime(mtime, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc).timestamp()
+
+
+def parse_xml_entries(url: str, text: str) -> List[Entry]:
+    return [
+        Entry(
+            url=make_child_url(url, element.text or "", element.tag == "directory"),
+            size=int(size) if (size := element.get("size")) else None,
+            mtime=parse_xml_mtime(mtime) if (mtime := element.get("mtime")) else None,
+        )
+        for element in xml.etree.ElementTree.fromstring(text)
+        if element.tag in ("directory", "file")
+    ]
+
+
+def find_entries_parser(content_type: str) -> Callable[[str, str], List[Entry]]:
+    # autoindex_format json / xml / html
+    if content_type.startswith("application/json"):
+        return parse_json_entries
+    elif content_type.startswith("text/xml") or content_type.startswith("application/xml"):
+        return parse_xml_entries
+    else:
+        return parse_html_entries
 
 
 def is_dir(url: str) -> bool:
     return url.endswith("/")
 
 
-def scan_nginx(max_workers: int, origin_url: str) -> None:
+def get_listed_at(headers: Dict[str, str]) -> float:
+    # The Date of the response is on the same clock as the autoindex mtimes.
+    if date := headers.get("Date"):
+        try:
+            return email.utils.parsedate_to_datetime(date).timestamp()
+        except (TypeError, ValueError):
+            pass
+    return time.time()
+
+
+def is_unchanged_leaf(cached: Optional[Listing], dir_mtime: Optional[float]) -> bool:
+    # The autoindex mtime of a directory only changes when its own entries are added or removed, so a cached
+    # listing can be reused without a request only for leaf directories; a parent must still be fetched to
+    # learn the current mtimes of its subdirectories.
+    return bool(
+        cached
+        and dir_mtime
+        and cached.mtime == dir_mtime
+        and cached.listed_at
+        and cached.listed_at >= dir_mtime + MTIME_PRECISION + MTIME_MARGIN
+        and not any(is_dir(entry.url) for entry in cached.entries)
+    )
+
+
+def make_conditional_headers(listing: Optional[Listing]) -> Dict[str, str]:
+    headers = {}
+    if listing and listing.etag:
+        headers["If-None-Match"] = listing.etag
+    if listing and listing.last_modified:
+        headers["If-Modified-Since"] = listing.last_modified
+    return headers
+
+
+async def crawl(
+    origin_url: str,
+    max_workers: int,
+    max_connections_per_host: int,
+    listing_cache: Optional[ListingCache],
+    checkpoint: Optional[CrawlCheckpoint],
+    removed_file: Optional[TextIO],
+    output: Callable[[Entry], None],
+) -> None:
+    queue: asyncio.Queue[Tuple[str, Optional[float]]] = asyncio.Queue()
+    visited: Set[str] = {origin_url}
+    host_semaphores: DefaultDict[str, asyncio.Semaphore] = collections.defaultdict(
+        lambda: asyncio.Semaphore(max_connections_per_host)
+    )
+    if checkpoint and (checkpoint_visited := checkpoint.load_visited()):
+        visited = checkpoint_visited
+        pending = checkpoint.load_pending()
+        logging.info(f"resume: visited.length = {len(visited)}, pending.length = {len(pending)}")
+        for dir_url, dir_mtime in pending:
+            queue.put_nowait((dir_url, dir_mtime))
+    else:
+        if checkpoint:
+            checkpoint.add(origin_url, None)
+        queue.put_nowait((origin_url, None))
+
+    def flush_checkpoint_if_due() -> None:
+        # The listing cache is committed right after the checkpoint, never before it; otherwise a crash could leave
+        # a directory listed in the cache but still pending, and its added URLs would not be printed on resume.
+        if checkpoint and checkpoint.flush_if_due() and listing_cache:
+            listing_cache.commit()
+
+    def report_removed(url: str) -> None:
+        logging.info(f"removed {url}")
+        if removed_file:
+            print(url, file=removed_file)
+
+    async def list_dir(
+        session: aiohttp.ClientSession, dir_url: str, dir_mtime: Optional[float]
+    ) -> Tuple[List[Entry], Optional[Listing]]:
+        cached = listing_cache.get(dir_url) if listing_cache else None
+        if cached and is_unchanged_leaf(cached, dir_mtime):
+            logging.debug(f"unchanged {dir_url}")
+            return cached.entries, cached
+
+        async with host_semaphores[urlparse(dir_url).netloc]:
+            status, headers, text = await get_with_retry(session, dir_url, make_conditional_headers(cached))
+        if cached and status == 304:
+            entries = cached.entries
+        elif status != 200:
+            # An error page would parse as an empty listing and report the whole cached subtree as removed;
+            # the cache is left as it is and the directory stays pending in the checkpoint.
+            raise Exception(f"unexpected status {status} for {dir_url}")
+        else:
+            entries = find_entries_parser(headers.get("Content-Type", ""))(dir_url, text)
+        if listing_cache:
+            listing_cache.put(
+                dir_url,
+                Listing(
+                    etag=headers.get("ETag"),
+                    last_modified=headers.get("Last-Modified"),
+                    mtime=dir_mtime,
+                    entries=entries,
+                    listed_at=get_listed_at(headers),
+                ),
+            )
+        return entries, cached
+
+    def find_removed(entries: List[Entry], cached: Listing) -> None:
+        assert listing_cache
+        sub_urls = {entry.url for entry in entries}
+        for cached_entry in cached.entries:
+            if cached_entry.url in sub_urls:
+                continue
+            if is_dir(cached_entry.url):
+                for removed_url in listing_cache.delete_subtree(cached_entry.url):
+                    report_removed(removed_url)
+            else:
+                report_removed(cached_entry.url)
+
+    async def worker(session: aiohttp.ClientSession) -> None:
+        while True:
+            dir_url, dir_mtime = await queue.get()
+            try:
+                entries, cached = await list_dir(session, dir_url, dir_mtime)
+                known_urls = set()
+                if cached:
+                    known_urls = {cached_entry.url for cached_entry in cached.entries}
+                    if entries is not cached.entries:
+                        find_removed(entries, cached)
+                for entry in entries:
+                    if not is_dir(entry.url):
+                        if entry.url not in known_urls:
+                            output(entry)
+                    elif entry.url not in visited:
+                        visited.add(entry.url)
+                        if checkpoint:
+                            checkpoint.add(entry.url, entry.mtime)
+                        queue.put_nowait((entry.url, entry.mtime))
+                if checkpoint:
+                    checkpoint.done(dir_url)
+                    flush_checkpoint_if_due()
+            except Exception:
+                logging.exception(f"failed to scan {dir_url}")
+            finally:
+                queue.task_done()
+
+    connector = aiohttp.TCPConnector(limit_per_host=max_connections_per_host)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        workers = [asyncio.create_task(worker(session)) for _ in range(max_workers)]
+        try:
+            await queue.join()
+        finally:
+            for task in workers:
+                task.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+
+def output_text(entry: Entry) -> None:
+    print(entry.url)
+
+
+def output_jsonl(entry: Entry) -> None:
+    print(json.dumps(entry._asdict(), ensure_ascii=False))
+
+
+OUTPUT_FORMATS: Dict[str, Callable[[Entry], None]] = {
+    "text": output_text,
+    "jsonl": output_jsonl,
+}
+
+
+def scan_nginx(
+    max_workers: int,
+    max_connections_per_host: int,
+    cache_file: Optional[pathlib.Path],
+    removed_file: Optional[pathlib.Path],
+    checkpoint_file: Optional[pathlib.Path],
+    resume: bool,
+    output_format: str,
+    origin_url: str,
+) -> None:
     logging.debug(f"max_workers = {json.dumps(max_workers)}")
+    logging.debug(f"max_connections_per_host = {json.dumps(max_connections_per_host)}")
+    logging.debug(f"cache_file = {json.dumps(str(cache_file))}")
+    logging.debug(f"removed_file = {json.dumps(str(removed_file))}")
+    logging.debug(f"checkpoint_file = {json.dumps(str(checkpoint_file))}")
+    logging.debug(f"resume = {json.dumps(resume)}")
+    logging.debug(f"output_format = {json.dumps(output_format)}")
     logging.debug(f"origin_url = {json.dumps(origin_url)}")
 
-    if is_dir(origin_url):
-        dir_urls = [origin_url]
-        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
-            try:
-                while len(dir_urls) > 0:
-                    new_dir_urls = []
-                    for sub_url in itertools.chain(*executor.map(extract_urls, dir_urls)):
-                        if is_dir(sub_url):
-                            new_dir_urls.append(sub_url)
-                        else:
-                            print(sub_url)
-                    dir_urls = new_dir_urls
-            except KeyboardInterrupt:
-                executor.shutdown(wait=False)
-    else:
-        print(origin_url)
+    output = OUTPUT_FORMATS[output_format]
+
+    if not is_dir(origin_url):
+        output(Entry(url=origin_url, size=None, mtime=None))
+        return
+
+    checkpoint = CrawlCheckpoint(checkpoint_file, resume=resume) if checkpoint_file else None
+    listing_cache = ListingCache(cache_file, commit_interval=None if checkpoint else 1000) if cache_file else None
+    removed_io = removed_file.open("a") if removed_file else None
+    try:
+        asyncio.run(
+            crawl(
+                origin_url,
+                max_workers=max_workers,
+                max_connections_per_host=max_connections_per_host,
+                listing_cache=listing_cache,
+                checkpoint=checkpoint,
+                removed_file=removed_io,
+                output=output,
+            )
+        )
+    except KeyboardInterrupt:
+        logging.warning("interrupted")
+    finally:
+        if checkpoint:
+            checkpoint.close()
+        if listing_cache:
+            listing_cache.close()
+        if removed_io:
+            removed_io.close()
 
 
 @click.command()
 @option_log_level
-@click.option("--max-workers", type=int, default=4, show_default=True, required=True)
+@click.option("--max-workers", type=int, default=16, show_default=True, required=True)
+@click.option("--max-connections-per-host", type=int, default=8, show_default=True, required=True)
+@click.option(
+    "--cache-file",
+    type=click.Path(dir_okay=False, path_type=pathlib.Path),
+    default=None,
+    help="listing cache; when given, only added URLs are printed",
+)
+@click.option(
+    "--removed-file",
+    type=click.Path(dir_okay=False, path_type=pathlib.Path),
+    default=None,
+    help="append removed URLs to this file",
+)
+@click.option(
+    "--checkpoint-file",
+    type=click.Path(dir_okay=False, path_type=pathlib.Path),
+    default=None,
+    help="persist the crawl frontier to this file",
+)
+@click.option("--resume", type=bool, default=False, is_flag=True, help="continue from --checkpoint-file")
+@click.option("--output-format", type=click.Choice(list(OUTPUT_FORMATS.keys())), default="text", show_default=True)
 @click.argument("origin_url")
-def main(log_level: str, max_workers: int, origin_url: str) -> None:
+def main(
+    log_level: str,
+    max_workers: int,
+    max_connections_per_host: int,
+    cache_file: Optional[pathlib.Path],
+    removed_file: Optional[pathlib.Path],
+    checkpoint_file: Optional[pathlib.Path],
+    resume: bool,
+    output_format: str,
+    origin_url: str,
+) -> None:
     logging.basicConfig(
         format="%(asctime)s %(levelname)s pid:%(process)d %(message)s",
         level=getattr(logging, log_level.upper(), logging.INFO),
     )
     logging.debug(f"log_level = {json.dumps(log_level)}")
 
-    scan_nginx(max_workers=max_workers, origin_url=origin_url)
+    if resume and checkpoint_file is None:
+        raise click.UsageError("--resume requires --checkpoint-file")
+
+    scan_nginx(
+        max_workers=max_workers,
+        max_connections_per_host=max_connections_per_host,
+        cache_file=cache_file,
+        removed_file=removed_file,
+        checkpoint_file=checkpoint_file,
+        resume=resume,
+        output_format=output_format,
+        origin_url=origin_url,
+    )
 
     logging.info("done")
 
@@ -0,0 +1,99 @@
+import logging
+import math
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import pymongo
+
+from .db import get_database
+
+# Both url and object ids are SHA-1 hex digests, so their prefixes are uniformly distributed.
+ID_PREFIX_LENGTH = 8
+
+
+def make_id_ranges(number_of_ranges: int) -> List[Tuple[Optional[str], Optional[str]]]:
+    bounds: List[Optional[str]] = [
+        format(index * 16**ID_PREFIX_LENGTH // number_of_ranges, f"0{ID_PREFIX_LENGTH}x")
+        for index in range(1, number_of_ranges)
+    ]
+    return list(zip([None] + bounds, bounds + [None]))
+
+
+def make_range_condition(
+    start_id: Optional[str], end_id: Optional[str], after_id: Optional[str] = None
+) -> Dict[str, Any]:
+    condition = {}
+    if after_id is not None:
+        condition["$gt"] = after_id
+    elif start_id is not None:
+        condition["$gte"] = start_id
+    if end_id is not None:
+        condition["$lt"] = end_id
+    return {"_id": condition} if condition else {}
+
+
+def scan_range(
+    mongodb_url: str,
+    collection_name: str,
+    condition: Dict[str, Any],
+    projection: Dict[str, Any],
+    id_range: Tuple[Optional[str], Optional[str]],
+    chunk_size: int,
+    max_records: Optional[int],
+    process: Callable[[List[Dict[str, Any]]], None],
+) -> int:
+    logging.info(f"scan {collection_name} from {id_range[0]} to {id_range[1]}")
+    mongodb = get_database(mongodb_url)
+
+    start_id, end_id = id_range
+    after_id = None
+    number_of_records = 0
+    while max_records is None or number_of_records < max_records:
+        limit = chunk_size if max_records is None else min(chunk_size, max_records - number_of_records)
+        # Keyset pagination instead of one long-lived cursor, which would time out while a chunk is processed.
+        records = list(
+            mongodb[collection_name]
+            .find({**condition, **make_range_condition(start_id, end_id, after_id)}, {**projection, "_id": True})
+            .sort("_id", pymongo.ASCENDING)
+            .limit(limit)
+        )
+        if len(records) == 0:
+            break
+
+        try:
+            process(records)
+        except Exception as error:
+            logging.error(f"failed to process {len(records)} records: {error!r}")
+        number_of_records += len(records)
+        # Records that are still unresolved are left for the next run; the scan always moves forward.
+        after_id = records[-1]["_id"]
+
+    logging.info(f"scanned {number_of_records} records of {collection_name} from {id_range[0]} to {id_range[1]}")
+    return number_of_records
+
+
+def submit_range_scans(
+    executor: Any,
+    mongodb_url: str,
+    collection_name: str,
+    condition: Dict[str, Any],
+    projection: Dict[str, Any],
+    number_of_ranges: int,
+    chunk_size: int,
+    max_records: Optional[int],
+    process: Callable[[List[Dict[str, Any]]], None],
+) -> List[Any]:
+    max_records_per_range = None if max_records is None else math.ceil(max_records / number_of_ranges)
+    return [
+        executor.submit(
+            scan_range,
+            mongodb_url,
+            collection_name,
+            condition,
+            projection,
+            id_range,
+            chunk_size,
+            max_records_per_range,
+            process,
+        )
+        for id_range in make_id_ranges(number_of_ranges)
+    ]
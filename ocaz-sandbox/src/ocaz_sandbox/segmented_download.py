@@ -0,0 +1,68 @@
+import collections
+import concurrent.futures
+import logging
+from typing import Deque, Iterator, Optional
+
+import requests
+
+from .http_client import get_http_client, parse_content_range
+
+SEGMENT_SIZE = 16 * 1000 * 1000
+MAX_SEGMENTS_IN_FLIGHT = 4
+
+
+def get_segment(url: str, host: Optional[str], start_byte: int, end_byte: int) -> bytes:
+    with get_http_client().get(url, host=host, headers={"Range": f"bytes={start_byte}-{end_byte}"}) as response:
+        assert response.status_code == requests.codes.partial
+        content_range = parse_content_range(response.headers.get("Content-Range"))
+        assert content_range and content_range["start_byte"] == start_byte
+        content: bytes = response.content
+        assert len(content) == end_byte - start_byte + 1
+        return content
+
+
+def iter_segmented_content(
+    url: str,
+    host: Optional[str] = None,
+    segment_size: int = SEGMENT_SIZE,
+    max_segments_in_flight: int = MAX_SEGMENTS_IN_FLIGHT,
+    chunk_size: int = 1000 * 1000,
+) -> Iterator[bytes]:
+    with get_http_client().get(
+        url, host=host, headers={"Range": f"bytes=0-{segment_size - 1}"}, stream=True
+    ) as response:
+        if response.status_code == requests.codes.requested_range_not_satisfiable:
+            # An empty body has no byte to satisfy the range.
+            return
+        content_range = parse_content_range(response.headers.get("Content-Range"))
+        if response.status_code != requests.codes.partial or content_range is None:
+            logging.info(f"{url} does not support Range; download it in a single stream")
+            assert response.status_code == requests.codes.ok
+            yield from response.iter_content(chunk_size=chunk_size)
+            return
+        # Read the first segment up front, so that no host slot is held while the other segments wait for theirs.
+        first_segment = response.content
+
+    total_size = content_range["total_size"]
+    assert len(first_segment) == min(segment_size, total_size)
+    yield first_segment
+
+    ranges = iter(
+        [
+            (start_byte, min(start_byte + segment_size, total_size) - 1)
+            for start_byte in range(segment_size, total_size, segment_size)
+        ]
+    )
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_segments_in_flight) as executor:
+        # The reorder buffer: segments finish in any order but are yielded strictly by offset,
+        # and at most max_segments_in_flight of them are held in memory.
+        segments: Deque[concurrent.futures.Future[bytes]] = collections.deque()
+        for start_byte, end_byte in ranges:
+            segments.append(executor.submit(get_segment, url, host, start_byte, end_byte))
+            if len(segments) >= max_segments_in_flight:
+                break
+        while segments:
+            segment = segments.popleft().result()
+            if next_range := next(ranges, None):
+                segments.append(executor.submit(get_segment, url, host, *next_range))
+            yield segment
@@ -0,0 +1,25 @@
+from typing import Dict, List
+
+STATUS_PENDING = "pending"
+STATUS_DONE = "done"
+
+STAGE_OBJECT_META = "objectMeta"
+STAGE_SHA1 = "sha1"
+STAGE_MEDIA_META = "mediaMeta"
+STAGE_PHASH = "phash"
+# The classifier stages are named after CLASSIFIER_NAME of predict_nsfw_*.
+STAGE_NSFW_GANTMAN = "ocaz-classifier-nsfw-gantman"
+STAGE_NSFW_OPENNSFW2 = "ocaz-classifier-nsfw-opennsfw2"
+
+URL_STAGES = [STAGE_OBJECT_META]
+OBJECT_STAGES = [STAGE_SHA1, STAGE_MEDIA_META, STAGE_PHASH, STAGE_NSFW_GANTMAN, STAGE_NSFW_OPENNSFW2]
+# Stages that become pending once an object turns out to be an image.
+IMAGE_STAGES = [STAGE_PHASH, STAGE_NSFW_GANTMAN, STAGE_NSFW_OPENNSFW2]
+
+
+def make_pending_condition(stage: str) -> Dict[str, str]:
+    return {f"status.{stage}": STATUS_PENDING}
+
+
+def make_status_record(stages: List[str], status: str) -> Dict[str, str]:
+    return {f"status.{stage}": status for stage in stages}